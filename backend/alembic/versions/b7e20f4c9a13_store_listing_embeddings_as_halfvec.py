@@ -0,0 +1,77 @@
+"""store Listing.embeddings as halfvec
+
+Revision ID: b7e20f4c9a13
+Revises: a3c91e52d7b4
+Create Date: 2026-10-17 11:40:05.218733
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b7e20f4c9a13"
+down_revision: Union[str, None] = "a3c91e52d7b4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BACKFILL_BATCH_SIZE = 10000
+
+
+def convert_embeddings(column_type: str, opclass: str):
+    """
+    Rewrites listings.embeddings into `column_type` without locking the table for the duration of the rewrite
+
+    `ALTER COLUMN TYPE` and a plain index build lock the listings for the whole rewrite. Instead the embeddings are
+    copied into a new column in batches, kept in sync by a trigger in the meantime, indexed concurrently and swapped
+    in with a short transaction. An interrupted run can be started again.
+    """
+    op.execute(f"ALTER TABLE listings ADD COLUMN IF NOT EXISTS embeddings_new {column_type}")
+    op.execute(
+        "CREATE OR REPLACE FUNCTION listings_sync_embeddings_new() RETURNS trigger AS $$ BEGIN "
+        f"NEW.embeddings_new := NEW.embeddings::{column_type}; RETURN NEW; "
+        "END $$ LANGUAGE plpgsql"
+    )
+    op.execute("DROP TRIGGER IF EXISTS listings_sync_embeddings_new ON listings")
+    op.execute(
+        "CREATE TRIGGER listings_sync_embeddings_new BEFORE INSERT OR UPDATE OF embeddings ON listings "
+        "FOR EACH ROW EXECUTE FUNCTION listings_sync_embeddings_new()"
+    )
+
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        min_id, max_id = connection.execute(sa.text("SELECT min(id), max(id) FROM listings")).one()
+        # each batch commits on its own, the row locks are held for one batch only
+        for start_id in range(min_id or 0, (max_id or -1) + 1, BACKFILL_BATCH_SIZE):
+            connection.execute(
+                sa.text(
+                    f"UPDATE listings SET embeddings_new = embeddings::{column_type} "
+                    "WHERE id >= :start_id AND id < :end_id AND embeddings IS NOT NULL"
+                ),
+                {"start_id": start_id, "end_id": start_id + BACKFILL_BATCH_SIZE},
+            )
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS listings_embeddings_index_new")
+        op.execute(
+            "CREATE INDEX CONCURRENTLY listings_embeddings_index_new ON listings "
+            f"USING hnsw (embeddings_new {opclass}) WITH (m = 16, ef_construction = 64)"
+        )
+
+    # the swap only changes the catalog, the table is locked for milliseconds
+    op.execute("DROP TRIGGER listings_sync_embeddings_new ON listings")
+    op.execute("DROP FUNCTION listings_sync_embeddings_new()")
+    # the float32 operator classes do not apply to halfvec, the old indexes go with the old column
+    op.execute("DROP INDEX IF EXISTS ivfflat_index")
+    op.execute("DROP INDEX IF EXISTS listings_embeddings_index")
+    op.execute("ALTER TABLE listings DROP COLUMN embeddings")
+    op.execute("ALTER TABLE listings RENAME COLUMN embeddings_new TO embeddings")
+    op.execute("ALTER INDEX listings_embeddings_index_new RENAME TO listings_embeddings_index")
+
+
+def upgrade() -> None:
+    convert_embeddings("halfvec(1536)", "halfvec_cosine_ops")
+
+
+def downgrade() -> None:
+    convert_embeddings("vector(1536)", "vector_cosine_ops")
@@ -0,0 +1,42 @@
+"""partial ANN index on embedded listings, index on Listing.auction_end_time
+
+Revision ID: c58d3a1f06e2
+Revises: b7e20f4c9a13
+Create Date: 2026-10-17 13:02:47.904116
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c58d3a1f06e2"
+down_revision: Union[str, None] = "b7e20f4c9a13"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_listings_auction_end_time ON listings (auction_end_time)"
+        )
+        op.execute(
+            "CREATE INDEX CONCURRENTLY listings_embeddings_index_partial ON listings "
+            "USING hnsw (embeddings halfvec_cosine_ops) WITH (m = 16, ef_construction = 64) "
+            "WHERE embeddings IS NOT NULL"
+        )
+    op.execute("DROP INDEX IF EXISTS listings_embeddings_index")
+    op.execute("ALTER INDEX listings_embeddings_index_partial RENAME TO listings_embeddings_index")
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_listings_auction_end_time")
+        op.execute(
+            "CREATE INDEX CONCURRENTLY listings_embeddings_index_full ON listings "
+            "USING hnsw (embeddings halfvec_cosine_ops) WITH (m = 16, ef_construction = 64)"
+        )
+    op.execute("DROP INDEX IF EXISTS listings_embeddings_index")
+    op.execute("ALTER INDEX listings_embeddings_index_full RENAME TO listings_embeddings_index")
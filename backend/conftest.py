@@ -0,0 +1,10 @@
+import os
+
+# the models create their engines on import, the tests only connect to the database of TEST_DB_URL
+if "TEST_DB_URL" in os.environ:
+    os.environ["DB_URL"] = os.environ["TEST_DB_URL"]
+else:
+    os.environ.setdefault("DB_URL", "postgresql+psycopg2://postgres@localhost/domainwizard_test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+os.environ.setdefault("STRIPE_API_KEY", "test")
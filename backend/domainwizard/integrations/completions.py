@@ -107,11 +107,11 @@ async def rate_domain(domain: str, quality_score: int, prompt: str) -> int:
     return int(response.content[0].text)
 
 
-def get_summary(description: str) -> str:
-    response = client.beta.prompt_caching.messages.create(
-        model="claude-3-5-sonnet-20240620",
-        max_tokens=30,
-        system=[
+def _summary_request(description: str) -> dict:
+    return {
+        "model": "claude-3-5-sonnet-20240620",
+        "max_tokens": 30,
+        "system": [
             {
                 "type": "text",
                 "text": (
@@ -122,9 +122,17 @@ def get_summary(description: str) -> str:
                 "cache_control": {"type": "ephemeral"},
             },
         ],
-        messages=[
+        "messages": [
             {"role": "user", "content": f"The description is: {description}"},
         ],
-    )
+    }
+
+
+def get_summary(description: str) -> str:
+    response = client.beta.prompt_caching.messages.create(**_summary_request(description))
+    return response.content[0].text
+
 
+async def aget_summary(description: str) -> str:
+    response = await aclient.beta.prompt_caching.messages.create(**_summary_request(description))
     return response.content[0].text
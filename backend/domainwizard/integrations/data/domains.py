@@ -1,23 +1,199 @@
+import datetime as dt
+import multiprocessing
 import re
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Iterator
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
+from itertools import compress, islice
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence
+
+import requests
+from loguru import logger
 
 CONTAINS_MORE_THAN_TWO_NUMBERS_PATTERN = re.compile(r".*?\d{3,}.*?$")
 
+# column name -> values of a batch of listings, see `DomainAdapter.yield_listing_batches`
+ColumnBatch = dict[str, list[Any]]
+
+
+def parse_column(values: list[Any], parser: Callable[[Any], Any]) -> list[Any]:
+    """Applies `parser` once per distinct value of the column (feed columns like end times repeat a lot)"""
+    parsed = {value: parser(value) for value in set(values)}
+    return [parsed[value] for value in values]
+
+
+def parse_datetime(value: Optional[str]) -> Optional[dt.datetime]:
+    """Parses the ISO formatted (UTC) timestamps of the feeds"""
+    return dt.datetime.fromisoformat(value).replace(tzinfo=dt.UTC) if value else None
+
+
+def map_bounded(
+    executor: Executor, fnc: Callable[[Any], Any], iterable: Iterable[Any], max_pending: int, ordered: bool = True
+) -> Iterator[Any]:
+    """
+    `executor.map` that only submits up to `max_pending` tasks ahead of the consumer
+
+    Unlike `Executor.map`, the input is not consumed all at once, which keeps the memory bounded when the input is
+    a large feed. With `ordered=False`, results are yielded as they complete.
+    """
+    pending: deque[Future] = deque()
+    for argument in iterable:
+        pending.append(executor.submit(fnc, argument))
+        while len(pending) >= max_pending:
+            yield from _pop_results(pending, ordered)
+    while pending:
+        yield from _pop_results(pending, ordered)
+
+
+def _pop_results(pending: deque[Future], ordered: bool) -> Iterator[Any]:
+    if ordered:
+        yield pending.popleft().result()
+        return
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        pending.remove(future)
+        yield future.result()
+
+
+def iter_column_rows(column_batches: Iterable[ColumnBatch]) -> Iterator[dict[str, Any]]:
+    """Turns column batches back into listing data dicts, e.g. for `Listing.upsert_batch`"""
+    for columns in column_batches:
+        names = list(columns)
+        for values in zip(*columns.values()):
+            yield dict(zip(names, values))
+
 
 class DomainAdapter(ABC):
     url: str
     name: str
+    # download in MB-sized chunks, parsing starts with the first chunk
+    chunk_size = 1024 * 1024
+
+    def __init__(self, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        # seconds spent waiting on the download and in the adapter overall (download + parsing),
+        # see `download_chunks` and `timed_listings_data`
+        self.timings = {"download": 0.0, "adapter": 0.0}
+        # validators of the previous download, the feed is skipped when the server reports it as unchanged
+        self.etag = etag
+        self.last_modified = last_modified
+        self.not_modified = False
+
+    def request_feed(self) -> Optional[requests.Response]:
+        """
+        Conditionally requests the feed, returns None when it did not change since the previous download
+
+        The validators of the new response are stored on the adapter.
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        response = requests.get(self.url, headers=headers, stream=True, timeout=10)
+        if response.status_code == 304:
+            logger.info(f"{self.name} feed not modified since the last download, skipping it")
+            self.not_modified = True
+            response.close()
+            return None
+        response.raise_for_status()
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        return response
 
     @abstractmethod
-    def yield_listings_data(self) -> Iterator[dict[str, Any]]:
+    def yield_raw_items(self) -> Iterator[dict[str, Any]]:
+        """Downloads the feed and yields its items as they are parsed"""
         raise NotImplementedError
 
-    @staticmethod
+    def yield_listings_data(self) -> Iterator[dict[str, Any]]:
+        for item in self.yield_raw_items():
+            listing_data = self.transform_item(item)
+            if self.item_filter(listing_data["url"]):
+                listing_data["source"] = self.name
+                yield listing_data
+
+    def yield_listing_batches(
+        self, batch_size: int = 100000, workers: int = 0, ordered: bool = True
+    ) -> Iterator[ColumnBatch]:
+        """
+        Columnar variant of `yield_listings_data`, yields the listings as batches of column lists
+
+        With `workers`, the batches are transformed and filtered in a process pool while the feed is still being
+        downloaded and parsed, `ordered=False` yields them as soon as they are done.
+        """
+        items = self.yield_raw_items()
+        item_batches = iter(lambda: list(islice(items, batch_size)), [])
+        if not workers:
+            yield from map(self.process_batch, item_batches)
+            return
+        # spawned, the ingest forks from a threaded process otherwise
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            yield from map_bounded(executor, self.process_batch, item_batches, 2 * workers, ordered)
+
+    def process_batch(self, item_batch: Sequence[dict[str, Any]]) -> ColumnBatch:
+        """Transforms and filters a batch of raw items"""
+        columns = self.transform_batch(item_batch)
+        keep = [self.item_filter(url) for url in columns["url"]]
+        if not all(keep):
+            columns = {name: list(compress(values, keep)) for name, values in columns.items()}
+        columns["source"] = [self.name] * len(columns["url"])
+        return columns
+
+    def download_chunks(self, response: requests.Response) -> Iterable[bytes]:
+        """Yields the response body in `chunk_size` chunks, recording the time spent waiting on the network"""
+        chunks = response.iter_content(self.chunk_size)
+        while True:
+            tick = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                self.timings["download"] += time.perf_counter() - tick
+            yield chunk
+
+    def timed_listings_data(self) -> Iterator[dict[str, Any]]:
+        """Yields from `yield_listings_data`, recording the time spent producing the items"""
+        return self._timed(self.yield_listings_data())
+
+    def timed_listing_batches(
+        self, batch_size: int = 100000, workers: int = 0, ordered: bool = True
+    ) -> Iterator[ColumnBatch]:
+        """Yields from `yield_listing_batches`, recording the time spent producing the batches"""
+        return self._timed(self.yield_listing_batches(batch_size, workers, ordered))
+
+    def _timed(self, iterator: Iterator) -> Iterator:
+        while True:
+            tick = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.timings["adapter"] += time.perf_counter() - tick
+            yield item
+
     @abstractmethod
-    def transform_item(item: dict[str, Any]) -> dict[str, Any]:
+    def transform_item(self, item: dict[str, Any]) -> dict[str, Any]:
         raise NotImplementedError
 
+    def transform_batch(self, items: Sequence[dict[str, Any]]) -> ColumnBatch:
+        """
+        Transforms a batch of raw items into column lists
+
+        Falls back to `transform_item` per row, adapters override it to parse whole columns at once.
+        """
+        rows = [self.transform_item(item) for item in items]
+        names = dict.fromkeys(name for row in rows for name in row)
+        return {name: [row.get(name) for row in rows] for name in names}
+
     @staticmethod
     def item_filter(url: str):
         """
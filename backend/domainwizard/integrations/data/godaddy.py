@@ -1,70 +1,73 @@
-import datetime as dt
 import re
-import tempfile
-import zipfile
-from typing import Any, Iterator
+from typing import Any, Iterator, Optional, Sequence
 
 import ijson
-import requests
 from loguru import logger
 
-from .domains import DomainAdapter
+from .domains import ColumnBatch, DomainAdapter, parse_column, parse_datetime
+from .streams import iter_zip_member, open_chunks
 
 DOLLAR_PATTERN = re.compile(r"\$(\d+)")
 
 
+try:
+    ijson_backend = ijson.get_backend("yajl2_c")
+except ImportError:
+    logger.warning("ijson C backend (yajl2_c) not available, falling back to the default backend")
+    ijson_backend = ijson
+
+
+def parse_domain_name(value: str) -> str:
+    return value.lower()
+
+
+def parse_dollars(value: Optional[str]) -> Optional[str]:
+    return match.group(1) if value and (match := DOLLAR_PATTERN.match(value)) else None
+
+
 class GodaddyAdapter(DomainAdapter):
     url = "https://inventory.auctions.godaddy.com/all_listings.json.zip"
     name = "godaddy"
 
-    def yield_listings_data(self) -> Iterator[dict[str, Any]]:
-        response = requests.get(self.url, stream=True, timeout=10)
-        # Sizes in bytes.
-        block_size = 1024
-        with tempfile.TemporaryFile() as buffer:
-            logger.info("Downloading Godaddy domain auctions")
-            for chunk in response.iter_content(block_size):
-                buffer.write(chunk)
+    def yield_raw_items(self) -> Iterator[dict[str, Any]]:
+        if (response := self.request_feed()) is None:
+            return
+        logger.info("Downloading & extracting Godaddy domain auctions")
+        # the json is inflated and parsed while the zip is still downloading
+        json_chunks = iter_zip_member(self.download_chunks(response), self.chunk_size)
+        yield from ijson_backend.items(open_chunks(json_chunks, self.chunk_size), "data.item")
 
-            logger.info("Downloaded dataset from Godaddy. Extracting...")
-            buffer.seek(0)
-            with zipfile.ZipFile(buffer, "r") as myzip:
-                [json_file] = myzip.namelist()
-                with myzip.open(json_file) as myfile:
-                    for item in ijson.items(myfile, "data.item"):
-                        listing_data = self.transform_item(item)
-                        if self.item_filter(listing_data["url"]):
-                            yield listing_data
+    KEYS_TO_TRANSFORM = {
+        "domainName": ("url", parse_domain_name),
+        "auctionEndTime": ("auction_end_time", parse_datetime),
+        "price": ("price", parse_dollars),
+        "valuation": ("valuation", parse_dollars),
+        "monthlyParkingRevenue": ("monthly_parking_revenue", parse_dollars),
+    }
+    KEYS_TO_FNAME = {
+        "link": "link",
+        "auctionType": "auction_type",
+        "numberOfBids": "number_of_bids",
+        "domainAge": "domain_age",
+        "pageviews": "pageviews",
+        "isAdult": "is_adult",
+    }
 
-    @staticmethod
-    def transform_item(domaindatum: dict[str, Any]) -> dict[str, Any]:
-        keys_to_transform = {
-            "domainName": ("url", lambda x: x.lower()),
-            "auctionEndTime": (
-                "auction_end_time",
-                lambda dt_str: dt.datetime.fromisoformat(dt_str).replace(tzinfo=dt.UTC),
-            ),
-            "price": ("price", lambda x: match.group(1) if (match := DOLLAR_PATTERN.match(x)) else None),
-            "valuation": ("valuation", lambda x: match.group(1) if (match := DOLLAR_PATTERN.match(x)) else None),
-            "monthlyParkingRevenue": (
-                "monthly_parking_revenue",
-                lambda x: match.group(1) if (match := DOLLAR_PATTERN.match(x)) else None,
-            ),
-        }
-        keys_to_fname = {
-            "link": "link",
-            "auctionType": "auction_type",
-            "numberOfBids": "number_of_bids",
-            "domainAge": "domain_age",
-            "pageviews": "pageviews",
-            "isAdult": "is_adult",
-        }
+    def transform_item(self, domaindatum: dict[str, Any]) -> dict[str, Any]:
         fields_to_data = {}
         for key, value in domaindatum.items():
-            if key in keys_to_transform:
-                model_fname, fnc = keys_to_transform[key]
+            if key in self.KEYS_TO_TRANSFORM:
+                model_fname, fnc = self.KEYS_TO_TRANSFORM[key]
                 fields_to_data[model_fname] = fnc(value)
             else:
-                fname = keys_to_fname[key]
+                fname = self.KEYS_TO_FNAME[key]
                 fields_to_data[fname] = value
         return fields_to_data
+
+    def transform_batch(self, items: Sequence[dict[str, Any]]) -> ColumnBatch:
+        columns = {}
+        for key, (model_fname, fnc) in self.KEYS_TO_TRANSFORM.items():
+            columns[model_fname] = parse_column([item.get(key) for item in items], fnc)
+        for key, fname in self.KEYS_TO_FNAME.items():
+            columns[fname] = [item.get(key) for item in items]
+        return columns
@@ -2,13 +2,12 @@ import csv
 import datetime as dt
 import io
 import re
-import tempfile
-from typing import Any, Iterator
+from typing import Any, Iterator, Optional, Sequence
 
-import requests
 from loguru import logger
 
-from .domains import DomainAdapter
+from .domains import ColumnBatch, DomainAdapter, parse_column, parse_datetime
+from .streams import open_chunks
 
 DOLLAR_PATTERN = re.compile(r"\$(\d+)")
 CONTAINS_MORE_THAN_TWO_NUMBERS_PATTERN = re.compile(r".*?\d{3,}.*?$")
@@ -20,42 +19,46 @@ class NamecheapAdapter(DomainAdapter):
     url = "https://nc-aftermarket-www-production.s3.amazonaws.com/reports/Namecheap_Market_Sales.csv"
     name = "namecheap"
 
-    def yield_listings_data(self) -> Iterator[dict[str, Any]]:
-        response = requests.get(self.url, stream=True, timeout=10)
-        # Sizes in bytes.
-        block_size = 1024
-        with tempfile.TemporaryFile() as buffer:
-            logger.info("Downloading Namecheap domain auctions")
-            for chunk in response.iter_content(block_size):
-                buffer.write(chunk)
-
-            logger.info("Downloaded dataset from Namecheap. Processing listings..")
-            buffer.seek(0)
-
-            string_buffer = io.TextIOWrapper(buffer, encoding="utf-8")
-            reader = csv.DictReader(string_buffer)
-            for row in reader:
-                listing_data = self.transform_item(row)
-                if self.item_filter(listing_data["url"]):
-                    yield listing_data
-
-    @staticmethod
-    def transform_item(domaindatum: dict[str, Any]) -> dict[str, Any]:
+    def yield_raw_items(self) -> Iterator[dict[str, Any]]:
+        if (response := self.request_feed()) is None:
+            return
+        logger.info("Downloading & processing Namecheap domain auctions")
+        # rows are parsed as the bytes arrive
+        string_buffer = io.TextIOWrapper(
+            open_chunks(self.download_chunks(response), self.chunk_size), encoding="utf-8", newline=""
+        )
+        yield from csv.DictReader(string_buffer)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the domain age is relative to the time of the download
+        self.now = dt.datetime.now(dt.UTC)
+
+    def transform_item(self, domaindatum: dict[str, Any]) -> dict[str, Any]:
         return {
             "url": domaindatum["name"],
             "link": domaindatum["url"],
             "auction_type": "Bid",
-            "auction_end_time": dt.datetime.fromisoformat(domaindatum["endDate"]).replace(tzinfo=dt.UTC),
+            "auction_end_time": parse_datetime(domaindatum["endDate"]),
             "price": int(float(domaindatum["price"])),
             "number_of_bids": int(domaindatum["bidCount"]),
-            "domain_age": (
-                (
-                    dt.datetime.fromisoformat(domaindatum["registeredDate"]).replace(tzinfo=dt.UTC)
-                    - dt.datetime.now(dt.UTC)
-                ).days
-                // 365
-                if domaindatum.get("registeredDate")
-                else None
-            ),
+            "domain_age": self.parse_domain_age(domaindatum.get("registeredDate")),
             "valuation": int(float(domaindatum.get("lastSoldPrice") or domaindatum.get("estibotValue") or 0)),
         }
+
+    def transform_batch(self, items: Sequence[dict[str, Any]]) -> ColumnBatch:
+        return {
+            "url": [item["name"] for item in items],
+            "link": [item["url"] for item in items],
+            "auction_type": ["Bid"] * len(items),
+            "auction_end_time": parse_column([item["endDate"] for item in items], parse_datetime),
+            "price": [int(float(item["price"])) for item in items],
+            "number_of_bids": [int(item["bidCount"]) for item in items],
+            "domain_age": parse_column([item.get("registeredDate") for item in items], self.parse_domain_age),
+            "valuation": [int(float(item.get("lastSoldPrice") or item.get("estibotValue") or 0)) for item in items],
+        }
+
+    def parse_domain_age(self, registered_date: Optional[str]) -> Optional[int]:
+        if not registered_date:
+            return None
+        return (parse_datetime(registered_date) - self.now).days // 365
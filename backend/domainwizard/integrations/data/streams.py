@@ -0,0 +1,76 @@
+import io
+import struct
+import tempfile
+import zipfile
+import zlib
+from typing import Iterable, Iterator
+
+LOCAL_FILE_HEADER = struct.Struct("<4sHHHHHIIIHH")
+LOCAL_FILE_HEADER_SIGNATURE = b"PK\x03\x04"
+DEFLATED = 8
+# size up to which the fallback zip buffer is kept in memory before it spills to disk
+SPOOL_MAX_SIZE = 256 * 1024 * 1024
+
+
+class ChunkReader(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks, e.g. `requests.Response.iter_content`"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def open_chunks(chunks: Iterable[bytes], buffer_size: int = io.DEFAULT_BUFFER_SIZE) -> io.BufferedReader:
+    return io.BufferedReader(ChunkReader(chunks), buffer_size=buffer_size)
+
+
+def iter_zip_member(chunks: Iterable[bytes], chunk_size: int = io.DEFAULT_BUFFER_SIZE) -> Iterator[bytes]:
+    """
+    Yields the decompressed content of the first member of a zip archive while the archive is still downloading
+
+    Deflated members are inflated straight from their local file header (the deflate stream is self-terminating, so
+    the sizes in the central directory at the end of the archive are not needed). Other compression methods fall
+    back to buffering the archive in a spooled temporary file and reading it with `zipfile`.
+    """
+    stream = open_chunks(chunks, chunk_size)
+    header = stream.read(LOCAL_FILE_HEADER.size)
+    signature, _version, _flags, method, *_, name_length, extra_length = LOCAL_FILE_HEADER.unpack(header)
+    if signature != LOCAL_FILE_HEADER_SIGNATURE:
+        raise ValueError("Not a zip archive")
+
+    if method != DEFLATED:
+        yield from _iter_spooled_zip_member(header, stream, chunk_size)
+        return
+
+    stream.read(name_length + extra_length)
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    while not decompressor.eof and (chunk := stream.read(chunk_size)):
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+def _iter_spooled_zip_member(head: bytes, stream: io.BufferedReader, chunk_size: int) -> Iterator[bytes]:
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as buffer:
+        buffer.write(head)
+        while chunk := stream.read(chunk_size):
+            buffer.write(chunk)
+        buffer.seek(0)
+        with zipfile.ZipFile(buffer, "r") as archive:
+            [member] = archive.namelist()
+            with archive.open(member) as member_file:
+                while chunk := member_file.read(chunk_size):
+                    yield chunk
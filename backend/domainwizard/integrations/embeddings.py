@@ -1,10 +1,311 @@
-from openai import OpenAI
+import asyncio
+import hashlib
+import random
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+import openai
+from loguru import logger
+from openai import AsyncOpenAI, OpenAI
 
 from ..config import config
 
-client = OpenAI(api_key=config["OPENAI_API_KEY"])
+# e.g. a local fake server, see `scripts/fake_openai_server.py`
+OPENAI_BASE_URL = config.get("OPENAI_BASE_URL") or None
+client = OpenAI(api_key=config["OPENAI_API_KEY"], base_url=OPENAI_BASE_URL)
+aclient = AsyncOpenAI(api_key=config["OPENAI_API_KEY"], base_url=OPENAI_BASE_URL)
+
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+# rate limits of the embeddings endpoint for the online embedding of listings, see `aembed_texts`
+EMBEDDING_RPM = int(config.get("OPENAI_EMBEDDING_RPM", 3000))
+EMBEDDING_TPM = int(config.get("OPENAI_EMBEDDING_TPM", 1_000_000))
+# the embeddings endpoint accepts up to 2048 inputs per request
+MAX_INPUTS_PER_REQUEST = 2048
+
+
+def normalize_text(text: str) -> str:
+    """Collapses whitespace and case, so that trivial variants of a prompt share their embeddings"""
+    return " ".join(text.split()).casefold()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode()).hexdigest()
+
+
+class EmbeddingCacheStats:
+    """Hit/miss counters of the embedding cache, the saved latency is estimated from the mean latency of a miss"""
+
+    def __init__(self):
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.db_hits
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def saved_seconds(self) -> float:
+        return self.hits * self.miss_seconds / self.misses if self.misses else 0.0
+
+    def record_hit(self, source: str):
+        if source == "memory":
+            self.memory_hits += 1
+        else:
+            self.db_hits += 1
+        logger.info(
+            f"Embedding cache hit ({source}): hit ratio {self.hit_ratio:.1%} "
+            f"({self.memory_hits} memory, {self.db_hits} db, {self.misses} misses), "
+            f"~{self.saved_seconds:.2f}s saved"
+        )
+
+    def record_miss(self, seconds: float):
+        self.misses += 1
+        self.miss_seconds += seconds
+        logger.info(f"Embedding cache miss: took {seconds:.2f}s, hit ratio {self.hit_ratio:.1%}")
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+embedding_lru = LRUCache(int(config.get("EMBEDDING_CACHE_SIZE", 10000)))
+cache_stats = EmbeddingCacheStats()
+
+
+class EmbeddingProvider(ABC):
+    """Embeds texts with a fixed model into vectors of `dimensions`"""
+
+    name: str
+
+    def __init__(self, model: str, dimensions: int):
+        self.model = model
+        self.dimensions = dimensions
+
+    @abstractmethod
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        raise NotImplementedError
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        return await asyncio.to_thread(self.embed, texts)
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    name = "openai"
+
+    def __init__(self, model: str = OPENAI_EMBEDDING_MODEL, dimensions: int = 1536):
+        super().__init__(model, dimensions)
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        response = client.embeddings.create(input=texts, model=self.model)
+        return [datum.embedding for datum in response.data]
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        response = await aclient.embeddings.create(input=texts, model=self.model)
+        return [datum.embedding for datum in response.data]
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """
+    CPU sentence embeddings with an ONNX (optionally quantized) model, requires `fastembed`
+
+    The model is loaded on first use. With `parallel`, large inputs are embedded across that many processes
+    (0: one per core), each loading its own copy of the model, otherwise in this process with `threads`.
+    """
+
+    name = "local"
+
+    def __init__(
+        self,
+        model: str = "BAAI/bge-small-en-v1.5",
+        dimensions: int = 384,
+        batch_size: int = 256,
+        parallel: Optional[int] = None,
+        threads: Optional[int] = None,
+    ):
+        super().__init__(model, dimensions)
+        self.batch_size = batch_size
+        self.parallel = parallel
+        # onnxruntime threads per process, all cores by default
+        self.threads = threads
+        self._text_embedding = None
+
+    @property
+    def text_embedding(self):
+        if self._text_embedding is None:
+            try:
+                from fastembed import TextEmbedding
+            except ImportError as e:
+                raise ImportError("The local embedding provider requires fastembed (pip install fastembed)") from e
+
+            self._text_embedding = TextEmbedding(model_name=self.model, threads=self.threads)
+        return self._text_embedding
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        # the processes only pay off for inputs spanning several batches
+        parallel = self.parallel if len(texts) > self.batch_size else None
+        vectors = self.text_embedding.embed(texts, batch_size=self.batch_size, parallel=parallel)
+        return [vector.tolist() for vector in vectors]
+
+
+EmbeddingProviders = {provider.name: provider for provider in [OpenAIEmbeddingProvider, LocalEmbeddingProvider]}
+
+
+def get_embedding_provider(name: Optional[str] = None) -> EmbeddingProvider:
+    """
+    Instantiates the embedding provider configured with EMBEDDING_PROVIDER (default: openai)
+
+    The local model is set with LOCAL_EMBEDDING_MODEL and its vector size with EMBEDDING_DIMENSIONS. The vector
+    columns are created with that size, switching the model requires migrating the columns and embedding the
+    listings again.
+    """
+    name = name or config.get("EMBEDDING_PROVIDER", OpenAIEmbeddingProvider.name)
+    if name not in EmbeddingProviders:
+        raise ValueError(f"Unknown embedding provider '{name}', choose one of {', '.join(EmbeddingProviders)}")
+    if name == OpenAIEmbeddingProvider.name:
+        return OpenAIEmbeddingProvider()
+    kwargs = {}
+    if model := config.get("LOCAL_EMBEDDING_MODEL"):
+        kwargs["model"] = model
+    if dimensions := config.get("EMBEDDING_DIMENSIONS"):
+        kwargs["dimensions"] = int(dimensions)
+    if parallel := config.get("LOCAL_EMBEDDING_PARALLEL"):
+        kwargs["parallel"] = int(parallel)
+    return LocalEmbeddingProvider(**kwargs)
+
+
+embedding_provider = get_embedding_provider()
+EMBEDDING_DIMENSIONS = embedding_provider.dimensions
+
+
+def listing_text(url: str) -> str:
+    """The text a listing is embedded as, its domain name with the dots replaced by spaces"""
+    return " ".join(url.split("."))
+
+
+def get_embeddings(text: str, provider: EmbeddingProvider = embedding_provider) -> list[float]:
+    key = (provider.model, text_hash(text))
+    if (embeddings := embedding_lru.get(key)) is not None:
+        cache_stats.record_hit("memory")
+        return embeddings
+    tick = time.perf_counter()
+    embeddings = provider.embed([text])[0]
+    cache_stats.record_miss(time.perf_counter() - tick)
+    embedding_lru.put(key, embeddings)
+    return embeddings
+
+
+async def aget_embeddings(text: str, provider: EmbeddingProvider = embedding_provider) -> list[float]:
+    key = (provider.model, text_hash(text))
+    if (embeddings := embedding_lru.get(key)) is not None:
+        cache_stats.record_hit("memory")
+        return embeddings
+    tick = time.perf_counter()
+    embeddings = (await provider.aembed([text]))[0]
+    cache_stats.record_miss(time.perf_counter() - tick)
+    embedding_lru.put(key, embeddings)
+    return embeddings
+
+
+class TokenBucket:
+    """Refills `per_minute` tokens per minute, `acquire` waits until the requested amount is available"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1):
+        # a request larger than the bucket would never fit, it waits for a full bucket instead
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Request (RPM) and token (TPM) buckets of the embeddings endpoint"""
+
+    def __init__(self, requests_per_minute: float = EMBEDDING_RPM, tokens_per_minute: float = EMBEDDING_TPM):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    async def acquire(self, n_tokens: int):
+        await self.requests.acquire()
+        await self.tokens.acquire(n_tokens)
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for english text, the domain names are short
+    return len(text) // 4 + 1
+
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
 
+async def aembed_texts(
+    aclient: AsyncOpenAI,
+    texts: list[str],
+    rate_limiter: RateLimiter,
+    model: str = OPENAI_EMBEDDING_MODEL,
+    max_retries: int = 5,
+) -> list[list[float]]:
+    """
+    Embeds up to `MAX_INPUTS_PER_REQUEST` texts with a single request
 
-def get_embeddings(text, model="text-embedding-3-small"):
-    response = client.embeddings.create(input=text, model=model)
-    return response.data[0].embedding
+    Waits for the rate limiter before each attempt and retries rate limited, timed out and failed requests with
+    exponential backoff and jitter.
+    """
+    if len(texts) > MAX_INPUTS_PER_REQUEST:
+        raise ValueError(f"At most {MAX_INPUTS_PER_REQUEST} inputs per request, got {len(texts)}")
+    n_tokens = sum(map(estimate_tokens, texts))
+    for attempt in range(max_retries + 1):
+        await rate_limiter.acquire(n_tokens)
+        try:
+            response = await aclient.embeddings.create(input=texts, model=model)
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            backoff = min(2**attempt, 60) * (1 + random.random())
+            logger.warning(f"Embedding request failed ({type(e).__name__}), retrying in {backoff:.1f}s")
+            await asyncio.sleep(backoff)
+        else:
+            return [datum.embedding for datum in sorted(response.data, key=lambda datum: datum.index)]
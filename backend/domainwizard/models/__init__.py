@@ -1,2 +1,3 @@
 from .models import *
 from .session import *
+from .vector_index import *
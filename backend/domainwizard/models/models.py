@@ -1,9 +1,14 @@
+import asyncio
+import csv
 import datetime as dt
 import enum
 import hashlib
+import io
+import itertools
 import json
-import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 
 try:
     from itertools import batched  # type: ignore
@@ -19,50 +24,124 @@ except ImportError:
             yield batch
 
 
-from typing import Iterable, Iterator, List, Optional, Self, Sequence, Tuple
+from typing import (
+    TYPE_CHECKING,
+    ClassVar,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Self,
+    Sequence,
+    Tuple,
+)
 
 import openai
+import orjson
 import requests
 import ulid
 from loguru import logger
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import BIT, HALFVEC, Vector
 from requests.exceptions import ChunkedEncodingError
 from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Column,
     ForeignKey,
     Index,
+    Integer,
     LargeBinary,
     MetaData,
-    Result,
+    Row,
+    Select,
+    Table,
+    UniqueConstraint,
+    and_,
+    cast,
+    delete,
     func,
     insert,
+    literal_column,
+    or_,
     select,
+    text,
+    true,
+    tuple_,
     update,
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
     Session,
+    load_only,
     mapped_column,
+    raiseload,
     relationship,
     sessionmaker,
 )
+from tqdm import tqdm
 from ulid import ULID
 from urllib3.exceptions import IncompleteRead, ProtocolError
 from urllib3.exceptions import TimeoutError as ConnectionTimeoutError
 
 from ..config import config
-from ..integrations.completions import get_summary
-from ..integrations.embeddings import get_embeddings
+from ..integrations.completions import aget_summary
+from ..integrations.embeddings import (
+    EMBEDDING_DIMENSIONS,
+    MAX_INPUTS_PER_REQUEST,
+    OPENAI_BASE_URL,
+    EmbeddingProvider,
+    RateLimiter,
+    aembed_texts,
+    aget_embeddings,
+    cache_stats,
+    embedding_lru,
+    embedding_provider,
+    get_embeddings,
+    listing_text,
+    text_hash,
+)
+from .singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from .vector_index import VectorIndex
+
+client = openai.OpenAI(api_key=config["OPENAI_API_KEY"], base_url=OPENAI_BASE_URL)
+# serialize the creation of identical searches across workers with a postgres advisory lock
+USE_ADVISORY_LOCK = config.get("SEARCH_ADVISORY_LOCK", "false").lower() in ("1", "true", "yes")
+# search-time settings of the listing ANN index, the server defaults are used when not set
+HNSW_EF_SEARCH = int(config["HNSW_EF_SEARCH"]) if config.get("HNSW_EF_SEARCH") else None
+IVFFLAT_PROBES = int(config["IVFFLAT_PROBES"]) if config.get("IVFFLAT_PROBES") else None
+# coarse search of the listings on binary quantized ("binary") or truncated (Matryoshka) embeddings, the candidates
+# are re-ranked with the full embeddings. Needs the matching index, see `scripts/create_index.py`
+LISTING_SEARCH_QUANTIZATION = config.get("LISTING_SEARCH_QUANTIZATION") or None
+LISTING_SEARCH_DIMENSIONS = (
+    int(config["LISTING_SEARCH_DIMENSIONS"]) if config.get("LISTING_SEARCH_DIMENSIONS") else None
+)
+LISTING_SEARCH_RERANK_FACTOR = int(config.get("LISTING_SEARCH_RERANK_FACTOR", 4))
+# keep scanning the index until `limit` rows pass the auction_end_time filter. "auto" enables it if the installed
+# pgvector has it (>= 0.8), without it a search returning fewer than `limit` rows is retried with a wider scan
+ANN_ITERATIVE_SCAN = config.get("ANN_ITERATIVE_SCAN", "auto").lower()
+# the largest hnsw.ef_search pgvector accepts
+MAX_HNSW_EF_SEARCH = 1000
+PGVECTOR_VERSION_QUERY = text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+
+
+def utcnow() -> dt.datetime:
+    """
+    The current time as naive UTC
 
-client = openai.OpenAI(api_key=config["OPENAI_API_KEY"])
+    The timestamp columns are `TIMESTAMP WITHOUT TIME ZONE` holding UTC, asyncpg refuses to bind aware datetimes to them.
+    """
+    return dt.datetime.now(dt.UTC).replace(tzinfo=None)
 
 
 class Base(DeclarativeBase):
-    created_at: Mapped[dt.datetime] = mapped_column(default=lambda: dt.datetime.now(dt.UTC))
-    updated_at: Mapped[dt.datetime] = mapped_column(
-        default=lambda: dt.datetime.now(dt.UTC),
-        onupdate=lambda: dt.datetime.now(dt.UTC),
-    )
+    created_at: Mapped[dt.datetime] = mapped_column(default=utcnow)
+    updated_at: Mapped[dt.datetime] = mapped_column(default=utcnow, onupdate=utcnow)
 
     # https://alembic.sqlalchemy.org/en/latest/naming.html#integration-of-naming-conventions-into-operations-autogenerate
     metadata = MetaData(
@@ -86,7 +165,7 @@ class Listing(Base):
     url: Mapped[str] = mapped_column(unique=True, index=True)
     link: Mapped[str] = mapped_column()
     auction_type: Mapped[Optional[str]] = mapped_column(nullable=True)
-    auction_end_time: Mapped[Optional[dt.datetime]] = mapped_column(nullable=True)
+    auction_end_time: Mapped[Optional[dt.datetime]] = mapped_column(nullable=True, index=True)
     price: Mapped[Optional[int]] = mapped_column(nullable=True)
     number_of_bids: Mapped[Optional[int]] = mapped_column(nullable=True)
     domain_age: Mapped[Optional[int]] = mapped_column(nullable=True)
@@ -94,8 +173,12 @@ class Listing(Base):
     valuation: Mapped[Optional[int]] = mapped_column(nullable=True)
     monthly_parking_revenue: Mapped[Optional[int]] = mapped_column(nullable=True)
     is_adult: Mapped[Optional[bool]] = mapped_column(nullable=True)
-    # when listing is created
-    embeddings: Mapped[Optional[List[float]]] = mapped_column(Vector(1536), nullable=True)
+    # name of the `DomainAdapter` the listing comes from
+    source: Mapped[Optional[str]] = mapped_column(nullable=True, index=True)
+    # hash of the `TRACKED_COLUMNS` as last received from the feed, unchanged listings are not rewritten
+    content_hash: Mapped[Optional[str]] = mapped_column(nullable=True)
+    # when listing is created, stored in half precision
+    embeddings: Mapped[Optional[List[float]]] = mapped_column(HALFVEC(EMBEDDING_DIMENSIONS), nullable=True)
     domain_searches: Mapped[List["DomainSearch"]] = relationship(
         "DomainSearch",
         secondary="listings_to_domain_searches_rel",
@@ -122,24 +205,167 @@ class Listing(Base):
 
         If the listing already exists, it will be updated with the new data
         If the listing does not exist, it will be inserted
-        For all the listings that are not in the dataset anymore, remove the embeddings
+        The existing listings are looked up per batch by url, so memory is bounded by the batch size
         """
-        tick = time.time()
         logger.info("Upserting listings from downloaded batch")
-        logger.info(f"Querying database for existing listings from {source}")
-        url_to_id = {
-            row.url: row.id for row in session.execute(select(cls.url, cls.id).where(cls.link.like(f"%{source}%")))
-        }
-        tack = time.time()
-        logger.info(f"Found {len(url_to_id)} listings in the database (took {tack - tick:.2f}s)")
         logger.info(f"Processing {source} data in batches...")
-        for i, url_item_batch in enumerate(batched(listings, batch_size)):
+        for i, url_item_batch in enumerate(batched(map(cls.with_content_hash, listings), batch_size)):
+            tick = time.time()
+            url_to_id, url_to_hash = {}, {}
+            for url_batch in batched({item["url"] for item in url_item_batch}, batch_size // 5):
+                rows = session.execute(select(cls.url, cls.id, cls.content_hash).where(cls.url.in_(url_batch)))
+                for url, listing_id, content_hash in rows:
+                    url_to_id[url] = listing_id
+                    url_to_hash[url] = content_hash
+            logger.info(f"Found {len(url_to_id)} existing listings in batch #{i + 1} (took {time.time() - tick:.2f}s)")
             listing_id_to_url = cls.process_items(
-                session, url_to_id, url_item_batch, batch_size=batch_size // 5, n_batch=i + 1
+                session,
+                url_to_id,
+                url_item_batch,
+                batch_size=batch_size // 5,
+                n_batch=i + 1,
+                db_url_to_hash=url_to_hash,
             )
             for listing_id, url in listing_id_to_url.items():
                 yield listing_id, url
 
+    # columns written by the feed adapters, and the ones refreshed for listings that already exist
+    COPY_COLUMNS = (
+        "url",
+        "link",
+        "auction_type",
+        "auction_end_time",
+        "price",
+        "number_of_bids",
+        "domain_age",
+        "pageviews",
+        "valuation",
+        "monthly_parking_revenue",
+        "is_adult",
+        "source",
+        "content_hash",
+    )
+    UPDATE_COLUMNS = ("auction_end_time", "price", "valuation", "number_of_bids", "source", "content_hash")
+    # the fields that change between feed updates, a listing is only rewritten when one of them changed
+    TRACKED_COLUMNS = ("price", "valuation", "number_of_bids", "auction_end_time")
+    # whether the searches use iterative index scans, looked up with the first search unless configured
+    iterative_scan: ClassVar[Optional[bool]] = (
+        None if ANN_ITERATIVE_SCAN == "auto" else ANN_ITERATIVE_SCAN in ("1", "true", "yes")
+    )
+    # the columns shown in a domain search result, the relationships and the embeddings raise when accessed
+    RESULT_COLUMNS = (
+        "url",
+        "link",
+        "auction_type",
+        "auction_end_time",
+        "price",
+        "number_of_bids",
+        "domain_age",
+        "pageviews",
+        "valuation",
+        "monthly_parking_revenue",
+        "is_adult",
+    )
+
+    @classmethod
+    def with_content_hash(cls, listing: dict) -> dict:
+        """Adds the hash of the tracked fields of the listing data to it"""
+        listing["content_hash"] = cls.content_hash_of(listing.get(column) for column in cls.TRACKED_COLUMNS)
+        return listing
+
+    @staticmethod
+    def content_hash_of(tracked_values: Iterable) -> str:
+        return hashlib.md5("|".join(map(str, tracked_values)).encode()).hexdigest()
+
+    @classmethod
+    def copy_upsert_batch(
+        cls, session: Session, listings: Iterator[dict], source: str, batch_size=100000
+    ) -> Iterable[tuple[int, str]]:
+        """
+        Bulk variant of `upsert_batch`
+
+        Each batch is streamed into a temporary staging table with `COPY FROM STDIN` and merged into the listings
+        with a single `INSERT ... ON CONFLICT (url) DO UPDATE`, which skips the listings whose content hash did not
+        change. Yields the ids and urls of the inserted listings. Requires a psycopg2 connection.
+        """
+        return cls._copy_upsert_rows(session, map(cls.copy_rows, batched(listings, batch_size)), source)
+
+    @classmethod
+    def copy_upsert_column_batches(
+        cls, session: Session, column_batches: Iterator[dict[str, list]], source: str
+    ) -> Iterable[tuple[int, str]]:
+        """
+        `copy_upsert_batch` for the column batches of `DomainAdapter.yield_listing_batches`
+
+        The rows are zipped from the columns straight into the COPY buffer.
+        """
+        return cls._copy_upsert_rows(session, map(cls.column_copy_rows, column_batches), source)
+
+    @classmethod
+    def copy_rows(cls, listings: Iterable[dict]) -> list[tuple]:
+        """The `COPY_COLUMNS` rows of the listings data, including the content hash"""
+        return [
+            tuple(listing.get(column) for column in cls.COPY_COLUMNS)
+            for listing in map(cls.with_content_hash, listings)
+        ]
+
+    @classmethod
+    def column_copy_rows(cls, columns: dict[str, list]) -> list[tuple]:
+        """`copy_rows` of a column batch, hashes the same as `with_content_hash`"""
+        n_rows = len(columns["url"])
+        # the tracked columns repeat a lot, each distinct value is converted to a string once
+        tracked_strings = []
+        for column in cls.TRACKED_COLUMNS:
+            value_to_string = {value: str(value) for value in set(columns[column])}
+            tracked_strings.append([value_to_string[value] for value in columns[column]])
+        columns["content_hash"] = [
+            hashlib.md5("|".join(tracked_values).encode()).hexdigest() for tracked_values in zip(*tracked_strings)
+        ]
+        return list(zip(*(columns.get(column) or [None] * n_rows for column in cls.COPY_COLUMNS)))
+
+    @classmethod
+    def _copy_upsert_rows(
+        cls, session: Session, row_batches: Iterator[list[tuple]], source: str
+    ) -> Iterable[tuple[int, str]]:
+        columns = ", ".join(cls.COPY_COLUMNS)
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in cls.UPDATE_COLUMNS + ("updated_at",))
+        upsert_query = (
+            f"INSERT INTO listings ({columns}, created_at, updated_at) "
+            f"SELECT DISTINCT ON (url) {columns}, now() AT TIME ZONE 'utc', now() AT TIME ZONE 'utc' "
+            f"FROM listings_staging ORDER BY url "
+            f"ON CONFLICT (url) DO UPDATE SET {updates} "
+            f"WHERE listings.content_hash IS DISTINCT FROM EXCLUDED.content_hash "
+            f"RETURNING id, url, (xmax = 0) AS inserted"
+        )
+        cursor = session.connection().connection.dbapi_connection.cursor()
+        try:
+            # left over on the pooled connection if an earlier run failed, dropping it in a `finally` would run in the
+            # failed transaction and hide the original error
+            cursor.execute("DROP TABLE IF EXISTS listings_staging")
+            cursor.execute(f"CREATE TEMP TABLE listings_staging AS SELECT {columns} FROM listings WITH NO DATA")
+            logger.info(f"Processing {source} data in batches...")
+            for i, row_batch in enumerate(row_batches):
+                tick = time.time()
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(row_batch)
+                buffer.seek(0)
+                cursor.copy_expert(f"COPY listings_staging ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+                cursor.execute(upsert_query)
+                written = cursor.fetchall()
+                new_listings = [(listing_id, url) for listing_id, url, inserted in written if inserted]
+                cursor.execute("TRUNCATE listings_staging")
+                DomainSearch.invalidate_results_of_listings(
+                    session, [listing_id for listing_id, _, inserted in written if not inserted]
+                )
+                logger.info(
+                    f"Upserted batch #{i + 1} ({len(row_batch)} listings, {len(new_listings)} new, "
+                    f"{len(written) - len(new_listings)} changed) in {time.time() - tick:.2f}s"
+                )
+                yield from new_listings
+            cursor.execute("DROP TABLE listings_staging")
+        finally:
+            cursor.close()
+
     @classmethod
     def process_items(
         cls,
@@ -148,31 +374,34 @@ class Listing(Base):
         url_items: Iterable[dict],
         batch_size: int,
         n_batch: int,
+        db_url_to_hash: Optional[dict[str, Optional[str]]] = None,
     ) -> dict[int, str]:
         url_to_data = {datum["url"]: datum for datum in url_items}
         listing_urls_in_batch = url_to_data.keys()
         listing_urls_to_be_updated = listing_urls_in_batch & db_url_to_id.keys()
         new_listing_urls = listing_urls_in_batch - db_url_to_id.keys()
+        if db_url_to_hash is not None:
+            # only rewrite the listings whose tracked fields changed
+            listing_urls_to_be_updated = {
+                url
+                for url in listing_urls_to_be_updated
+                if url_to_data[url].get("content_hash") != db_url_to_hash.get(url)
+            }
 
-        fnames_for_update = [
-            "auction_end_time",
-            "price",
-            "valuation",
-            "number_of_bids",
-        ]
-        logger.info(f"Updating existing listings in batch #{n_batch}")
+        logger.info(f"Updating {len(listing_urls_to_be_updated)} changed listings in batch #{n_batch}")
         for url_batch in batched(listing_urls_to_be_updated, batch_size):
             session.execute(
                 update(cls),
                 [
                     {
                         "id": db_url_to_id[url],
-                        **{fname: url_to_data[url].get(fname) for fname in fnames_for_update},
+                        **{fname: url_to_data[url].get(fname) for fname in cls.UPDATE_COLUMNS},
                     }
                     for url in url_batch
                 ],
             )
             session.flush()
+            DomainSearch.invalidate_results_of_listings(session, [db_url_to_id[url] for url in url_batch])
 
         result_listing_id_to_url = {}
         if new_listing_urls:
@@ -189,32 +418,445 @@ class Listing(Base):
 
     @classmethod
     def get_by_embeddings(
-        cls, session: Session, embeddings: List[float], limit: int = 100
-    ) -> Result[Tuple[Self, float]]:
-        now = dt.datetime.now(dt.UTC)
-        query = (
-            select(cls, cls.embeddings.cosine_distance(embeddings).label("score"))
-            .where(cls.auction_end_time > now)
-            .order_by(cls.embeddings.cosine_distance(embeddings))
-            .limit(limit)
+        cls,
+        session: Session,
+        embeddings: List[float],
+        limit: int = 100,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+        quantization: Optional[str] = LISTING_SEARCH_QUANTIZATION,
+        dimensions: Optional[int] = LISTING_SEARCH_DIMENSIONS,
+    ) -> Sequence[Row[Tuple[Self, float]]]:
+        query, n_candidates = cls._by_embeddings_query(embeddings, limit, quantization, dimensions)
+        with cls.index_settings(session, n_candidates, ef_search, probes):
+            rows = session.execute(query).all()
+        if len(rows) < limit and not cls.iterative_scan:
+            # the expired listings among the nearest neighbours of the index scan were filtered out
+            with cls.index_settings(session, n_candidates, MAX_HNSW_EF_SEARCH, cls._wide_probes(probes)):
+                rows = session.execute(query).all()
+        return rows
+
+    @classmethod
+    async def aget_by_embeddings(
+        cls,
+        session: AsyncSession,
+        embeddings: List[float],
+        limit: int = 100,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+        quantization: Optional[str] = LISTING_SEARCH_QUANTIZATION,
+        dimensions: Optional[int] = LISTING_SEARCH_DIMENSIONS,
+    ) -> Sequence[Row[Tuple[Self, float]]]:
+        query, n_candidates = cls._by_embeddings_query(embeddings, limit, quantization, dimensions)
+        async with cls.aindex_settings(session, n_candidates, ef_search, probes):
+            rows = (await session.execute(query)).all()
+        if len(rows) < limit and not cls.iterative_scan:
+            async with cls.aindex_settings(session, n_candidates, MAX_HNSW_EF_SEARCH, cls._wide_probes(probes)):
+                rows = (await session.execute(query)).all()
+        return rows
+
+    @classmethod
+    def _by_embeddings_query(
+        cls, embeddings: List[float], limit: int, quantization: Optional[str], dimensions: Optional[int]
+    ) -> tuple[Select[Tuple[Self, float]], int]:
+        """
+        Returns the query for the `limit` nearest active listings and the number of rows fetched from the ANN index
+
+        With `quantization` or `dimensions`, the index is scanned for `LISTING_SEARCH_RERANK_FACTOR * limit`
+        candidates on the quantized/truncated embeddings, which are then re-ranked by their exact distance.
+        """
+        now = utcnow()
+        distance = cls.embeddings.cosine_distance(embeddings)
+        if quantization is None and dimensions is None:
+            query = (
+                select(cls, distance.label("score"))
+                .where(cls.auction_end_time > now, cls.embeddings.is_not(None))
+                .order_by(distance)
+                .limit(limit)
+            )
+            return query, limit
+
+        n_candidates = limit * LISTING_SEARCH_RERANK_FACTOR
+        candidates = (
+            select(cls.id)
+            .where(cls.auction_end_time > now, cls.embeddings.is_not(None))
+            .order_by(cls.coarse_distance(embeddings, quantization, dimensions))
+            .limit(n_candidates)
+        )
+        query = select(cls, distance.label("score")).where(cls.id.in_(candidates)).order_by(distance).limit(limit)
+        return query, n_candidates
+
+    @classmethod
+    def coarse_distance(cls, embeddings: List[float], quantization: Optional[str], dimensions: Optional[int]):
+        """
+        Distance on the binary quantized or the truncated and re-normalized (Matryoshka) embeddings
+
+        The expressions match the expression indexes of `scripts/create_index.py` (the sizes are rendered as
+        literals, so that the planner can use the index with server side parameters as well)
+        """
+        if quantization == "binary":
+            bits = BIT(EMBEDDING_DIMENSIONS)
+            return cast(func.binary_quantize(cls.embeddings), bits).hamming_distance(
+                cast(func.binary_quantize(cast(embeddings, HALFVEC(EMBEDDING_DIMENSIONS))), bits)
+            )
+        elif quantization is not None:
+            raise ValueError(f"Unknown quantization '{quantization}'")
+
+        truncated = embeddings[:dimensions]
+        norm = sum(value * value for value in truncated) ** 0.5 or 1.0
+        return cast(
+            func.l2_normalize(func.subvector(cls.embeddings, literal_column("1"), literal_column(str(dimensions)))),
+            HALFVEC(dimensions),
+        ).cosine_distance([value / norm for value in truncated])
+
+    @staticmethod
+    def _wide_probes(probes: Optional[int]) -> int:
+        # ivfflat.probes defaults to 1 on the server
+        return 4 * (probes or IVFFLAT_PROBES or 1)
+
+    @classmethod
+    def _set_iterative_scan(cls, pgvector_version: Optional[str]):
+        cls.iterative_scan = pgvector_version is not None and tuple(
+            int(part) for part in pgvector_version.split(".")[:2]
+        ) >= (0, 8)
+        logger.info(f"pgvector {pgvector_version}, iterative index scans {'on' if cls.iterative_scan else 'off'}")
+
+    @classmethod
+    def _index_settings(cls, limit: int, ef_search: Optional[int], probes: Optional[int]) -> dict[str, int | str]:
+        # hnsw returns at most ef_search rows, so it has to be at least the limit
+        settings: dict[str, int | str] = {"hnsw.ef_search": max(limit, ef_search or HNSW_EF_SEARCH or 0)}
+        if probes := probes or IVFFLAT_PROBES:
+            settings["ivfflat.probes"] = probes
+        if cls.iterative_scan:
+            # expired listings are filtered after the index scan, without iterative scans fewer rows than `limit`
+            # would be returned once the nearest neighbours include expired listings
+            settings["hnsw.iterative_scan"] = "strict_order"
+            settings["ivfflat.iterative_scan"] = "relaxed_order"
+        return settings
+
+    @classmethod
+    @contextmanager
+    def index_settings(
+        cls, session: Session, limit: int, ef_search: Optional[int] = None, probes: Optional[int] = None
+    ) -> Iterator[None]:
+        """
+        Applies `ef_search` (hnsw) and `probes` (ivfflat) to the queries run inside the block
+
+        The engine runs in autocommit mode, so `SET LOCAL` would not outlive the statement; the settings are set on
+        the connection and reset afterwards.
+        """
+        if cls.iterative_scan is None:
+            cls._set_iterative_scan(session.scalar(PGVECTOR_VERSION_QUERY))
+        settings = cls._index_settings(limit, ef_search, probes)
+        for name, value in settings.items():
+            session.execute(text(f"SET {name} = {value}"))
+        try:
+            yield
+        finally:
+            for name in settings:
+                session.execute(text(f"RESET {name}"))
+
+    @classmethod
+    @asynccontextmanager
+    async def aindex_settings(
+        cls, session: AsyncSession, limit: int, ef_search: Optional[int] = None, probes: Optional[int] = None
+    ):
+        if cls.iterative_scan is None:
+            cls._set_iterative_scan(await session.scalar(PGVECTOR_VERSION_QUERY))
+        settings = cls._index_settings(limit, ef_search, probes)
+        for name, value in settings.items():
+            await session.execute(text(f"SET {name} = {value}"))
+        try:
+            yield
+        finally:
+            for name in settings:
+                await session.execute(text(f"RESET {name}"))
+
+    @classmethod
+    def result_load_options(cls) -> tuple:
+        return (load_only(*(getattr(cls, column) for column in cls.RESULT_COLUMNS), raiseload=True), raiseload("*"))
+
+    @classmethod
+    def get_by_ids(cls, session: Session, listing_ids: Sequence[int]) -> list[Self]:
+        """
+        Returns the listings in the order of the given ids, skipping the ones that do not exist (anymore)
+
+        Only the columns of the results and emails are loaded, accessing anything else raises instead of lazy loading.
+        """
+        id_to_listing = {
+            listing.id: listing
+            for listing in session.scalars(
+                select(cls).where(cls.id.in_(listing_ids)).options(*cls.result_load_options())
+            )
+        }
+        return [id_to_listing[listing_id] for listing_id in listing_ids if listing_id in id_to_listing]
+
+    @classmethod
+    def delete_expired(cls, session: Session, batch_size: int = 10000) -> int:
+        """
+        Deletes the listings whose auction ended in batches
+
+        Short deletes keep the locks and the WAL of each statement small, compared to one DELETE over all expired rows
+        """
+        now = utcnow()
+        DomainSearch.invalidate_results(
+            session,
+            DomainSearch.id.in_(
+                select(ListingDomainSearch.domain_search_id)
+                .join(cls, cls.id == ListingDomainSearch.listing_id)
+                .where(cls.auction_end_time < now)
+            ),
         )
-        return session.execute(query)
+        n_deleted = 0
+        while True:
+            expired_ids = select(cls.id).where(cls.auction_end_time < now).limit(batch_size)
+            n_batch = session.execute(delete(cls).where(cls.id.in_(expired_ids))).rowcount
+            n_deleted += n_batch
+            if n_batch < batch_size:
+                logger.info(f"Deleted {n_deleted} expired listings")
+                return n_deleted
 
     @classmethod
     def get_active_listings_count(cls, session: Session):
-        now = dt.datetime.now(dt.UTC)
+        now = utcnow()
         # pylint: disable=not-callable
         count_query = select(func.count()).select_from(cls).where(cls.auction_end_time > now)
         row_count = session.execute(count_query).scalar()
         return row_count
 
+    @classmethod
+    def _unsubmitted_query(cls, *columns):
+        """The active listings that neither have embeddings nor are part of a batch request"""
+        now = utcnow()
+        return select(*columns).where(
+            cls.embeddings.is_(None), cls.batch_request_id.is_(None), cls.auction_end_time > now
+        )
+
+    @classmethod
+    def get_unsubmitted(cls, session: Session, limit: int) -> list[tuple[int, str]]:
+        return session.execute(cls._unsubmitted_query(cls.id, cls.url).order_by(cls.id).limit(limit)).tuples().all()
+
+    @classmethod
+    def get_unsubmitted_count(cls, session: Session) -> int:
+        # pylint: disable=not-callable
+        return session.execute(cls._unsubmitted_query(func.count()).select_from(cls)).scalar()
+
+    @classmethod
+    def embedding_freshness(cls, session: Session, *criteria) -> Optional[dict[str, float]]:
+        """
+        Seconds from the insert of the listings matching `criteria` until now (the time their embeddings are written)
+
+        Returns the median, the 95th percentile and the maximum, None when no listing matches.
+        """
+        age = func.extract("epoch", func.timezone("utc", func.now()) - cls.created_at)
+        p50, p95, maximum = session.execute(
+            select(
+                func.percentile_cont(0.5).within_group(age),
+                func.percentile_cont(0.95).within_group(age),
+                func.max(age),
+            ).where(*criteria)
+        ).one()
+        if maximum is None:
+            return None
+        return {"p50": float(p50), "p95": float(p95), "max": float(maximum)}
+
+    @classmethod
+    def embed_online(
+        cls,
+        session_factory: sessionmaker,
+        listing_id_to_url: Iterable[tuple[int, str]],
+        batch_size: int = MAX_INPUTS_PER_REQUEST,
+        concurrency: int = 8,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> int:
+        """
+        Embeds the listings with the embeddings endpoint instead of a 24h batch request, returns their number
+
+        The listings are read from `listing_id_to_url` (e.g. the running upsert) in micro-batches of `batch_size`,
+        up to `concurrency` requests are in flight, limited by the RPM/TPM of `rate_limiter`. The embeddings of each
+        micro-batch are written in their own session.
+        """
+        return asyncio.run(cls.aembed_online(session_factory, listing_id_to_url, batch_size, concurrency, rate_limiter))
+
+    @classmethod
+    async def aembed_online(
+        cls,
+        session_factory: sessionmaker,
+        listing_id_to_url: Iterable[tuple[int, str]],
+        batch_size: int = MAX_INPUTS_PER_REQUEST,
+        concurrency: int = 8,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> int:
+        rate_limiter = rate_limiter or RateLimiter()
+        # retries are done by `aembed_texts`, a client per event loop like `acreate_batch_requests`
+        async with openai.AsyncOpenAI(
+            api_key=config["OPENAI_API_KEY"], base_url=OPENAI_BASE_URL, max_retries=0
+        ) as aclient:
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def embed(n_batch: int, listing_batch: tuple[tuple[int, str], ...]) -> int:
+                try:
+                    texts = [listing_text(url) for _, url in listing_batch]
+                    embeddings = await aembed_texts(aclient, texts, rate_limiter)
+                    freshness = await asyncio.to_thread(
+                        cls._write_embeddings,
+                        session_factory,
+                        [
+                            (listing_id, listing_embeddings)
+                            for (listing_id, _), listing_embeddings in zip(listing_batch, embeddings)
+                        ],
+                    )
+                    logger.info(
+                        f"Embedded micro-batch #{n_batch} ({len(listing_batch)} listings), freshness "
+                        + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in (freshness or {}).items())
+                    )
+                    return len(listing_batch)
+                finally:
+                    semaphore.release()
+
+            tasks, submitted_batches = [], []
+            listing_batches = batched(listing_id_to_url, batch_size)
+            while True:
+                await semaphore.acquire()
+                if (listing_batch := await asyncio.to_thread(next, listing_batches, None)) is None:
+                    semaphore.release()
+                    break
+                submitted_batches.append(listing_batch)
+                tasks.append(asyncio.create_task(embed(len(tasks) + 1, listing_batch)))
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        failed_batches = [
+            listing_batch
+            for listing_batch, result in zip(submitted_batches, results)
+            if isinstance(result, BaseException)
+        ]
+        if failed_batches:
+            # nothing else picks up listings without embeddings, they are embedded by a batch request instead
+            logger.error(
+                f"{len(failed_batches)} of {len(results)} embedding micro-batches failed, falling back to batch"
+            )
+            with session_factory.begin() as session:
+                OpenAIEmbeddingBatchRequest.create_batch_requests(session, itertools.chain(*failed_batches))
+        return sum(result for result in results if not isinstance(result, BaseException))
 
+    @classmethod
+    def embed_local(
+        cls,
+        session_factory: sessionmaker,
+        listing_id_to_url: Iterable[tuple[int, str]],
+        provider: EmbeddingProvider = embedding_provider,
+        batch_size: int = 10000,
+    ) -> int:
+        """
+        Embeds the listings with a local `provider` (see `LocalEmbeddingProvider`), returns their number
+
+        The provider spreads each batch across its processes, the embeddings are written like in `embed_online`.
+        """
+        n_listings = 0
+        for i, listing_batch in enumerate(batched(listing_id_to_url, batch_size)):
+            tick = time.time()
+            embeddings = provider.embed([listing_text(url) for _, url in listing_batch])
+            freshness = cls._write_embeddings(
+                session_factory,
+                [
+                    (listing_id, listing_embeddings)
+                    for (listing_id, _), listing_embeddings in zip(listing_batch, embeddings)
+                ],
+            )
+            n_listings += len(listing_batch)
+            logger.info(
+                f"Embedded batch #{i + 1} ({len(listing_batch)} listings) with {provider.model} in "
+                f"{time.time() - tick:.2f}s, freshness "
+                + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in (freshness or {}).items())
+            )
+        return n_listings
+
+    @classmethod
+    def copy_embeddings(cls, session: Session, listing_embeddings: Sequence[tuple[int, str]]):
+        """
+        Writes embeddings given in pgvector's text format ('[0.1,-0.2,...]') into the listings
+
+        The rows are streamed into a temporary staging table with `COPY FROM STDIN` and applied with a single
+        `UPDATE ... FROM`, listings deleted in the meantime are skipped. Requires a psycopg2 connection.
+        """
+        cursor = session.connection().connection.dbapi_connection.cursor()
+        try:
+            # left over on the pooled connection if an earlier write failed, see `_copy_upsert_rows`
+            cursor.execute("DROP TABLE IF EXISTS embeddings_staging")
+            cursor.execute(
+                "CREATE TEMP TABLE embeddings_staging "
+                f"(id integer NOT NULL, embeddings halfvec({EMBEDDING_DIMENSIONS}) NOT NULL)"
+            )
+            buffer = io.StringIO(
+                "".join(f"{listing_id}\t{embeddings}\n" for listing_id, embeddings in listing_embeddings)
+            )
+            cursor.copy_expert("COPY embeddings_staging (id, embeddings) FROM STDIN", buffer)
+            cursor.execute(
+                "UPDATE listings SET embeddings = embeddings_staging.embeddings "
+                "FROM embeddings_staging WHERE listings.id = embeddings_staging.id"
+            )
+            cursor.execute("DROP TABLE embeddings_staging")
+        finally:
+            cursor.close()
+
+    @classmethod
+    def stage_new_listings(
+        cls, session: Session, batch_request_ids: Sequence[int] = (), listing_ids: Sequence[int] = ()
+    ) -> int:
+        """
+        Collects the ids of the listings to merge into the domain searches in the temporary table
+        `new_listings_staging`, returns their number
+
+        The listings of `batch_request_ids` and `listing_ids` (embedded online or locally) are staged once per ranking
+        run, so the id lists are not sent with every chunk of searches. The table lives on the connection of
+        `session`, `DomainSearch.merge_new_listings` has to run on the same one. Requires a psycopg2 connection.
+        """
+        cursor = session.connection().connection.dbapi_connection.cursor()
+        try:
+            # left over on the pooled connection if an earlier run failed, see `_copy_upsert_rows`
+            cursor.execute("DROP TABLE IF EXISTS new_listings_staging")
+            cursor.execute("CREATE TEMP TABLE new_listings_staging (id integer PRIMARY KEY)")
+            if listing_ids:
+                buffer = io.StringIO("".join(f"{listing_id}\n" for listing_id in listing_ids))
+                cursor.copy_expert("COPY new_listings_staging (id) FROM STDIN", buffer)
+            if batch_request_ids:
+                cursor.execute(
+                    "INSERT INTO new_listings_staging SELECT id FROM listings WHERE batch_request_id = ANY(%s) "
+                    "ON CONFLICT DO NOTHING",
+                    (list(batch_request_ids),),
+                )
+            cursor.execute("ANALYZE new_listings_staging")
+            cursor.execute("SELECT count(*) FROM new_listings_staging")
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    @classmethod
+    def _write_embeddings(
+        cls, session_factory: sessionmaker, listing_embeddings: Sequence[tuple[int, List[float]]]
+    ) -> Optional[dict[str, float]]:
+        with session_factory.begin() as session:
+            session.execute(
+                update(cls),
+                [{"id": listing_id, "embeddings": embeddings} for listing_id, embeddings in listing_embeddings],
+            )
+            return cls.embedding_freshness(session, cls.id.in_([listing_id for listing_id, _ in listing_embeddings]))
+
+
+# the temporary table of `Listing.stage_new_listings`
+NEW_LISTINGS_STAGING = Table("new_listings_staging", MetaData(), Column("id", Integer, primary_key=True))
+
+LISTING_INDEX_NAME = "listings_embeddings_index"
+
+# rebuild with `scripts/create_index.py`, which also swaps the index without downtime
 ListingIndex = Index(
-    "ivfflat_index",
+    LISTING_INDEX_NAME,
     Listing.embeddings,
-    postgresql_using="ivfflat",
-    postgresql_with={"lists": 1000},
-    postgresql_ops={"embeddings": "vector_cosine_ops"},
+    postgresql_using="hnsw",
+    postgresql_with={"m": 16, "ef_construction": 64},
+    postgresql_ops={"embeddings": "halfvec_cosine_ops"},
+    # only listings with embeddings can be ranked
+    postgresql_where=Listing.embeddings.is_not(None),
 )
 
 
@@ -231,7 +873,7 @@ class DomainSearch(Base):
     is_unlocked: Mapped[bool] = mapped_column(default=False)
     is_example: Mapped[bool] = mapped_column(default=False)
     summary: Mapped[Optional[str]] = mapped_column(nullable=True)
-    embeddings: Mapped[Optional[List[float]]] = mapped_column(Vector(1536), nullable=True)
+    embeddings: Mapped[Optional[List[float]]] = mapped_column(Vector(EMBEDDING_DIMENSIONS), nullable=True)
     listings: Mapped[List["Listing"]] = relationship(
         "Listing",
         secondary="listings_to_domain_searches_rel",
@@ -243,56 +885,262 @@ class DomainSearch(Base):
     )
     name: Mapped[Optional[str]] = mapped_column(nullable=True)
     email: Mapped[Optional[str]] = mapped_column(nullable=True)
+    # `get_result` serialized to JSON and its ETag, dropped whenever the result changes
+    result_json: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    result_etag: Mapped[Optional[str]] = mapped_column(nullable=True)
+    # incremented by every invalidation, a result computed before one is not stored
+    result_version: Mapped[int] = mapped_column(default=0, server_default="0")
 
     @classmethod
     def get_by_uuid(cls, session: Session, uuid: str) -> Optional["DomainSearch"]:
         uuid_bytes = bytes.fromhex(uuid.replace("-", ""))
         return session.scalar(select(cls).where(cls.ulid == uuid_bytes))
 
+    @classmethod
+    async def aget_by_uuid(cls, session: AsyncSession, uuid: str) -> Optional["DomainSearch"]:
+        uuid_bytes = bytes.fromhex(uuid.replace("-", ""))
+        return await session.scalar(select(cls).where(cls.ulid == uuid_bytes))
+
     @classmethod
     def get_examples(cls, session: Session, limit=4) -> Sequence["DomainSearch"]:
         examples = session.scalars(select(cls).where(cls.is_example).limit(limit)).all()
         return examples
 
     @classmethod
-    def create_or_get(cls, session: Session, prompt: str) -> "DomainSearch":
+    async def aget_examples(cls, session: AsyncSession, limit=4) -> Sequence["DomainSearch"]:
+        examples = (await session.scalars(select(cls).where(cls.is_example).limit(limit))).all()
+        return examples
+
+    @classmethod
+    async def acreate_or_get(
+        cls,
+        session_factory: async_sessionmaker,
+        prompt: str,
+        defer_summary: bool = False,
+        vector_index: Optional["VectorIndex"] = None,
+    ) -> "DomainSearch":
+        """
+        Returns the domain search of `prompt`, created and ranked if it does not exist yet
+
+        The embeddings and the summary are requested concurrently and the transaction is only opened once both
+        returned. With `defer_summary`, only the embeddings are awaited and the summary is left empty, to be filled
+        in later with `afill_summary`.
+        Concurrent calls for the same prompt share a single computation (see `SingleFlight`).
+        The listings are ranked with `vector_index`, or with `Listing.get_by_embeddings` if none is given.
+        """
         prompt = prompt.strip()
         prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
-        domain_search = session.scalar(select(cls).where(cls.prompt_hash == prompt_hash))
-        if domain_search is None:
-            embeddings = get_embeddings(prompt)
-            summary = get_summary(prompt)
-            domain_search = cls(prompt=prompt, prompt_hash=prompt_hash, embeddings=embeddings, summary=summary)
-            session.add(domain_search)
-            domain_search.update_listings(session)
+        async with session_factory() as session:
+            domain_search = await session.scalar(select(cls).where(cls.prompt_hash == prompt_hash))
+        if domain_search is not None:
+            return domain_search
+
+        return await _create_flight.do(
+            prompt_hash, lambda: cls._acreate(session_factory, prompt, prompt_hash, defer_summary, vector_index)
+        )
+
+    @classmethod
+    async def _acreate(
+        cls,
+        session_factory: async_sessionmaker,
+        prompt: str,
+        prompt_hash: str,
+        defer_summary: bool,
+        vector_index: Optional["VectorIndex"],
+    ) -> "DomainSearch":
+        if not USE_ADVISORY_LOCK:
+            return await cls._acreate_unlocked(session_factory, prompt, prompt_hash, defer_summary, vector_index)
+        # the lock belongs to the connection, which is therefore held until the search is created
+        async with session_factory() as lock_session:
+            await lock_session.execute(select(func.pg_advisory_lock(func.hashtext(prompt_hash))))
+            try:
+                return await cls._acreate_unlocked(session_factory, prompt, prompt_hash, defer_summary, vector_index)
+            finally:
+                await lock_session.execute(select(func.pg_advisory_unlock(func.hashtext(prompt_hash))))
+
+    @classmethod
+    async def _acreate_unlocked(
+        cls,
+        session_factory: async_sessionmaker,
+        prompt: str,
+        prompt_hash: str,
+        defer_summary: bool,
+        vector_index: Optional["VectorIndex"],
+    ) -> "DomainSearch":
+        # another worker might have created the search while we were waiting for the lock
+        async with session_factory() as session:
+            domain_search = await session.scalar(select(cls).where(cls.prompt_hash == prompt_hash))
+        if domain_search is not None:
+            return domain_search
+
+        # no connection is held during the remote calls
+        if defer_summary:
+            embeddings, summary = await EmbeddingCache.aget_or_compute(session_factory, prompt), None
+        else:
+            embeddings, summary = await asyncio.gather(
+                EmbeddingCache.aget_or_compute(session_factory, prompt), aget_summary(prompt)
+            )
+
+        async with session_factory() as session:
+            if vector_index is None:
+                listing_scores = [
+                    (listing.id, score) for listing, score in await Listing.aget_by_embeddings(session, embeddings)
+                ]
+            else:
+                listing_scores = await vector_index.asearch(session, embeddings)
+
+        try:
+            async with session_factory.begin() as session:
+                # a real transaction, in autocommit mode a concurrent request could see the search without its
+                # rankings and cache the empty result
+                await session.connection(execution_options={"isolation_level": "READ COMMITTED"})
+                domain_search = cls(prompt=prompt, prompt_hash=prompt_hash, embeddings=embeddings, summary=summary)
+                session.add(domain_search)
+                await session.flush()
+                for listing_id, score in listing_scores:
+                    session.add(
+                        ListingDomainSearch(listing_id=listing_id, domain_search_id=domain_search.id, score=score)
+                    )
+        except IntegrityError:
+            logger.info(f"Search {prompt_hash} was created concurrently, using the existing one")
+            async with session_factory() as session:
+                domain_search = await session.scalar(select(cls).where(cls.prompt_hash == prompt_hash))
         return domain_search
 
-    def update_listings(self, session: Session, limit=100) -> Optional[Sequence["Listing"]]:
-        """Update the listings and return the ids of the listings that were updated"""
-        if self.embeddings is None:
-            self.embeddings = get_embeddings(self.prompt)
-        existing_listings_domains_searches = self.listing_domain_searches
-        existing_listing_ids = {lds.listing_id: lds for lds in existing_listings_domains_searches}
-        listing_to_score = {
-            listing.id: score for (listing, score) in Listing.get_by_embeddings(session, self.embeddings, limit)
+    @classmethod
+    async def afill_summary(cls, session_factory: async_sessionmaker, domain_search_id: int, prompt: str):
+        summary = await aget_summary(prompt)
+        async with session_factory.begin() as session:
+            await session.execute(
+                cls._invalidate_results_query(cls.id == domain_search_id).values(summary=summary, updated_at=utcnow())
+            )
+
+    @classmethod
+    def bulk_update_listings(
+        cls, session: Session, domain_search_ids: Sequence[int], limit: int = 100
+    ) -> dict[int, list[int]]:
+        """
+        Ranks the listings of many domain searches at once
+
+        The top listings of all searches are selected in a single LATERAL query and the difference to the stored
+        ranking is applied with one bulk insert and one bulk delete.
+        Returns the ids of the newly ranked listings per domain search id, best score first.
+        """
+        for domain_search in session.scalars(
+            select(cls).where(cls.id.in_(domain_search_ids), cls.embeddings.is_(None))
+        ):
+            domain_search.embeddings = EmbeddingCache.get_or_compute(session, domain_search.prompt)
+        session.flush()
+
+        now = utcnow()
+        distance = Listing.embeddings.cosine_distance(cast(cls.embeddings, HALFVEC(EMBEDDING_DIMENSIONS)))
+        top_listings = (
+            select(Listing.id.label("listing_id"), distance.label("score"))
+            .where(Listing.auction_end_time > now, Listing.embeddings.is_not(None))
+            .order_by(distance)
+            .limit(limit)
+            .lateral("top_listings")
+        )
+        with Listing.index_settings(session, limit):
+            ranked = session.execute(
+                select(cls.id, top_listings.c.listing_id, top_listings.c.score)
+                .join(top_listings, true())
+                .where(cls.id.in_(domain_search_ids))
+            ).all()
+        ranked_scores = {(domain_search_id, listing_id): score for domain_search_id, listing_id, score in ranked}
+        existing = set(
+            session.execute(
+                select(ListingDomainSearch.domain_search_id, ListingDomainSearch.listing_id).where(
+                    ListingDomainSearch.domain_search_id.in_(domain_search_ids)
+                )
+            ).tuples()
+        )
+        return ListingDomainSearch.apply_diff(session, ranked_scores, existing)
+
+    @classmethod
+    def merge_new_listings(
+        cls, session: Session, domain_search_ids: Sequence[int], limit: int = 100
+    ) -> dict[int, list[int]]:
+        """
+        Incremental variant of `bulk_update_listings` over the listings of `Listing.stage_new_listings`
+
+        The staged listings are scored exactly against each search, their vectors are materialized first so the
+        filter is not applied after an approximate index scan. A new listing enters the ranking of a search only when
+        it beats the worst stored score, so the ranking stays the exact top of all listings, only shorter than `limit`
+        once ranked listings expired. Searches with fewer than `limit // 2` ranked listings are refreshed in full.
+        Returns the ids of the newly ranked listings per domain search id, like `bulk_update_listings`.
+        """
+        now = utcnow()
+        existing = set()
+        domain_search_to_scores: dict[int, dict[int, float]] = {
+            domain_search_id: {} for domain_search_id in domain_search_ids
         }
-        updated_listing_ids = listing_to_score.keys() - existing_listing_ids.keys()
-        to_remove_listing_ids = existing_listing_ids.keys() - listing_to_score.keys()
-
-        for listing_id in updated_listing_ids:
-            score = listing_to_score[listing_id]
-            listing_domain_search = ListingDomainSearch(listing_id=listing_id, domain_search=self, score=score)
-            session.add(listing_domain_search)
-
-        for listing_id in to_remove_listing_ids:
-            session.delete(existing_listing_ids[listing_id])
-
-        if updated_listing_ids:
-            return sorted(
-                (listing for listing_id in updated_listing_ids if (listing := session.get(Listing, listing_id))),
-                key=lambda listing: listing_to_score[listing.id],
-                reverse=True,
+        for domain_search_id, listing_id, score, is_active in session.execute(
+            select(
+                ListingDomainSearch.domain_search_id,
+                ListingDomainSearch.listing_id,
+                ListingDomainSearch.score,
+                Listing.auction_end_time > now,
+            )
+            .join(Listing, Listing.id == ListingDomainSearch.listing_id)
+            .where(ListingDomainSearch.domain_search_id.in_(domain_search_ids))
+        ):
+            existing.add((domain_search_id, listing_id))
+            if is_active:
+                domain_search_to_scores[domain_search_id][listing_id] = score
+
+        # the ranking only shrinks between full refreshes, below half of `limit` the searches are refilled
+        depleted_domain_search_ids = [
+            domain_search_id
+            for domain_search_id, listing_to_score in domain_search_to_scores.items()
+            if len(listing_to_score) < max(limit // 2, 1)
+        ]
+        for domain_search_id in depleted_domain_search_ids:
+            del domain_search_to_scores[domain_search_id]
+
+        new_listing_ids: dict[int, list[int]] = {}
+        if domain_search_to_scores:
+            staged_listings = (
+                select(Listing.id, Listing.embeddings)
+                .join(NEW_LISTINGS_STAGING, NEW_LISTINGS_STAGING.c.id == Listing.id)
+                .where(Listing.embeddings.is_not(None), Listing.auction_end_time > now)
+                .cte("staged_listings")
+                .prefix_with("MATERIALIZED")
             )
+            distance = staged_listings.c.embeddings.cosine_distance(cast(cls.embeddings, HALFVEC(EMBEDDING_DIMENSIONS)))
+            new_listings = (
+                select(staged_listings.c.id.label("listing_id"), distance.label("score"))
+                .order_by(distance)
+                .limit(limit)
+                .lateral("new_listings")
+            )
+            candidates = session.execute(
+                select(cls.id, new_listings.c.listing_id, new_listings.c.score)
+                .join(new_listings, true())
+                .where(cls.id.in_(domain_search_to_scores.keys()), cls.embeddings.is_not(None))
+            ).all()
+            for domain_search_id, listing_id, score in candidates:
+                listing_to_score = domain_search_to_scores[domain_search_id]
+                if listing_id not in listing_to_score and score < max(listing_to_score.values()):
+                    listing_to_score[listing_id] = score
+                    if len(listing_to_score) > limit:
+                        del listing_to_score[max(listing_to_score, key=listing_to_score.__getitem__)]
+
+            ranked_scores = {
+                (domain_search_id, listing_id): score
+                for domain_search_id, listing_to_score in domain_search_to_scores.items()
+                for listing_id, score in listing_to_score.items()
+            }
+            new_listing_ids = ListingDomainSearch.apply_diff(
+                session,
+                ranked_scores,
+                {pair for pair in existing if pair[0] in domain_search_to_scores},
+            )
+
+        if depleted_domain_search_ids:
+            logger.info(f"Falling back to a full refresh for {len(depleted_domain_search_ids)} domain searches")
+            new_listing_ids.update(cls.bulk_update_listings(session, depleted_domain_search_ids, limit))
+        return new_listing_ids
 
     @classmethod
     def create(cls, session: Session, prompt: str) -> "DomainSearch":
@@ -305,16 +1153,108 @@ class DomainSearch(Base):
     def uuid(self) -> str:
         return str(ULID(self.ulid).to_uuid())
 
-    def get_result(self):
-        """Helper function to get the result of a domain search including the skeletons if the request is not unlocked"""
-        offset = 0 if self.is_unlocked else 5
-        listing_id_to_score = {
-            listing_domain_search.listing.id: listing_domain_search.score
-            for listing_domain_search in self.listing_domain_searches
-        }
-        sorted_domain_listings = sorted(
-            self.listings, key=lambda listing: listing_id_to_score[listing.id], reverse=True
+    def unlock(self):
+        self.is_unlocked = True
+        self._invalidate_result()
+
+    def _invalidate_result(self):
+        self.result_json = self.result_etag = None
+        self.result_version = type(self).result_version + 1
+
+    @classmethod
+    def _invalidate_results_query(cls, *criteria):
+        return (
+            update(cls)
+            .where(*criteria)
+            # the cache is not content of the search, updated_at is kept
+            .values(
+                result_json=None,
+                result_etag=None,
+                result_version=cls.result_version + 1,
+                updated_at=cls.updated_at,
+            )
+            .execution_options(synchronize_session=False)
         )
+
+    @classmethod
+    def invalidate_results(cls, session: Session, *criteria):
+        """Drops the cached results of the domain searches matching `criteria`"""
+        session.execute(cls._invalidate_results_query(*criteria))
+
+    @classmethod
+    def invalidate_results_of_listings(cls, session: Session, listing_ids: Iterable[int], batch_size: int = 10000):
+        """Drops the cached results of the domain searches that rank one of the listings"""
+        for listing_id_batch in batched(listing_ids, batch_size):
+            cls.invalidate_results(
+                session,
+                cls.id.in_(
+                    select(ListingDomainSearch.domain_search_id).where(
+                        ListingDomainSearch.listing_id.in_(listing_id_batch)
+                    )
+                ),
+            )
+
+    @staticmethod
+    def serialize_result(result: dict) -> tuple[bytes, str]:
+        """The JSON bytes of a result and their ETag"""
+        result_json = orjson.dumps(result)
+        return result_json, hashlib.blake2b(result_json, digest_size=16).hexdigest()
+
+    @classmethod
+    async def aget_cached_result(cls, session: AsyncSession, uuid: str) -> Optional[tuple[bytes, str]]:
+        """
+        The serialized result of the domain search with `uuid` and its ETag, None if the search does not exist
+
+        A cached result is read with a single select of three columns, without loading the search or its listings.
+        Otherwise the result is built, serialized and stored, unless it was invalidated in the meantime.
+        """
+        uuid_bytes = bytes.fromhex(uuid.replace("-", ""))
+        row = (
+            await session.execute(
+                select(cls.id, cls.result_json, cls.result_etag, cls.result_version).where(cls.ulid == uuid_bytes)
+            )
+        ).one_or_none()
+        if row is None:
+            return None
+        domain_search_id, result_json, result_etag, result_version = row
+        if result_json is not None:
+            return result_json, result_etag
+
+        domain_search = await session.get(cls, domain_search_id)
+        result_json, result_etag = cls.serialize_result(await domain_search.aget_result(session))
+        await session.execute(
+            update(cls)
+            .where(cls.id == domain_search_id, cls.result_version == result_version)
+            .values(result_json=result_json, result_etag=result_etag, updated_at=cls.updated_at)
+            .execution_options(synchronize_session=False)
+        )
+        return result_json, result_etag
+
+    def get_result(self, session: Session):
+        """
+        Helper function to get the result of a domain search including the skeletons if the request is not unlocked
+
+        The listings are loaded with their scores in a single query
+        """
+        listing_scores = session.execute(self._listing_scores_query()).tuples().all()
+        return self._format_result(listing_scores)
+
+    async def aget_result(self, session: AsyncSession):
+        """Async variant of `get_result`"""
+        listing_scores = (await session.execute(self._listing_scores_query())).tuples().all()
+        return self._format_result(listing_scores)
+
+    def _listing_scores_query(self) -> Select[Tuple[Listing, float]]:
+        return (
+            select(Listing, ListingDomainSearch.score)
+            .join(ListingDomainSearch, ListingDomainSearch.listing_id == Listing.id)
+            .where(ListingDomainSearch.domain_search_id == self.id)
+            .order_by(ListingDomainSearch.score.desc())
+            .options(*Listing.result_load_options())
+        )
+
+    def _format_result(self, listing_scores: Sequence[Tuple[Listing, float]]):
+        offset = 0 if self.is_unlocked else 5
         result = {
             "domains": [
                 {
@@ -337,12 +1277,12 @@ class DomainSearch(Base):
                     "price": listing.price,
                     "numberOfBids": listing.number_of_bids,
                     "domainAge": listing.domain_age,
-                    "score": listing_id_to_score[listing.id],
+                    "score": score,
                 }
-                for i, listing in enumerate(sorted_domain_listings[offset:], start=offset + 1)
+                for i, (listing, score) in enumerate(listing_scores[offset:], start=offset + 1)
             ],
             "uuid": self.uuid,
-            "totalDomains": len(self.listings),
+            "totalDomains": len(listing_scores),
             "isUnlocked": self.is_unlocked,
             "prompt": self.prompt,
             "summary": self.summary,
@@ -354,9 +1294,9 @@ class DomainSearch(Base):
                     "price": listing.price,
                     "pageviews": listing.pageviews,
                     "valuation": listing.valuation,
-                    "score": listing_id_to_score[listing.id],
+                    "score": score,
                 }
-                for i, listing in enumerate(sorted_domain_listings[:offset], start=1)
+                for i, (listing, score) in enumerate(listing_scores[:offset], start=1)
             ]
         else:
             result["skeletons"] = []
@@ -376,6 +1316,9 @@ class DomainSearch(Base):
             return count
 
 
+_create_flight = SingleFlight()
+
+
 class ListingDomainSearch(Base):
     __tablename__ = "listings_to_domain_searches_rel"
 
@@ -390,6 +1333,41 @@ class ListingDomainSearch(Base):
 
     score: Mapped[float] = mapped_column()
 
+    @classmethod
+    def apply_diff(
+        cls,
+        session: Session,
+        ranked_scores: dict[tuple[int, int], float],
+        existing: set[tuple[int, int]],
+        batch_size: int = 10000,
+    ) -> dict[int, list[int]]:
+        """
+        Inserts the (domain_search_id, listing_id) pairs of `ranked_scores` that do not exist yet and deletes the
+        `existing` pairs that are not ranked anymore.
+        Returns the ids of the inserted listings per domain search id, sorted by score (descending)
+        """
+        to_insert = ranked_scores.keys() - existing
+        to_delete = existing - ranked_scores.keys()
+        for pair_batch in batched(to_insert, batch_size):
+            session.execute(
+                insert(cls),
+                [
+                    {"domain_search_id": pair[0], "listing_id": pair[1], "score": ranked_scores[pair]}
+                    for pair in pair_batch
+                ],
+            )
+        for pair_batch in batched(to_delete, batch_size):
+            session.execute(delete(cls).where(tuple_(cls.domain_search_id, cls.listing_id).in_(pair_batch)))
+        changed_domain_search_ids = {domain_search_id for domain_search_id, _ in to_insert | to_delete}
+        for domain_search_id_batch in batched(changed_domain_search_ids, batch_size):
+            DomainSearch.invalidate_results(session, DomainSearch.id.in_(domain_search_id_batch))
+
+        new_listing_ids: dict[int, list[int]] = {}
+        for domain_search_id, listing_id in sorted(to_insert, key=ranked_scores.__getitem__, reverse=True):
+            new_listing_ids.setdefault(domain_search_id, []).append(listing_id)
+        logger.info(f"Ranked {len(to_insert)} new and removed {len(to_delete)} listing/search pairs")
+        return new_listing_ids
+
 
 class BatchRequestStatus(enum.Enum):
     PENDING = 0  # created but not submitted
@@ -406,12 +1384,14 @@ class OpenAIEmbeddingBatchRequest(Base):
     listings: Mapped[List[Listing]] = relationship("Listing", back_populates="batch_request")
     status: Mapped[BatchRequestStatus] = mapped_column(default=BatchRequestStatus.PENDING)
     output_file_id: Mapped[Optional[str]] = mapped_column(nullable=True)
+    # bytes of the output file applied to the listings, an interrupted download resumes from there
+    downloaded_bytes: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
 
     @property
     def output_file_id_download_url(self) -> str:
         if self.output_file_id is None:
             raise ValueError("No output file id on {self.batch_id}")
-        url = f"https://api.openai.com/v1/internal/files/{self.output_file_id}/download_link"
+        url = f"{str(client.base_url).rstrip('/')}/internal/files/{self.output_file_id}/download_link"
         headers = {"Authorization": f"Bearer {config['OPENAI_API_KEY']}"}
         download_link_response = requests.get(url, headers=headers, timeout=5)
         return download_link_response.json()["url"]
@@ -428,51 +1408,135 @@ class OpenAIEmbeddingBatchRequest(Base):
         """
         for i, listing_batch in enumerate(batched(listing_id_to_url, batch_size)):
             logger.info(f"Creating OpenAI text embedding batch request #{i+1}")
-            with tempfile.TemporaryFile() as buffer:
-                for listing_id, url in listing_batch:
-                    parts = url.split(".")
-                    request_data = {
-                        "custom_id": f"{str(ulid.ULID())}:{listing_id}:{url}",
-                        "method": "POST",
-                        "url": "/v1/embeddings",
-                        "body": {
-                            "model": "text-embedding-3-small",
-                            "input": [" ".join(parts)],
-                            "encoding_format": "float",
-                        },
-                    }
-                    buffer.write((json.dumps(request_data) + "\n").encode("utf-8"))
-                buffer.seek(0)
+            batch_input_file = client.files.create(
+                file=("batch.jsonl", cls._batch_file(listing_batch)), purpose="batch"
+            )
+            request_response = client.batches.create(
+                input_file_id=batch_input_file.id,
+                endpoint="/v1/embeddings",
+                completion_window="24h",
+            )
+            cls._add(session, request_response.id, listing_batch)
 
-                batch_input_file = client.files.create(file=buffer, purpose="batch")
-                request_response = client.batches.create(
-                    input_file_id=batch_input_file.id,
-                    endpoint="/v1/embeddings",
-                    completion_window="24h",
-                )
-                batch_request = cls(
-                    batch_id=request_response.id,
-                    status=BatchRequestStatus.PROCESSING,
-                )
-                session.add(batch_request)
-                session.flush()
-                session.execute(
-                    update(Listing),
-                    [{"id": listing_id, "batch_request_id": batch_request.id} for listing_id, _ in listing_batch],
-                )
+    @classmethod
+    def submit_batch_requests(
+        cls,
+        session_factory: sessionmaker,
+        listing_id_to_url: Iterable[tuple[int, str]],
+        batch_size: int = 50000,
+        concurrency: int = 4,
+    ) -> list[str]:
+        """
+        Pipelined variant of `create_batch_requests`, returns the ids of the created batches
+
+        The next batch of listings is read from `listing_id_to_url` (e.g. the running upsert) while up to
+        `concurrency` batches are built, uploaded and created. Each batch request is committed in its own session
+        as soon as it is created, independently of the session that produces the listings.
+        """
+        return asyncio.run(cls.acreate_batch_requests(session_factory, listing_id_to_url, batch_size, concurrency))
+
+    @classmethod
+    async def acreate_batch_requests(
+        cls,
+        session_factory: sessionmaker,
+        listing_id_to_url: Iterable[tuple[int, str]],
+        batch_size: int = 50000,
+        concurrency: int = 4,
+    ) -> list[str]:
+        # a client per event loop, `submit_batch_requests` may run in several threads at once
+        async with openai.AsyncOpenAI(api_key=config["OPENAI_API_KEY"], base_url=OPENAI_BASE_URL) as aclient:
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def submit(n_batch: int, listing_batch: tuple[tuple[int, str], ...]) -> str:
+                try:
+                    tick = time.time()
+                    batch_file = await asyncio.to_thread(cls._batch_file, listing_batch)
+                    batch_input_file = await aclient.files.create(file=("batch.jsonl", batch_file), purpose="batch")
+                    request_response = await aclient.batches.create(
+                        input_file_id=batch_input_file.id,
+                        endpoint="/v1/embeddings",
+                        completion_window="24h",
+                    )
+                    await asyncio.to_thread(cls._commit, session_factory, request_response.id, listing_batch)
+                    logger.info(
+                        f"Created OpenAI text embedding batch request #{n_batch} ({len(listing_batch)} listings) "
+                        f"in {time.time() - tick:.2f}s"
+                    )
+                    return request_response.id
+                finally:
+                    semaphore.release()
+
+            tasks = []
+            listing_batches = batched(listing_id_to_url, batch_size)
+            while True:
+                await semaphore.acquire()
+                # reading the next batch runs the producer (e.g. the upsert), off the event loop
+                if (listing_batch := await asyncio.to_thread(next, listing_batches, None)) is None:
+                    semaphore.release()
+                    break
+                tasks.append(asyncio.create_task(submit(len(tasks) + 1, listing_batch)))
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        if errors := [result for result in results if isinstance(result, BaseException)]:
+            logger.error(f"{len(errors)} of {len(results)} batch requests could not be created")
+            raise errors[0]
+        return results
+
+    @classmethod
+    def _commit(cls, session_factory: sessionmaker, batch_id: str, listing_batch: Sequence[tuple[int, str]]):
+        with session_factory.begin() as session:
+            cls._add(session, batch_id, listing_batch)
+
+    @classmethod
+    def _add(cls, session: Session, batch_id: str, listing_batch: Sequence[tuple[int, str]]):
+        batch_request = cls(batch_id=batch_id, status=BatchRequestStatus.PROCESSING)
+        session.add(batch_request)
+        session.flush()
+        session.execute(
+            update(Listing),
+            [{"id": listing_id, "batch_request_id": batch_request.id} for listing_id, _ in listing_batch],
+        )
+
+    # the custom id and the input are the only parts that differ between the lines of a batch file
+    BATCH_FILE_LINE = (
+        '{{"custom_id": {custom_id}, "method": "POST", "url": "/v1/embeddings", "body": '
+        '{{"model": "text-embedding-3-small", "input": [{input}], "encoding_format": "float"}}}}\n'
+    )
+
+    @classmethod
+    def _batch_file(cls, listing_batch: Sequence[tuple[int, str]]) -> bytes:
+        """The JSONL input file of an embedding batch for the listings"""
+        return "".join(
+            cls.BATCH_FILE_LINE.format(
+                custom_id=json.dumps(f"{ulid.ULID()}:{listing_id}:{url}"), input=json.dumps(listing_text(url))
+            )
+            for listing_id, url in listing_batch
+        ).encode("utf-8")
 
     @classmethod
-    def update_processing(cls, session: Session) -> list["OpenAIEmbeddingBatchRequest"]:
+    def get_open_count(cls, session: Session) -> int:
+        """Number of batch requests whose embeddings are not written yet"""
+        open_statuses = [BatchRequestStatus.PENDING, BatchRequestStatus.PROCESSING, BatchRequestStatus.COMPLETED]
+        # pylint: disable=not-callable
+        return session.execute(select(func.count()).select_from(cls).where(cls.status.in_(open_statuses))).scalar()
+
+    @classmethod
+    def update_processing(cls, session: Session, concurrency: int = 8) -> list["OpenAIEmbeddingBatchRequest"]:
         """
         Process all the open batch requests
+
+        The status of up to `concurrency` batches is retrieved at once, the results are applied in `session`.
         """
         result = []
         open_batch_requests = session.scalars(
             select(cls).where(cls.status.in_([BatchRequestStatus.PENDING, BatchRequestStatus.PROCESSING]))
-        )
+        ).all()
         now = dt.datetime.now(dt.UTC)
-        for batch_request in open_batch_requests:
-            batch_response = client.batches.retrieve(batch_request.batch_id)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            batch_responses = list(
+                executor.map(client.batches.retrieve, [batch_request.batch_id for batch_request in open_batch_requests])
+            )
+        for batch_request, batch_response in zip(open_batch_requests, batch_responses):
             if batch_response.status == "completed":
                 logger.info(f"Batch {batch_request.batch_id} completed!")
                 batch_request.output_file_id = batch_response.output_file_id
@@ -493,66 +1557,148 @@ class OpenAIEmbeddingBatchRequest(Base):
                 batch_request.status = BatchRequestStatus.FAILED
         return result
 
-    def download(self, session_factory: sessionmaker, retry=1, max_retries=3, batch_size=10000):
+    def download(
+        self,
+        session_factory: sessionmaker,
+        max_retries=3,
+        batch_size=10000,
+        progress_position: Optional[int] = None,
+    ):
+        """
+        Downloads the output file and writes the embeddings into the listings
+
+        The embeddings are applied in batches of `batch_size` lines, each followed by storing the byte offset reached
+        in the output file. After a network error (or a crash) the download resumes from that offset with an HTTP
+        Range request. With `progress_position`, the applied bytes are shown as a progress bar on that line.
+        """
         with session_factory.begin() as session:
-            session.add(self)
-            download_url = self.output_file_id_download_url
-            embedding_file_response = requests.get(download_url, stream=True, timeout=5)
             session.add(self)
             # pylint: disable=not-callable
             count_query = select(func.count()).select_from(Listing).where(Listing.batch_request_id == self.id)
             n_listings = session.execute(count_query).scalar()
-            batch_id = self.batch_id
-        try:
-            for data_batch in batched(self._yield_embedding_data(embedding_file_response, batch_id), batch_size):
-                with session_factory.begin() as session:
-                    result = (
-                        session.query(Listing.id)
-                        .filter(Listing.id.in_({listing_id for listing_id, _ in data_batch}))
-                        .all()
-                    )
-                    listing_ids = {row.id for row in result}
-                    session.execute(
-                        update(Listing),
-                        [
-                            {"id": listing_id, "embeddings": embeddings}
-                            for listing_id, embeddings in data_batch
-                            if listing_id in listing_ids
-                        ],
-                    )
+            batch_id, output_file_id, offset = self.batch_id, self.output_file_id, self.downloaded_bytes
 
-        except (
-            TimeoutError,
-            IncompleteRead,
-            ConnectionTimeoutError,
-            requests.exceptions.ConnectionError,
-            ProtocolError,
-            ChunkedEncodingError,
-        ):
-            if retry < max_retries:
-                logger.warning(f"Download failed for {batch_id}. Retrying {retry}/{max_retries}")
-                return self.download(session_factory, retry=retry + 1, max_retries=max_retries, batch_size=batch_size)
-            else:
-                raise
+        progress = tqdm(
+            desc=batch_id,
+            initial=offset,
+            unit="B",
+            unit_scale=True,
+            position=progress_position,
+            leave=False,
+            disable=progress_position is None,
+        )
+        retry = 0
+        while True:
+            try:
+                with session_factory.begin() as session:
+                    session.add(self)
+                    download_url = self.output_file_id_download_url
+                embedding_file_response = self._request_output(download_url, offset)
+                if embedding_file_response is None:
+                    logger.info(f"{batch_id} was downloaded up to byte {offset} already, finalizing it")
+                    break
+                progress.total = offset + int(embedding_file_response.headers.get("Content-Length", 0))
+                logger.info(f"Downloading & processing lines in {batch_id} from byte {offset}")
+                for data_batch in batched(self._yield_embedding_data(embedding_file_response, offset), batch_size):
+                    with session_factory.begin() as session:
+                        Listing.copy_embeddings(
+                            session, [(listing_id, embeddings) for _, listing_id, embeddings in data_batch]
+                        )
+                        progress.update(data_batch[-1][0] - offset)
+                        offset = data_batch[-1][0]
+                        session.execute(
+                            update(type(self)).where(type(self).id == self.id).values(downloaded_bytes=offset)
+                        )
+                break
+            except (
+                TimeoutError,
+                IncompleteRead,
+                ConnectionTimeoutError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                ProtocolError,
+                ChunkedEncodingError,
+            ):
+                retry += 1
+                if retry > max_retries:
+                    progress.close()
+                    raise
+                logger.warning(f"Download failed for {batch_id}. Resuming from byte {offset} ({retry}/{max_retries})")
+        progress.close()
 
         with session_factory.begin() as session:
             session.add(self)
             self.status = BatchRequestStatus.FINALIZED
-            if self.output_file_id:
+            if freshness := Listing.embedding_freshness(session, Listing.batch_request_id == self.id):
+                logger.info(
+                    f"Freshness of the listings in {self.batch_id}: "
+                    + ", ".join(f"{name} {seconds:.0f}s" for name, seconds in freshness.items())
+                )
+            if output_file_id:
                 logger.info(
-                    f"Downloaded embeddings for {n_listings} listings in {self.batch_id}. Deleting file {self.output_file_id}"
+                    f"Downloaded embeddings for {n_listings} listings in {batch_id}. Deleting file {output_file_id}"
                 )
-                client.files.delete(self.output_file_id)
+                client.files.delete(output_file_id)
 
     @staticmethod
-    def _yield_embedding_data(response: requests.Response, batch_id: str) -> Iterable[tuple[int, list[float]]]:
-        logger.info(f"Downloading & processing lines in {batch_id}")
-        for line in response.iter_lines(decode_unicode=True):
-            data = json.loads(line)
-            custom_id = data["custom_id"]
-            _ulid, listing_id, _url = custom_id.split(":")
-            embeddings = data["response"]["body"]["data"][0]["embedding"]
-            yield listing_id, embeddings
+    def _request_output(download_url: str, offset: int) -> Optional[requests.Response]:
+        """Requests the output file from `offset` on, None if it was downloaded up to its end already"""
+        # no content encoding, the offsets are positions in the file itself
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        response = requests.get(download_url, headers=headers, stream=True, timeout=5)
+        # a crash after the last offset was stored resumes at the end of the file, which is not a satisfiable range
+        if response.status_code == 416:
+            response.close()
+            return None
+        response.raise_for_status()
+        if (content_range := response.headers.get("Content-Range")) and (total := content_range.rpartition("/")[2]):
+            if total.isdigit() and offset >= int(total):
+                response.close()
+                return None
+        return response
+
+    @classmethod
+    def _yield_embedding_data(cls, response: requests.Response, offset: int = 0) -> Iterable[tuple[int, int, str]]:
+        """
+        Yields the byte offset after each line of the output file, the listing id and the embeddings of the line
+
+        `offset` is the position the response starts at, when the server ignored the Range request (200 instead of
+        206), the bytes before it are skipped.
+        """
+        skip = offset if response.status_code != 206 else 0
+        position = offset
+        pending = b""
+        for chunk in response.iter_content(1024 * 1024):
+            if skip:
+                chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                position += len(line) + 1
+                if line.strip() and (parsed := cls._parse_output_line(line)) is not None:
+                    yield position, *parsed
+        if pending.strip() and (parsed := cls._parse_output_line(pending)) is not None:
+            yield position + len(pending), *parsed
+
+    @staticmethod
+    def _parse_output_line(line: bytes) -> Optional[tuple[int, str]]:
+        """
+        Returns the listing id and the embeddings (in pgvector's text format) of a line, None for failed requests
+
+        The embeddings array is cut out of the line as it is, only the rest of the line is parsed.
+        """
+        key = line.find(b'"embedding":')
+        if key == -1:
+            data = orjson.loads(line)
+            logger.warning(f"No embeddings for {data.get('custom_id')}: {data.get('error') or data.get('response')}")
+            return None
+        start = line.index(b"[", key)
+        end = line.index(b"]", start) + 1
+        data = orjson.loads(line[:start] + b"null" + line[end:])
+        _ulid, listing_id, _url = data["custom_id"].split(":")
+        return int(listing_id), line[start:end].decode()
 
 
 class DataUpdate(Base):
@@ -565,3 +1711,291 @@ class DataUpdate(Base):
     def get_listing_count(cls, session: Session):
         latest_update = session.scalar(select(cls).order_by(cls.created_at.desc()).limit(1))
         return latest_update.listing_count
+
+    @classmethod
+    async def aget_listing_count(cls, session: AsyncSession):
+        latest_update = await session.scalar(select(cls).order_by(cls.created_at.desc()).limit(1))
+        return latest_update.listing_count
+
+
+class FeedState(Base):
+    """Validators of the last feed download of a `DomainAdapter`, sent with the next request to skip unchanged feeds"""
+
+    __tablename__ = "feed_states"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    source: Mapped[str] = mapped_column(unique=True)
+    etag: Mapped[Optional[str]] = mapped_column(nullable=True)
+    last_modified: Mapped[Optional[str]] = mapped_column(nullable=True)
+
+    @classmethod
+    def get_or_create(cls, session: Session, source: str) -> "FeedState":
+        if (feed_state := session.scalar(select(cls).where(cls.source == source))) is None:
+            feed_state = cls(source=source)
+            session.add(feed_state)
+        return feed_state
+
+
+class PipelineStage(enum.Enum):
+    INGEST = 0  # download & upsert the listings of a feed -> ingested
+    SUBMIT = 1  # create embedding batch requests for the ingested listings -> submitted
+    POLL = 2  # poll the status of the open batch requests -> completed
+    DOWNLOAD = 3  # write the embeddings of a completed batch request -> embedded
+    RANK = 4  # merge the embedded listings into the domain search rankings -> ranked
+    CLEAN = 5  # delete expired listings, old jobs and old files
+
+
+class PipelineJobStatus(enum.Enum):
+    PENDING = 0  # waiting for `run_after`
+    RUNNING = 1  # claimed by a worker
+    DONE = 2  # finished
+    FAILED = 3  # gave up after `max_attempts`
+
+
+# predicate of the partial unique index on the key, repeated verbatim as the ON CONFLICT target
+OPEN_PIPELINE_JOB = "status IN ('PENDING', 'RUNNING')"
+
+
+class PipelineJob(Base):
+    """
+    A job of the embedding pipeline queue, see `scripts/pipeline_daemon.py`
+
+    Workers claim the due jobs of a stage with `FOR UPDATE SKIP LOCKED`, so any number of them can share the table.
+    Only one job per `key` can be open (pending or running), which makes enqueueing idempotent. A job whose worker
+    died is claimed again once its lease expired, so the stages must be safe to re-run.
+    """
+
+    __tablename__ = "pipeline_jobs"
+    __table_args__ = (
+        Index(
+            "ix_pipeline_jobs_key_open",
+            "key",
+            unique=True,
+            postgresql_where=text(OPEN_PIPELINE_JOB),
+        ),
+        Index("ix_pipeline_jobs_stage_status_run_after", "stage", "status", "run_after"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    stage: Mapped[PipelineStage] = mapped_column()
+    key: Mapped[str] = mapped_column()
+    payload: Mapped[dict] = mapped_column(JSON, default=dict)
+    status: Mapped[PipelineJobStatus] = mapped_column(default=PipelineJobStatus.PENDING)
+    attempts: Mapped[int] = mapped_column(default=0)
+    run_after: Mapped[dt.datetime] = mapped_column(default=utcnow)
+    locked_by: Mapped[Optional[str]] = mapped_column(nullable=True)
+    locked_at: Mapped[Optional[dt.datetime]] = mapped_column(nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(nullable=True)
+
+    OPEN_STATUSES = (PipelineJobStatus.PENDING, PipelineJobStatus.RUNNING)
+
+    @classmethod
+    def enqueue(
+        cls, session: Session, stage: PipelineStage, key: str, payload: Optional[dict] = None, delay: float = 0
+    ) -> bool:
+        """Adds a job unless one with the same key is still open, returns whether it was added"""
+        now = utcnow()
+        insert_query = (
+            pg_insert(cls)
+            .values(
+                stage=stage,
+                key=key,
+                payload=payload or {},
+                status=PipelineJobStatus.PENDING,
+                attempts=0,
+                run_after=now + dt.timedelta(seconds=delay),
+                created_at=now,
+                updated_at=now,
+            )
+            .on_conflict_do_nothing(index_elements=[cls.key], index_where=text(OPEN_PIPELINE_JOB))
+        )
+        return session.execute(insert_query).rowcount > 0
+
+    @classmethod
+    def claim(
+        cls, session: Session, stage: PipelineStage, worker: str, lease: dt.timedelta = dt.timedelta(hours=1)
+    ) -> Optional["PipelineJob"]:
+        """
+        Locks the next due job of `stage` for `worker`
+
+        The lookup and the update are a single statement, the row lock is only held while it runs. Running jobs whose
+        lease expired are taken over. The job is detached from `session`, it stays readable after the commit.
+        """
+        now = utcnow()
+        claimable_id = (
+            select(cls.id)
+            .where(
+                cls.stage == stage,
+                or_(
+                    and_(cls.status == PipelineJobStatus.PENDING, cls.run_after <= now),
+                    and_(cls.status == PipelineJobStatus.RUNNING, cls.locked_at < now - lease),
+                ),
+            )
+            .order_by(cls.run_after)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        job = session.scalars(
+            update(cls)
+            .where(cls.id == claimable_id)
+            .values(status=PipelineJobStatus.RUNNING, locked_by=worker, locked_at=now, attempts=cls.attempts + 1)
+            .returning(cls)
+            .execution_options(synchronize_session=False)
+        ).one_or_none()
+        if job is not None:
+            session.expunge(job)
+        return job
+
+    def _release(self, session: Session, **values) -> bool:
+        """Updates the job and releases its lock unless another worker took it over, returns whether it was updated"""
+        cls = type(self)
+        return (
+            session.execute(
+                update(cls)
+                .where(cls.id == self.id, cls.status == PipelineJobStatus.RUNNING, cls.locked_by == self.locked_by)
+                .values(locked_by=None, locked_at=None, **values)
+            ).rowcount
+            > 0
+        )
+
+    def complete(self, session: Session, next_run_in: Optional[float] = None) -> bool:
+        """
+        Marks the job as done, a periodic job is enqueued again to run in `next_run_in` seconds
+
+        Returns False without changes if the lease was lost to another worker.
+        """
+        if not self._release(session, status=PipelineJobStatus.DONE):
+            return False
+        if next_run_in is not None:
+            type(self).enqueue(session, self.stage, self.key, self.payload, delay=next_run_in)
+        return True
+
+    def postpone(self, session: Session, delay: float) -> bool:
+        """Puts the job back into the queue for `delay` seconds without counting the attempt (backpressure)"""
+        return self._release(
+            session,
+            status=PipelineJobStatus.PENDING,
+            attempts=type(self).attempts - 1,
+            run_after=utcnow() + dt.timedelta(seconds=delay),
+        )
+
+    def fail(self, session: Session, error: str, max_attempts: int = 5, backoff: float = 30) -> bool:
+        """Retries the job with exponential backoff, until `max_attempts` attempts failed"""
+        if self.attempts >= max_attempts:
+            logger.error(f"Giving up on pipeline job {self.key} after {self.attempts} attempts")
+            return self._release(session, status=PipelineJobStatus.FAILED, last_error=error)
+        return self._release(
+            session,
+            status=PipelineJobStatus.PENDING,
+            last_error=error,
+            run_after=utcnow() + dt.timedelta(seconds=backoff * 2 ** (self.attempts - 1)),
+        )
+
+    @classmethod
+    def checkpoint(cls, session: Session, job_id: int, worker: str, payload: dict) -> bool:
+        """
+        Stores the progress of a running job and renews its lease, a retry continues from there
+
+        Returns False without changes if `worker` lost the lease to another worker.
+        """
+        return (
+            session.execute(
+                update(cls)
+                .where(cls.id == job_id, cls.status == PipelineJobStatus.RUNNING, cls.locked_by == worker)
+                .values(payload=payload, locked_at=utcnow())
+            ).rowcount
+            > 0
+        )
+
+    @classmethod
+    def heartbeat(cls, session: Session, job_id: int, worker: str) -> bool:
+        """Renews the lease of a running job, returns False if `worker` lost it to another worker"""
+        return (
+            session.execute(
+                update(cls)
+                .where(cls.id == job_id, cls.status == PipelineJobStatus.RUNNING, cls.locked_by == worker)
+                .values(locked_at=utcnow())
+            ).rowcount
+            > 0
+        )
+
+    @classmethod
+    def queue_depths(cls, session: Session) -> dict[PipelineStage, int]:
+        """Number of open jobs per stage"""
+        # pylint: disable=not-callable
+        return dict(
+            session.execute(
+                select(cls.stage, func.count()).where(cls.status.in_(cls.OPEN_STATUSES)).group_by(cls.stage)
+            ).all()
+        )
+
+    @classmethod
+    def prune(cls, session: Session, older_than: dt.timedelta = dt.timedelta(days=7)) -> int:
+        """Deletes the finished jobs older than `older_than`"""
+        n_deleted = session.execute(
+            delete(cls).where(
+                cls.status.in_([PipelineJobStatus.DONE, PipelineJobStatus.FAILED]),
+                cls.updated_at < utcnow() - older_than,
+            )
+        ).rowcount
+        logger.info(f"Deleted {n_deleted} finished pipeline jobs")
+        return n_deleted
+
+
+class EmbeddingCache(Base):
+    """
+    Persistent cache of text embeddings, keyed by the model and the hash of the normalized text
+
+    The in-memory LRU of `integrations.embeddings` sits in front of it.
+    """
+
+    __tablename__ = "embedding_cache"
+    __table_args__ = (UniqueConstraint("model", "text_hash"),)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    model: Mapped[str] = mapped_column()
+    text_hash: Mapped[str] = mapped_column()
+    embeddings: Mapped[List[float]] = mapped_column(Vector(EMBEDDING_DIMENSIONS))
+
+    @classmethod
+    def get_or_compute(
+        cls, session: Session, text: str, provider: EmbeddingProvider = embedding_provider
+    ) -> List[float]:
+        key = (provider.model, text_hash(text))
+        if (embeddings := embedding_lru.get(key)) is not None:
+            cache_stats.record_hit("memory")
+            return embeddings
+        embeddings = session.scalar(cls._lookup_query(*key))
+        if embeddings is not None:
+            embedding_lru.put(key, embeddings)
+            cache_stats.record_hit("db")
+            return embeddings
+        embeddings = get_embeddings(text, provider)
+        session.execute(cls._insert_query(*key, embeddings))
+        return embeddings
+
+    @classmethod
+    async def aget_or_compute(
+        cls, session_factory: async_sessionmaker, text: str, provider: EmbeddingProvider = embedding_provider
+    ) -> List[float]:
+        """Async variant of `get_or_compute`, no connection is held while the embeddings are requested"""
+        key = (provider.model, text_hash(text))
+        if (embeddings := embedding_lru.get(key)) is not None:
+            cache_stats.record_hit("memory")
+            return embeddings
+        async with session_factory() as session:
+            embeddings = await session.scalar(cls._lookup_query(*key))
+        if embeddings is not None:
+            embedding_lru.put(key, embeddings)
+            cache_stats.record_hit("db")
+            return embeddings
+        embeddings = await aget_embeddings(text, provider)
+        async with session_factory.begin() as session:
+            await session.execute(cls._insert_query(*key, embeddings))
+        return embeddings
+
+    @classmethod
+    def _lookup_query(cls, model: str, hashed_text: str):
+        return select(cls.embeddings).where(cls.model == model, cls.text_hash == hashed_text)
+
+    @classmethod
+    def _insert_query(cls, model: str, hashed_text: str, embeddings: List[float]):
+        return pg_insert(cls).values(model=model, text_hash=hashed_text, embeddings=embeddings).on_conflict_do_nothing()
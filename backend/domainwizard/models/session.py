@@ -1,10 +1,19 @@
 from domainwizard.config import config
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 if db_url := config.get("DB_URL"):
     engine = create_engine(db_url, isolation_level="AUTOCOMMIT")
+    async_engine = create_async_engine(
+        make_url(db_url).set(drivername="postgresql+asyncpg"),
+        isolation_level="AUTOCOMMIT",
+        pool_size=int(config.get("DB_POOL_SIZE", 10)),
+    )
 else:
     raise ValueError("DB_URL environment variable not set. Cannot initialize database engine.")
 
+
 Session = sessionmaker(bind=engine)
+AsyncSession = async_sessionmaker(bind=async_engine, expire_on_commit=False)
@@ -0,0 +1,234 @@
+import asyncio
+import datetime as dt
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, List, NamedTuple, Optional
+
+import numpy as np
+from loguru import logger
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import cast, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, sessionmaker
+
+from ..config import config
+from .models import EMBEDDING_DIMENSIONS, Listing, utcnow
+
+__all__ = [
+    "VectorIndex",
+    "PgVectorIndex",
+    "IndexSnapshot",
+    "NumpyVectorIndex",
+    "HnswVectorIndex",
+    "VectorIndexes",
+    "get_vector_index",
+]
+
+
+class VectorIndex(ABC):
+    """
+    Nearest neighbour search over the embeddings of the active listings
+
+    `search` returns (listing id, cosine distance) tuples, nearest first, like `Listing.get_by_embeddings`.
+    """
+
+    name: str
+
+    def start(self, session_factory: sessionmaker):
+        """Prepares the index when the server starts, a no-op for the backends searching the database"""
+
+    def stop(self):
+        """Stops the background work of `start`"""
+
+    @abstractmethod
+    def search(self, session: Session, embeddings: List[float], limit: int = 100) -> list[tuple[int, float]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def asearch(
+        self, session: AsyncSession, embeddings: List[float], limit: int = 100
+    ) -> list[tuple[int, float]]:
+        raise NotImplementedError
+
+
+class PgVectorIndex(VectorIndex):
+    """Searches the listings table through the pgvector index"""
+
+    name = "pgvector"
+
+    def search(self, session: Session, embeddings: List[float], limit: int = 100) -> list[tuple[int, float]]:
+        return [(listing.id, score) for listing, score in Listing.get_by_embeddings(session, embeddings, limit)]
+
+    async def asearch(
+        self, session: AsyncSession, embeddings: List[float], limit: int = 100
+    ) -> list[tuple[int, float]]:
+        return [(listing.id, score) for listing, score in await Listing.aget_by_embeddings(session, embeddings, limit)]
+
+
+class IndexSnapshot(NamedTuple):
+    """The listings of one load of an in-process index, never modified after it is built"""
+
+    listing_ids: np.ndarray
+    auction_end_times: np.ndarray
+    matrix: np.ndarray
+    graph: Optional[Any] = None
+
+
+class NumpyVectorIndex(VectorIndex):
+    """
+    Exact in-process search over a float32 matrix of L2 normalized listing embeddings
+
+    `start` loads the matrix from the listings table and reloads it every `refresh_interval` seconds in a background
+    thread. Each load builds a new `IndexSnapshot` which replaces the current one in a single assignment, searches
+    only read the snapshot they started with and never wait for a load. Listings whose auction ended since the last
+    load are masked out at query time.
+    """
+
+    name = "numpy"
+
+    def __init__(self, refresh_interval: float = 3600, load_batch_size: int = 10000):
+        self.refresh_interval = refresh_interval
+        self.load_batch_size = load_batch_size
+        self.snapshot: Optional[IndexSnapshot] = None
+        self.loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._refresher: Optional[threading.Thread] = None
+
+    @property
+    def is_stale(self) -> bool:
+        return self.loaded_at is None or time.time() - self.loaded_at > self.refresh_interval
+
+    def load(self, session: Session):
+        tick = time.time()
+        now = utcnow()
+        listing_ids, auction_end_times, embeddings = [], [], []
+        # the server-side cursor of `yield_per` needs a transaction, the engine is in autocommit mode
+        with session.get_bind().connect().execution_options(isolation_level="REPEATABLE READ") as connection:
+            rows = connection.execute(
+                select(Listing.id, Listing.auction_end_time, cast(Listing.embeddings, Vector(EMBEDDING_DIMENSIONS)))
+                .where(Listing.embeddings.is_not(None), Listing.auction_end_time > now)
+                .execution_options(yield_per=self.load_batch_size)
+            )
+            for listing_id, auction_end_time, listing_embeddings in rows:
+                listing_ids.append(listing_id)
+                auction_end_times.append(auction_end_time.replace(tzinfo=dt.UTC).timestamp())
+                embeddings.append(np.asarray(listing_embeddings, dtype=np.float32))
+
+        matrix = np.vstack(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        self.snapshot = IndexSnapshot(
+            listing_ids=np.asarray(listing_ids, dtype=np.int64),
+            auction_end_times=np.asarray(auction_end_times, dtype=np.float64),
+            matrix=matrix,
+            graph=self._build(matrix),
+        )
+        self.loaded_at = time.time()
+        logger.info(f"Loaded {len(listing_ids)} listings into the {self.name} index ({time.time() - tick:.2f}s)")
+
+    def _build(self, matrix: np.ndarray) -> Optional[Any]:
+        return None
+
+    def start(self, session_factory: sessionmaker):
+        with session_factory() as session:
+            self.load(session)
+        self._stopping.clear()
+        self._refresher = threading.Thread(
+            target=self._refresh, args=(session_factory,), name=f"{self.name}-index-refresh", daemon=True
+        )
+        self._refresher.start()
+
+    def _refresh(self, session_factory: sessionmaker):
+        while not self._stopping.wait(self.refresh_interval):
+            try:
+                with session_factory() as session:
+                    self.load(session)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception(f"Refreshing the {self.name} index failed, the previous load is searched")
+
+    def stop(self):
+        self._stopping.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+
+    def search(self, session: Session, embeddings: List[float], limit: int = 100) -> list[tuple[int, float]]:
+        # the scripts search without `start`, the index is loaded on first use
+        if self._refresher is None and self.is_stale:
+            with self._lock:
+                if self.is_stale:
+                    self.load(session)
+        return self._search(self.snapshot, embeddings, limit)
+
+    async def asearch(
+        self, session: AsyncSession, embeddings: List[float], limit: int = 100
+    ) -> list[tuple[int, float]]:
+        if (snapshot := self.snapshot) is None:
+            raise RuntimeError(f"The {self.name} vector index is not loaded, start() it when the server starts")
+        return await asyncio.to_thread(self._search, snapshot, embeddings, limit)
+
+    def _query_vector(self, embeddings: List[float]) -> np.ndarray:
+        query = np.asarray(embeddings, dtype=np.float32)
+        return query / max(float(np.linalg.norm(query)), 1e-12)
+
+    def _search(self, snapshot: IndexSnapshot, embeddings: List[float], limit: int) -> list[tuple[int, float]]:
+        if not len(snapshot.listing_ids):
+            return []
+        distances = 1.0 - snapshot.matrix @ self._query_vector(embeddings)
+        distances[snapshot.auction_end_times <= time.time()] = np.inf
+        limit = min(limit, len(distances))
+        top = np.argpartition(distances, limit - 1)[:limit]
+        top = top[np.argsort(distances[top])]
+        return [(int(snapshot.listing_ids[i]), float(distances[i])) for i in top if np.isfinite(distances[i])]
+
+
+class HnswVectorIndex(NumpyVectorIndex):
+    """Approximate in-process search with an HNSW graph (requires `hnswlib`) built over the normalized matrix"""
+
+    name = "hnsw"
+
+    def __init__(self, m: int = 16, ef_construction: int = 200, ef_search: int = 200, **kwargs):
+        super().__init__(**kwargs)
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+
+    def _build(self, matrix: np.ndarray) -> Any:
+        try:
+            import hnswlib
+        except ImportError as e:
+            raise ImportError("The hnsw vector index backend requires hnswlib (pip install hnswlib)") from e
+
+        graph = hnswlib.Index(space="cosine", dim=matrix.shape[1] if len(matrix) else 1)
+        graph.init_index(max_elements=max(len(matrix), 1), ef_construction=self.ef_construction, M=self.m)
+        if len(matrix):
+            graph.add_items(matrix, np.arange(len(matrix)))
+        graph.set_ef(self.ef_search)
+        return graph
+
+    def _search(self, snapshot: IndexSnapshot, embeddings: List[float], limit: int) -> list[tuple[int, float]]:
+        if not len(snapshot.listing_ids):
+            return []
+        now = time.time()
+        active = snapshot.auction_end_times > now
+        limit = min(limit, int(active.sum()))
+        if not limit:
+            return []
+        labels, distances = snapshot.graph.knn_query(
+            self._query_vector(embeddings), k=limit, filter=lambda label: bool(active[label])
+        )
+        return [(int(snapshot.listing_ids[label]), float(distance)) for label, distance in zip(labels[0], distances[0])]
+
+
+VectorIndexes = {index.name: index for index in [PgVectorIndex, NumpyVectorIndex, HnswVectorIndex]}
+
+
+def get_vector_index(name: Optional[str] = None) -> VectorIndex:
+    """Instantiates the vector index backend configured with VECTOR_INDEX_BACKEND (default: pgvector)"""
+    name = name or config.get("VECTOR_INDEX_BACKEND", PgVectorIndex.name)
+    if name not in VectorIndexes:
+        raise ValueError(f"Unknown vector index backend '{name}', choose one of {', '.join(VectorIndexes)}")
+    if name == PgVectorIndex.name:
+        return PgVectorIndex()
+    return VectorIndexes[name](refresh_interval=float(config.get("VECTOR_INDEX_REFRESH_SECONDS", 3600)))
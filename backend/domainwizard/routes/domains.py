@@ -1,16 +1,39 @@
-from fastapi import APIRouter, HTTPException
+from typing import Optional
+
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, Response
 from pydantic import BaseModel
 from sqlalchemy import select
 
-from ..models import DataUpdate, DomainSearch, Session
+from ..models import AsyncSession, DataUpdate, DomainSearch, get_vector_index
 
 router = APIRouter()
+vector_index = get_vector_index()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
+async def result_response(session, uuid: str, request: Optional[Request] = None) -> Response:
+    """Responds with the cached result of a domain search, or 304 if the client has the current version"""
+    cached_result = await DomainSearch.aget_cached_result(session, uuid)
+    if cached_result is None:
+        raise HTTPException(status_code=404, detail="Request not found")
+    result_json, result_etag = cached_result
+    # the client revalidates on every use, the result changes with each data update
+    headers = {"ETag": f'"{result_etag}"', "Cache-Control": "no-cache"}
+    if request is not None and etag_matches(request.headers.get("If-None-Match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=result_json, media_type="application/json", headers=headers)
 
 
 @router.get("/api/requests")
 async def list_requests():
-    with Session.begin() as session:
-        requests = session.scalars(select(DomainSearch))
+    async with AsyncSession.begin() as session:
+        requests = await session.scalars(select(DomainSearch))
         return sorted(
             (
                 {"uuid": request.uuid, "summary": request.summary, "isExample": request.is_example}
@@ -23,43 +46,46 @@ async def list_requests():
 
 @router.put("/api/requests/{uuid}")
 async def update_request(uuid: str, data: dict):
-    with Session.begin() as session:
-        request = DomainSearch.get_by_uuid(session, uuid)
+    async with AsyncSession.begin() as session:
+        request = await DomainSearch.aget_by_uuid(session, uuid)
         if request is None:
             raise HTTPException(status_code=404, detail="Request not found")
         request.is_example = data["isExample"]
-        return request.get_result()
+        return await result_response(session, uuid)
 
 
 @router.get("/api/requests/{uuid}")
-async def get_request(uuid: str):
-    with Session.begin() as session:
-        request = DomainSearch.get_by_uuid(session, uuid)
-        if request is None:
-            raise HTTPException(status_code=404, detail="Request not found")
-        return request.get_result()
+async def get_request(uuid: str, request: Request):
+    async with AsyncSession.begin() as session:
+        return await result_response(session, uuid, request)
 
 
 @router.get("/api/count")
 async def get_active_listings_count():
-    with Session.begin() as session:
-        return DataUpdate.get_listing_count(session)
+    async with AsyncSession.begin() as session:
+        return await DataUpdate.aget_listing_count(session)
 
 
 class DomainSearchRequestBody(BaseModel):
     prompt: str
+    # return the ranked listings right away and generate the summary in the background
+    deferSummary: bool = False
 
 
 @router.post("/api/requests")
-async def create_or_get_request(data: DomainSearchRequestBody):
+async def create_or_get_request(data: DomainSearchRequestBody, background_tasks: BackgroundTasks):
     """Create a new request or get an existing one"""
-    with Session.begin() as session:
-        request = DomainSearch.create_or_get(session, data.prompt)
-        return request.get_result()
+    request = await DomainSearch.acreate_or_get(
+        AsyncSession, data.prompt, defer_summary=data.deferSummary, vector_index=vector_index
+    )
+    if request.summary is None:
+        background_tasks.add_task(DomainSearch.afill_summary, AsyncSession, request.id, request.prompt)
+    async with AsyncSession.begin() as session:
+        return await result_response(session, request.uuid)
 
 
 @router.get("/api/examples")
 async def list_examples():
-    with Session.begin() as session:
-        examples = DomainSearch.get_examples(session)
+    async with AsyncSession.begin() as session:
+        examples = await DomainSearch.aget_examples(session)
         return [{"uuid": example.uuid, "prompt": example.prompt, "summary": example.summary} for example in examples]
@@ -7,7 +7,7 @@ from loguru import logger
 from pydantic import BaseModel
 
 from ..config import config
-from ..models import DomainSearch, Session
+from ..models import AsyncSession, DomainSearch
 
 stripe.api_key = config["STRIPE_API_KEY"]
 
@@ -35,8 +35,8 @@ async def create_checkout(uuid: str, data: UnlockRequestBody):
             automatic_tax={"enabled": True},
             client_reference_id=uuid,
         )
-        with Session.begin() as session:
-            domain_search = DomainSearch.get_by_uuid(session, uuid)
+        async with AsyncSession.begin() as session:
+            domain_search = await DomainSearch.aget_by_uuid(session, uuid)
             if domain_search is None:
                 raise HTTPException(status_code=404, detail="Request not found")
             elif domain_search.is_unlocked:
@@ -66,12 +66,12 @@ async def webhook(request: Request):
 
     # Handle the event
     if event["type"] == "checkout.session.completed":
-        with Session.begin() as session:
-            domain_search = DomainSearch.get_by_uuid(session, event["data"]["object"]["client_reference_id"])
+        async with AsyncSession.begin() as session:
+            domain_search = await DomainSearch.aget_by_uuid(session, event["data"]["object"]["client_reference_id"])
             if domain_search is None:
                 logger.error("Request not found")
                 raise HTTPException(status_code=500, detail="Failed to create checkout session")
-            domain_search.is_unlocked = True
+            domain_search.unlock()
     else:
         print("Unhandled event type {}".format(event["type"]))
 
@@ -80,14 +80,15 @@ async def webhook(request: Request):
 async def success(uuid: str):
     # check if invoice is paid
     # create async wait until invoice is paid
-    with Session.begin() as session:
-        domain_search = DomainSearch.get_by_uuid(session, uuid)
+    async with AsyncSession.begin() as session:
+        domain_search = await DomainSearch.aget_by_uuid(session, uuid)
         if domain_search is None:
             logger.error("Request not found")
             raise HTTPException(status_code=500, detail="Failed to create checkout session")
-        if not domain_search.is_unlocked:
-            await asyncio.sleep(1)
-            return await success(uuid)
+        is_unlocked = domain_search.is_unlocked
+    if not is_unlocked:
+        await asyncio.sleep(1)
+        return await success(uuid)
     return config["DOMAIN"] + "/" + uuid
 
 
@@ -1,8 +1,21 @@
+import asyncio
+import contextlib
+
 from fastapi import FastAPI
 
+from ..models import Session
 from . import domains, payment
 
-app = FastAPI()
+
+@contextlib.asynccontextmanager
+async def lifespan(_: FastAPI):
+    # the in-process vector indexes are loaded before the first request and refreshed in the background
+    await asyncio.to_thread(domains.vector_index.start, Session)
+    yield
+    await asyncio.to_thread(domains.vector_index.stop)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 app.include_router(domains.router)
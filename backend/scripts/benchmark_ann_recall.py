@@ -0,0 +1,76 @@
+# Measures recall@k and latency of the listing ANN indexes (ef_search / probes, quantized and truncated coarse search)
+# against exact search, and reports the storage of the listings table and its indexes
+import argparse
+import statistics
+import time
+
+from domainwizard.models import DomainSearch, Listing, Session
+from loguru import logger
+from sqlalchemy import func, select, text
+
+
+def top_listing_ids(session, embeddings, limit, **settings) -> tuple[set[int], float]:
+    tick = time.perf_counter()
+    listing_ids = {listing.id for listing, _ in Listing.get_by_embeddings(session, embeddings, limit, **settings)}
+    return listing_ids, time.perf_counter() - tick
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=50, help="Number of saved searches used as queries")
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--ef-search", type=int, nargs="*", default=[100, 200, 400])
+    parser.add_argument("--probes", type=int, nargs="*", default=[])
+    parser.add_argument("--quantization", choices=["binary"], nargs="*", default=[])
+    parser.add_argument("--dimensions", type=int, nargs="*", default=[], help="Matryoshka truncated dimensions")
+    args = parser.parse_args()
+
+    with Session.begin() as session:
+        logger.info(
+            "listings: {} total, {} table".format(
+                *session.execute(
+                    text(
+                        "SELECT pg_size_pretty(pg_total_relation_size('listings')), "
+                        "pg_size_pretty(pg_table_size('listings'))"
+                    )
+                ).one()
+            )
+        )
+        for index_name, index_size in session.execute(
+            text(
+                "SELECT indexrelname, pg_size_pretty(pg_relation_size(indexrelid)) "
+                "FROM pg_stat_user_indexes WHERE relname = 'listings'"
+            )
+        ):
+            logger.info(f"index {index_name}: {index_size}")
+
+        query_embeddings = session.scalars(
+            select(DomainSearch.embeddings)
+            .where(DomainSearch.embeddings.is_not(None))
+            .order_by(func.random())
+            .limit(args.queries)
+        ).all()
+
+        session.execute(text("SET enable_indexscan = off"))
+        exact = [
+            top_listing_ids(session, embeddings, args.limit, quantization=None, dimensions=None)
+            for embeddings in query_embeddings
+        ]
+        session.execute(text("RESET enable_indexscan"))
+        logger.info(f"exact: p50={statistics.median(latency for _, latency in exact) * 1000:.1f}ms")
+
+        configurations = [{"ef_search": ef_search} for ef_search in args.ef_search]
+        configurations += [{"probes": probes} for probes in args.probes]
+        configurations += [{"quantization": quantization} for quantization in args.quantization]
+        configurations += [{"dimensions": dimensions} for dimensions in args.dimensions]
+        for settings in configurations:
+            latencies, recalls = [], []
+            for embeddings, (expected, _) in zip(query_embeddings, exact):
+                listing_ids, latency = top_listing_ids(session, embeddings, args.limit, **settings)
+                latencies.append(latency)
+                recalls.append(len(expected & listing_ids) / max(len(expected), 1))
+            percentiles = statistics.quantiles(latencies, n=100)
+            logger.info(
+                f"{settings}: p50={percentiles[49] * 1000:.1f}ms p99={percentiles[98] * 1000:.1f}ms "
+                f"recall@{args.limit}={statistics.mean(recalls):.3f}"
+            )
@@ -0,0 +1,52 @@
+# Compares the sequential and the pipelined creation of the embedding batch requests against the fake OpenAI server.
+# Needs a local database, the synthetic listings and their batch requests are deleted afterwards:
+#   python -m scripts.fake_openai_server --latency 0.5 &
+#   OPENAI_BASE_URL=http://localhost:8089/v1 python -m scripts.benchmark_batch_requests --rows 500000
+import argparse
+import time
+
+from domainwizard.models import Listing, OpenAIEmbeddingBatchRequest, Session
+from loguru import logger
+from sqlalchemy import delete, select, update
+
+from .benchmark_upsert import SOURCE, synthetic_feed
+
+
+def reset_batch_requests():
+    with Session.begin() as session:
+        batch_request_ids = session.scalars(
+            select(Listing.batch_request_id)
+            .where(Listing.source == SOURCE, Listing.batch_request_id.is_not(None))
+            .distinct()
+        ).all()
+        session.execute(update(Listing).where(Listing.source == SOURCE).values(batch_request_id=None))
+        session.execute(
+            delete(OpenAIEmbeddingBatchRequest).where(OpenAIEmbeddingBatchRequest.id.in_(batch_request_ids))
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--batch-size", type=int, default=50000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    with Session.begin() as session:
+        listing_id_to_url = list(Listing.copy_upsert_batch(session, synthetic_feed(args.rows), SOURCE))
+    try:
+        tick = time.time()
+        with Session.begin() as session:
+            OpenAIEmbeddingBatchRequest.create_batch_requests(session, listing_id_to_url, args.batch_size)
+        logger.info(f"sequential: {len(listing_id_to_url)} listings in {time.time() - tick:.1f}s")
+        reset_batch_requests()
+
+        tick = time.time()
+        OpenAIEmbeddingBatchRequest.submit_batch_requests(
+            Session, listing_id_to_url, args.batch_size, concurrency=args.concurrency
+        )
+        logger.info(f"pipelined ({args.concurrency}): {len(listing_id_to_url)} listings in {time.time() - tick:.1f}s")
+    finally:
+        reset_batch_requests()
+        with Session.begin() as session:
+            session.execute(delete(Listing).where(Listing.source == SOURCE))
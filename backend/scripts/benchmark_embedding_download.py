@@ -0,0 +1,140 @@
+# Parses a local fixture of a batch output file (50k lines of 1536-d embeddings by default) served over HTTP and
+# compares the line parsing of the download with json.loads. The server drops the first connection halfway, the
+# download has to resume with a Range request. With --apply, the embeddings are written to synthetic listings with
+# COPY and with ORM executemany (needs a local database).
+import argparse
+import http.server
+import json
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+from domainwizard.models import Listing, OpenAIEmbeddingBatchRequest, Session
+from loguru import logger
+from sqlalchemy import delete, update
+
+from .benchmark_upsert import SOURCE, synthetic_feed
+
+
+def write_fixture(path: Path, listing_ids: list[int], dimensions: int):
+    rng = random.Random(0)
+    with open(path, "w") as output_file:
+        for listing_id in listing_ids:
+            embedding = [round(rng.uniform(-0.1, 0.1), 9) for _ in range(dimensions)]
+            line = {
+                "id": f"batch_req_{listing_id}",
+                "custom_id": f"01JB7ZQ5C8X0R7KSZ4J2W6M3NA:{listing_id}:{SOURCE}-{listing_id}.com",
+                "response": {
+                    "status_code": 200,
+                    "body": {"object": "list", "data": [{"object": "embedding", "index": 0, "embedding": embedding}]},
+                },
+                "error": None,
+            }
+            output_file.write(json.dumps(line) + "\n")
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves one file with support for `Range: bytes=N-`, drops the first connection after `drop_after` bytes"""
+
+    path_to_serve: Path
+    drop_after = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        size = self.path_to_serve.stat().st_size
+        start = 0
+        if range_header := self.headers.get("Range"):
+            start = int(range_header.removeprefix("bytes=").rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        with open(self.path_to_serve, "rb") as served_file:
+            served_file.seek(start)
+            n_sent = 0
+            while chunk := served_file.read(1024 * 1024):
+                if type(self).drop_after and n_sent + len(chunk) > type(self).drop_after:
+                    type(self).drop_after = 0
+                    self.wfile.write(chunk[: len(chunk) // 2])
+                    self.close_connection = True
+                    return
+                self.wfile.write(chunk)
+                n_sent += len(chunk)
+
+
+def download(url: str) -> list[tuple[int, str]]:
+    """The resume loop of `OpenAIEmbeddingBatchRequest.download`, without the database"""
+    rows, offset = [], 0
+    for _ in range(3):
+        try:
+            response = OpenAIEmbeddingBatchRequest._request_output(url, offset)
+            for offset, listing_id, embeddings in OpenAIEmbeddingBatchRequest._yield_embedding_data(response, offset):
+                rows.append((listing_id, embeddings))
+            return rows
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Download interrupted ({type(e).__name__}), resuming from byte {offset}")
+    raise RuntimeError("Download failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=50000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--apply", action="store_true", help="Also write the embeddings into synthetic listings")
+    args = parser.parse_args()
+
+    listing_ids = list(range(1, args.lines + 1))
+    if args.apply:
+        with Session.begin() as session:
+            listing_ids = [
+                listing_id for listing_id, _ in Listing.copy_upsert_batch(session, synthetic_feed(args.lines), SOURCE)
+            ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "output.jsonl"
+        tick = time.perf_counter()
+        write_fixture(path, listing_ids, args.dimensions)
+        size = path.stat().st_size
+        logger.info(f"Wrote {args.lines} lines ({size / 1024**2:.0f} MB) in {time.perf_counter() - tick:.1f}s")
+
+        tick = time.perf_counter()
+        with open(path, "rb") as output_file:
+            for line in output_file:
+                data = json.loads(line)
+                embeddings = data["response"]["body"]["data"][0]["embedding"]
+        logger.info(f"json.loads: {args.lines / (time.perf_counter() - tick):.0f} lines/s (file, no network)")
+
+        handler = type("Handler", (RangeHandler,), {"path_to_serve": path, "drop_after": size // 2})
+        server = http.server.ThreadingHTTPServer(("localhost", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        tick = time.perf_counter()
+        rows = download(f"http://localhost:{server.server_port}/output.jsonl")
+        elapsed = time.perf_counter() - tick
+        assert [listing_id for listing_id, _ in rows] == listing_ids, "lines lost or repeated on resume"
+        logger.info(f"download: {len(rows) / elapsed:.0f} lines/s, {size / 1024**2 / elapsed:.0f} MB/s (with 1 resume)")
+        server.shutdown()
+
+    if args.apply:
+        try:
+            tick = time.perf_counter()
+            with Session.begin() as session:
+                Listing.copy_embeddings(session, rows)
+            logger.info(f"COPY + UPDATE ... FROM: {len(rows) / (time.perf_counter() - tick):.0f} rows/s")
+
+            tick = time.perf_counter()
+            with Session.begin() as session:
+                session.execute(
+                    update(Listing),
+                    [{"id": listing_id, "embeddings": json.loads(embeddings)} for listing_id, embeddings in rows],
+                )
+            logger.info(f"ORM executemany: {len(rows) / (time.perf_counter() - tick):.0f} rows/s")
+        finally:
+            with Session.begin() as session:
+                session.execute(delete(Listing).where(Listing.source == SOURCE))
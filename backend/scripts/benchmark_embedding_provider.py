@@ -0,0 +1,93 @@
+# Throughput of the local embedding provider (names/s per core) and the recall of its rankings against the stored
+# OpenAI embeddings. Run with the OpenAI provider configured (the stored vectors), the local model is loaded here:
+#   python -m scripts.benchmark_embedding_provider --names 100000 --parallel 1 0
+#   python -m scripts.benchmark_embedding_provider --names 0 --recall-searches 50 --recall-listings 100000
+import argparse
+import os
+import random
+import statistics
+import time
+
+import numpy as np
+from domainwizard.integrations.embeddings import LocalEmbeddingProvider, listing_text
+from domainwizard.models import DomainSearch, Listing, Session
+from loguru import logger
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import cast, func, select
+
+from .benchmark_feeds import domain_name
+
+
+def normalized(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
+def throughput(model: str, n_names: int, parallel: int):
+    rng = random.Random(0)
+    names = [listing_text(f"{domain_name(rng.randrange(10**9))}.com") for _ in range(n_names)]
+    # one thread per process, so that the throughput per core is comparable
+    provider = LocalEmbeddingProvider(model=model, parallel=None if parallel == 1 else parallel, threads=1)
+    # loads the model outside of the measurement
+    provider.embed(names[:1])
+    tick = time.perf_counter()
+    provider.embed(names)
+    elapsed = time.perf_counter() - tick
+    n_cores = (os.cpu_count() or 1) if parallel == 0 else parallel
+    logger.info(
+        f"{model} ({parallel or 'all'} processes): {n_names / elapsed:.0f} names/s, "
+        f"{n_names / elapsed / n_cores:.0f} names/s per core"
+    )
+
+
+def recall(model: str, n_searches: int, n_listings: int, k: int):
+    """Overlap of the local and the OpenAI top k listings of saved searches, over a sample of embedded listings"""
+    with Session.begin() as session:
+        listings = session.execute(
+            select(Listing.url, cast(Listing.embeddings, Vector(1536)))
+            .where(Listing.embeddings.is_not(None))
+            .order_by(func.random())
+            .limit(n_listings)
+        ).all()
+        searches = session.execute(
+            select(DomainSearch.prompt, DomainSearch.embeddings)
+            .where(DomainSearch.embeddings.is_not(None))
+            .order_by(func.random())
+            .limit(n_searches)
+        ).all()
+
+    provider = LocalEmbeddingProvider(model=model, parallel=0)
+    openai_listings = normalized([embeddings for _, embeddings in listings])
+    openai_searches = normalized([embeddings for _, embeddings in searches])
+    tick = time.perf_counter()
+    local_listings = normalized(provider.embed([listing_text(url) for url, _ in listings]))
+    local_searches = normalized(provider.embed([prompt for prompt, _ in searches]))
+    logger.info(f"Embedded {len(listings)} listings & {len(searches)} prompts in {time.perf_counter() - tick:.1f}s")
+
+    k = min(k, len(listings))
+    recalls = []
+    for openai_query, local_query in zip(openai_searches, local_searches):
+        expected = set(np.argpartition(-(openai_listings @ openai_query), k - 1)[:k])
+        actual = set(np.argpartition(-(local_listings @ local_query), k - 1)[:k])
+        recalls.append(len(expected & actual) / k)
+    logger.info(
+        f"{model} recall@{k} vs OpenAI over {len(listings)} listings: "
+        f"mean {statistics.mean(recalls):.3f}, min {min(recalls):.3f}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="BAAI/bge-small-en-v1.5")
+    parser.add_argument("--names", type=int, default=100_000)
+    parser.add_argument("--parallel", type=int, nargs="*", default=[1, 0], help="Process counts, 0: one per core")
+    parser.add_argument("--recall-searches", type=int, default=0, help="Number of saved searches (needs a database)")
+    parser.add_argument("--recall-listings", type=int, default=100_000)
+    parser.add_argument("--k", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.names:
+        for parallel in args.parallel:
+            throughput(args.model, args.names, parallel)
+    if args.recall_searches:
+        recall(args.model, args.recall_searches, args.recall_listings, args.k)
@@ -0,0 +1,163 @@
+# Serves synthetic GoDaddy / Namecheap feeds from a local HTTP server and measures end-to-end items/s of the adapters
+import argparse
+import csv
+import datetime as dt
+import functools
+import http.server
+import json
+import random
+import string
+import tempfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+from typing import Iterator
+
+from domainwizard.integrations.data import GodaddyAdapter, NamecheapAdapter
+from loguru import logger
+
+
+def domain_name(i: int) -> str:
+    # letters only, the adapters filter out names with three or more digits
+    name = ""
+    while True:
+        i, remainder = divmod(i, 26)
+        name += string.ascii_lowercase[remainder]
+        if not i:
+            return name
+
+
+def end_time(rng: random.Random) -> str:
+    # auctions end on full minutes within the next week
+    now = dt.datetime.now(dt.UTC).replace(second=0, microsecond=0)
+    return (now + dt.timedelta(minutes=rng.randint(1, 7 * 24 * 60))).isoformat()
+
+
+def godaddy_items(n_rows: int, rng: random.Random) -> Iterator[dict]:
+    for i in range(n_rows):
+        yield {
+            "domainName": f"{domain_name(i).capitalize()}.com",
+            "link": f"https://auctions.godaddy.com/trpItemListing.aspx?domain={domain_name(i)}.com",
+            "auctionType": "Bid",
+            "auctionEndTime": end_time(rng),
+            "price": f"${rng.randint(1, 10000)}",
+            "numberOfBids": rng.randint(0, 50),
+            "domainAge": rng.randint(0, 30),
+            "pageviews": rng.randint(0, 1000),
+            "valuation": f"${rng.randint(0, 100000)}",
+            "monthlyParkingRevenue": "$0",
+            "isAdult": False,
+        }
+
+
+NAMECHEAP_FIELDNAMES = [
+    "name",
+    "url",
+    "endDate",
+    "price",
+    "bidCount",
+    "registeredDate",
+    "lastSoldPrice",
+    "estibotValue",
+]
+
+
+def namecheap_rows(n_rows: int, rng: random.Random) -> Iterator[dict]:
+    # all values are strings, like the rows of the csv.DictReader
+    for i in range(n_rows):
+        yield {
+            "name": f"{domain_name(i)}.net",
+            "url": f"https://www.namecheap.com/market/{domain_name(i)}.net",
+            "endDate": end_time(rng),
+            "price": f"{rng.uniform(1, 10000):.2f}",
+            "bidCount": str(rng.randint(0, 50)),
+            "registeredDate": f"{rng.randint(1995, 2023)}-05-01T00:00:00",
+            "lastSoldPrice": "",
+            "estibotValue": str(rng.randint(0, 100000)),
+        }
+
+
+def write_godaddy_feed(path: Path, n_rows: int, rng: random.Random):
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open("all_listings.json", "w") as json_file:
+            json_file.write(b'{"meta": {}, "data": [')
+            for i, item in enumerate(godaddy_items(n_rows, rng)):
+                json_file.write((b"," if i else b"") + json.dumps(item).encode())
+            json_file.write(b"]}")
+
+
+def write_namecheap_feed(path: Path, n_rows: int, rng: random.Random):
+    with open(path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=NAMECHEAP_FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(namecheap_rows(n_rows, rng))
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory: Path) -> http.server.ThreadingHTTPServer:
+    handler = functools.partial(QuietHandler, directory=str(directory))
+    server = http.server.ThreadingHTTPServer(("localhost", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="*",
+        default=[0, 2, 4],
+        help="Process pool sizes of the columnar runs (0: transform in the main process)",
+    )
+    parser.add_argument("--unordered", action="store_true")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        write_godaddy_feed(directory / "all_listings.json.zip", args.rows, rng)
+        write_namecheap_feed(directory / "Namecheap_Market_Sales.csv", args.rows, rng)
+        server = serve(directory)
+        base_url = f"http://localhost:{server.server_port}"
+
+        for Adapter, filename in [
+            (GodaddyAdapter, "all_listings.json.zip"),
+            (NamecheapAdapter, "Namecheap_Market_Sales.csv"),
+        ]:
+            adapter = Adapter()
+            adapter.url = f"{base_url}/{filename}"
+            tick = time.perf_counter()
+            n_items = sum(1 for _ in adapter.timed_listings_data())
+            elapsed = time.perf_counter() - tick
+            logger.info(
+                f"{adapter.name}: {n_items} items in {elapsed:.2f}s ({n_items / elapsed:.0f} items/s), "
+                f"download wait {adapter.timings['download']:.2f}s"
+            )
+            for workers in args.workers:
+                batch_adapter = Adapter()
+                batch_adapter.url = adapter.url
+                tick = time.perf_counter()
+                batches = batch_adapter.timed_listing_batches(workers=workers, ordered=not args.unordered)
+                n_items = sum(len(columns["url"]) for columns in batches)
+                elapsed = time.perf_counter() - tick
+                logger.info(
+                    f"{adapter.name} (columnar, {workers} workers): {n_items} items in {elapsed:.2f}s "
+                    f"({n_items / elapsed:.0f} items/s)"
+                )
+            # a second request with the stored validators is answered with 304 Not Modified
+            unchanged_adapter = Adapter(etag=adapter.etag, last_modified=adapter.last_modified)
+            unchanged_adapter.url = adapter.url
+            tick = time.perf_counter()
+            n_items = sum(1 for _ in unchanged_adapter.timed_listings_data())
+            logger.info(
+                f"{adapter.name} (unchanged): {n_items} items in {time.perf_counter() - tick:.3f}s, "
+                f"not modified: {unchanged_adapter.not_modified}"
+            )
+        server.shutdown()
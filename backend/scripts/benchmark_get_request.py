@@ -0,0 +1,45 @@
+# Load benchmark for GET /api/requests/{uuid} against a running backend (e.g. `python main.py` on a local Postgres)
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from domainwizard.config import config
+from domainwizard.models import DomainSearch, Session
+from loguru import logger
+
+
+def timed_get(http: requests.Session, url: str) -> float:
+    tick = time.perf_counter()
+    response = http.get(url, timeout=30)
+    response.raise_for_status()
+    return time.perf_counter() - tick
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default=f"http://localhost:{config.get('FASTAPI_PORT', 8000)}")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    with Session.begin() as session:
+        uuids = [domain_search.uuid for domain_search in DomainSearch.get_all(session)]
+    if not uuids:
+        raise ValueError("No domain searches in the database to benchmark against")
+
+    urls = [f"{args.base_url}/api/requests/{uuids[i % len(uuids)]}" for i in range(args.requests)]
+    http = requests.Session()
+    http.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+
+    tick = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = list(executor.map(lambda url: timed_get(http, url), urls))
+    elapsed = time.perf_counter() - tick
+
+    percentiles = statistics.quantiles(latencies, n=100)
+    logger.info(
+        f"{args.requests} requests with concurrency {args.concurrency} in {elapsed:.2f}s "
+        f"({args.requests / elapsed:.1f} req/s): p50={percentiles[49] * 1000:.1f}ms p99={percentiles[98] * 1000:.1f}ms"
+    )
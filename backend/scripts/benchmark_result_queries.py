@@ -0,0 +1,62 @@
+# Counts the SQL statements and the time per domain search result fetch against the database of DB_URL
+import argparse
+import asyncio
+import time
+
+from domainwizard.models import (
+    AsyncSession,
+    DomainSearch,
+    Session,
+    async_engine,
+    engine,
+)
+from loguru import logger
+from sqlalchemy import event, select
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+async def afetch_results(domain_search_ids: list[int], counter: StatementCounter) -> float:
+    tick = time.perf_counter()
+    for domain_search_id in domain_search_ids:
+        async with AsyncSession() as session:
+            domain_search = await session.get(DomainSearch, domain_search_id)
+            counter.count = 0
+            await domain_search.aget_result(session)
+            assert counter.count == 1, f"aget_result of {domain_search_id} took {counter.count} statements"
+    return time.perf_counter() - tick
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--searches", type=int, default=100, help="Number of domain searches to fetch")
+    args = parser.parse_args()
+
+    with Session.begin() as session:
+        domain_search_ids = session.scalars(select(DomainSearch.id).limit(args.searches)).all()
+    if not domain_search_ids:
+        raise ValueError("No domain searches in the database to benchmark against")
+
+    counter = StatementCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", counter)
+
+    tick = time.perf_counter()
+    for domain_search_id in domain_search_ids:
+        with Session() as session:
+            domain_search = session.get(DomainSearch, domain_search_id)
+            counter.count = 0
+            domain_search.get_result(session)
+            # one joined select of the listings and their scores
+            assert counter.count == 1, f"get_result of {domain_search_id} took {counter.count} statements"
+    elapsed = time.perf_counter() - tick
+    logger.info(f"get_result: 1 statement per search, {elapsed / len(domain_search_ids) * 1000:.1f}ms per search")
+
+    elapsed = asyncio.run(afetch_results(domain_search_ids, counter))
+    logger.info(f"aget_result: 1 statement per search, {elapsed / len(domain_search_ids) * 1000:.1f}ms per search")
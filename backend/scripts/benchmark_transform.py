@@ -0,0 +1,45 @@
+# Micro-benchmark of the row by row and the columnar transform of the feed adapters (no download, no database)
+import argparse
+import random
+import time
+
+from domainwizard.integrations.data import GodaddyAdapter, NamecheapAdapter
+from domainwizard.integrations.data.domains import DomainAdapter
+from domainwizard.models import Listing
+from loguru import logger
+
+from .benchmark_feeds import godaddy_items, namecheap_rows
+
+
+def benchmark(adapter: DomainAdapter, items: list[dict], batch_size: int):
+    """Transforms the items into the rows written by the COPY ingest, row by row and in column batches"""
+    # feed the fixture items instead of downloading the feed
+    adapter.yield_raw_items = lambda: iter(items)
+
+    tick = time.perf_counter()
+    row_mode = Listing.copy_rows(adapter.yield_listings_data())
+    row_seconds = time.perf_counter() - tick
+
+    tick = time.perf_counter()
+    columnar = [
+        row for columns in adapter.yield_listing_batches(batch_size) for row in Listing.column_copy_rows(columns)
+    ]
+    columnar_seconds = time.perf_counter() - tick
+
+    assert sorted(row_mode) == sorted(columnar), f"{adapter.name}: the transforms disagree"
+    logger.info(
+        f"{adapter.name}: row {row_seconds:.2f}s ({len(items) / row_seconds:.0f} items/s), "
+        f"columnar {columnar_seconds:.2f}s ({len(items) / columnar_seconds:.0f} items/s), "
+        f"speedup {row_seconds / columnar_seconds:.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    benchmark(GodaddyAdapter(), list(godaddy_items(args.rows, rng)), args.batch_size)
+    benchmark(NamecheapAdapter(), list(namecheap_rows(args.rows, rng)), args.batch_size)
@@ -0,0 +1,59 @@
+# Compares rows/s and peak RSS of the ORM and the COPY upsert paths on a synthetic feed.
+# Run each path in its own process (peak RSS is per process), against a local database:
+#   python -m scripts.benchmark_upsert --path copy --rows 2000000
+import argparse
+import datetime as dt
+import random
+import resource
+import time
+
+from domainwizard.models import Listing, Session
+from loguru import logger
+from sqlalchemy import delete
+
+SOURCE = "benchmark"
+
+
+def synthetic_feed(n_rows: int, seed: int = 0):
+    rng = random.Random(seed)
+    now = dt.datetime.now(dt.UTC)
+    for i in range(n_rows):
+        url = f"{SOURCE}-{i}.com"
+        yield {
+            "url": url,
+            "link": f"https://{SOURCE}.example/{url}",
+            "auction_type": "Bid",
+            "auction_end_time": now + dt.timedelta(hours=rng.randint(1, 240)),
+            "price": rng.randint(1, 10000),
+            "number_of_bids": rng.randint(0, 50),
+            "domain_age": rng.randint(0, 30),
+            "pageviews": rng.randint(0, 1000),
+            "valuation": rng.randint(0, 100000),
+            "monthly_parking_revenue": None,
+            "is_adult": False,
+            "source": SOURCE,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", choices=["copy", "orm"], default="copy")
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic listings (e.g. to benchmark updates)")
+    args = parser.parse_args()
+
+    upsert_batch = Listing.copy_upsert_batch if args.path == "copy" else Listing.upsert_batch
+    tick = time.time()
+    with Session.begin() as session:
+        n_new = sum(1 for _ in upsert_batch(session, synthetic_feed(args.rows), SOURCE))
+    elapsed = time.time() - tick
+    # ru_maxrss is in KiB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    logger.info(
+        f"{args.path}: {args.rows} rows ({n_new} new) in {elapsed:.1f}s, "
+        f"{args.rows / elapsed:.0f} rows/s, peak RSS {peak_rss_mb:.0f} MB"
+    )
+
+    if not args.keep:
+        with Session.begin() as session:
+            session.execute(delete(Listing).where(Listing.url.like(f"{SOURCE}-%")))
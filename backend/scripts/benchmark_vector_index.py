@@ -0,0 +1,45 @@
+# Compares latency and recall@k of the vector index backends, using the exact numpy search as ground truth
+import argparse
+import statistics
+import time
+
+from domainwizard.models import DomainSearch, NumpyVectorIndex, Session, VectorIndexes
+from loguru import logger
+from sqlalchemy import func, select
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", nargs="+", default=list(VectorIndexes), choices=list(VectorIndexes))
+    parser.add_argument("--queries", type=int, default=50, help="Number of saved searches used as queries")
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    with Session.begin() as session:
+        query_embeddings = session.scalars(
+            select(DomainSearch.embeddings)
+            .where(DomainSearch.embeddings.is_not(None))
+            .order_by(func.random())
+            .limit(args.queries)
+        ).all()
+
+        exact_index = NumpyVectorIndex()
+        exact_index.load(session)
+        ground_truth = [
+            {listing_id for listing_id, _ in exact_index.search(session, embeddings, args.limit)}
+            for embeddings in query_embeddings
+        ]
+
+        for name in args.backends:
+            index = exact_index if name == NumpyVectorIndex.name else VectorIndexes[name]()
+            index.search(session, query_embeddings[0], args.limit)  # warm up / load
+            latencies, recalls = [], []
+            for embeddings, expected in zip(query_embeddings, ground_truth):
+                tick = time.perf_counter()
+                result = index.search(session, embeddings, args.limit)
+                latencies.append(time.perf_counter() - tick)
+                recalls.append(len(expected & {listing_id for listing_id, _ in result}) / max(len(expected), 1))
+            percentiles = statistics.quantiles(latencies, n=100)
+            logger.info(
+                f"{name}: p50={percentiles[49] * 1000:.1f}ms p99={percentiles[98] * 1000:.1f}ms "
+                f"recall@{args.limit}={statistics.mean(recalls):.3f}"
+            )
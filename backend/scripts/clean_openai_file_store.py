@@ -6,11 +6,20 @@ from loguru import logger
 
 client = openai.Client(api_key=config["OPENAI_API_KEY"])
 
-if __name__ == "__main__":
+
+def clean_file_store(max_age_days: int = 7) -> int:
+    """Deletes the files uploaded to OpenAI more than `max_age_days` days ago, returns their number"""
     now = dt.datetime.now(dt.UTC)
+    n_deleted = 0
     file_response = client.files.list()
     for file in file_response:
         file_created_at = dt.datetime.fromtimestamp(file.created_at, dt.UTC)
-        if (now - file_created_at).days > 7:
+        if (now - file_created_at).days > max_age_days:
             logger.info(f"Deleting file {file.id} created at {file_created_at}")
             client.files.delete(file.id)
+            n_deleted += 1
+    return n_deleted
+
+
+if __name__ == "__main__":
+    clean_file_store()
@@ -1,5 +1,98 @@
-from domainwizard.models import ListingIndex, engine
+# (Re)builds an ANN index on listings.embeddings without downtime:
+# the new index is built CONCURRENTLY under a temporary name, swapped in by renaming and the old one dropped CONCURRENTLY.
+import argparse
+import time
 
-# Create the index
-ListingIndex.drop(engine)
-ListingIndex.create(engine)
+from domainwizard.models import EMBEDDING_DIMENSIONS, LISTING_INDEX_NAME, engine
+from loguru import logger
+from psycopg2.errors import LockNotAvailable
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+# indexes replaced by LISTING_INDEX_NAME
+LEGACY_INDEX_NAMES = ["ivfflat_index"]
+# the swap waits this long for its locks before giving way to the queries queued behind it
+SWAP_LOCK_TIMEOUT = "2s"
+SWAP_ATTEMPTS = 10
+
+
+def index_definition(quantization: str | None, dimensions: int | None) -> tuple[str, str]:
+    """
+    Returns the name and the indexed expression with its operator class
+
+    The expressions have to match `Listing.coarse_distance` for the planner to use the index.
+    """
+    if quantization == "binary":
+        expression = f"(binary_quantize(embeddings)::bit({EMBEDDING_DIMENSIONS})) bit_hamming_ops"
+        return f"{LISTING_INDEX_NAME}_binary", expression
+    elif dimensions:
+        expression = f"(l2_normalize(subvector(embeddings, 1, {dimensions}))::halfvec({dimensions})) halfvec_cosine_ops"
+        return f"{LISTING_INDEX_NAME}_{dimensions}d", expression
+    return LISTING_INDEX_NAME, "embeddings halfvec_cosine_ops"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    parser.add_argument("--m", type=int, default=16, help="hnsw: max connections per layer")
+    parser.add_argument("--ef-construction", type=int, default=64, help="hnsw: size of the candidate list on build")
+    parser.add_argument("--lists", type=int, help="ivfflat: number of lists (default: rows / 1000, min. 100)")
+    parser.add_argument("--quantization", choices=["binary"], help="index the binary quantized embeddings")
+    parser.add_argument("--dimensions", type=int, help="index the embeddings truncated to this many dimensions")
+    args = parser.parse_args()
+
+    index_name, expression = index_definition(args.quantization, args.dimensions)
+    with engine.connect() as connection:
+        if args.method == "hnsw":
+            parameters = f"m = {args.m}, ef_construction = {args.ef_construction}"
+        else:
+            lists = args.lists
+            if lists is None:
+                n_listings = connection.scalar(text("SELECT count(*) FROM listings WHERE embeddings IS NOT NULL"))
+                lists = max(100, n_listings // 1000)
+            parameters = f"lists = {lists}"
+
+        new_index_name = f"{index_name}_{int(time.time())}"
+        logger.info(f"Building {args.method} index {new_index_name} on {expression} ({parameters})")
+        tick = time.time()
+        try:
+            connection.execute(
+                text(
+                    f"CREATE INDEX CONCURRENTLY {new_index_name} ON listings "
+                    f"USING {args.method} ({expression}) WITH ({parameters}) WHERE embeddings IS NOT NULL"
+                )
+            )
+        except Exception:
+            # a failed concurrent build leaves an invalid index behind
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {new_index_name}"))
+            raise
+        logger.info(f"Built {new_index_name} in {time.time() - tick:.0f}s")
+
+    old_index_names = [index_name] + (LEGACY_INDEX_NAMES if index_name == LISTING_INDEX_NAME else [])
+    retired_index_names = [f"{old_index_name}_retired_{int(time.time())}" for old_index_name in old_index_names]
+    # renaming only takes a SHARE UPDATE EXCLUSIVE lock, reads and writes of the listings go on during the swap.
+    # The engine runs in autocommit mode, run the swap in an explicit transaction
+    with engine.connect().execution_options(isolation_level="READ COMMITTED") as connection:
+        for attempt in range(1, SWAP_ATTEMPTS + 1):
+            try:
+                with connection.begin():
+                    connection.execute(text(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'"))
+                    for old_index_name, retired_index_name in zip(old_index_names, retired_index_names):
+                        connection.execute(
+                            text(f"ALTER INDEX IF EXISTS {old_index_name} RENAME TO {retired_index_name}")
+                        )
+                    connection.execute(text(f"ALTER INDEX {new_index_name} RENAME TO {index_name}"))
+                break
+            except OperationalError as e:
+                if not isinstance(e.orig, LockNotAvailable) or attempt == SWAP_ATTEMPTS:
+                    raise
+                logger.warning(f"Swap of {new_index_name} timed out waiting for a lock, attempt {attempt}")
+                time.sleep(attempt)
+    logger.info(f"Swapped in {new_index_name} as {index_name}")
+
+    # DROP INDEX CONCURRENTLY cannot run in a transaction and waits for the queries using the index instead of
+    # locking the listings
+    with engine.connect() as connection:
+        for retired_index_name in retired_index_names:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {retired_index_name}"))
+    logger.info(f"Dropped {', '.join(old_index_names)}")
@@ -0,0 +1,115 @@
+# Minimal stand-in for the OpenAI embeddings, files & batches endpoints, with simulated latency, to exercise the batch request
+# submission locally:
+#   python -m scripts.fake_openai_server --port 8089 --latency 0.5
+#   OPENAI_BASE_URL=http://localhost:8089/v1 python -m scripts.benchmark_batch_requests
+import argparse
+import http.server
+import json
+import random
+import threading
+import time
+
+import ulid
+from loguru import logger
+
+
+def fake_embedding(text: str, dimensions: int = 1536) -> list[float]:
+    rng = random.Random(text)
+    return [rng.uniform(-1, 1) for _ in range(dimensions)]
+
+
+class FakeOpenAIHandler(http.server.BaseHTTPRequestHandler):
+    # seconds per request, and upload bandwidth in bytes/s
+    latency = 0.5
+    bandwidth = 50 * 1024 * 1024
+    # share of the embedding requests answered with 429
+    error_rate = 0.0
+    batches: dict[str, dict] = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency + len(body) / self.bandwidth)
+        now = int(time.time())
+        if self.path == "/v1/files":
+            self.respond(
+                {
+                    "id": f"file-{ulid.ULID()}",
+                    "object": "file",
+                    "bytes": len(body),
+                    "created_at": now,
+                    "filename": "batch.jsonl",
+                    "purpose": "batch",
+                    "status": "processed",
+                }
+            )
+        elif self.path == "/v1/embeddings":
+            if random.random() < self.error_rate:
+                self.respond({"error": {"message": "Rate limit reached", "type": "requests"}}, status=429)
+                return
+            request = json.loads(body)
+            inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+            self.respond(
+                {
+                    "object": "list",
+                    "model": request["model"],
+                    "data": [
+                        {"object": "embedding", "index": i, "embedding": fake_embedding(text)}
+                        for i, text in enumerate(inputs)
+                    ],
+                    "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+                }
+            )
+        elif self.path == "/v1/batches":
+            request = json.loads(body)
+            batch = {
+                "id": f"batch_{ulid.ULID()}",
+                "object": "batch",
+                "endpoint": request["endpoint"],
+                "input_file_id": request["input_file_id"],
+                "completion_window": request["completion_window"],
+                "status": "in_progress",
+                "created_at": now,
+            }
+            self.batches[batch["id"]] = batch
+            self.respond(batch)
+        else:
+            self.respond({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        batch_id = self.path.removeprefix("/v1/batches/")
+        if batch_id in self.batches:
+            self.respond(self.batches[batch_id])
+        else:
+            self.respond({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+    def respond(self, data: dict, status: int = 200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def serve(port: int = 0, latency: float = 0.5, error_rate: float = 0.0) -> http.server.ThreadingHTTPServer:
+    """Starts the fake server in a background thread, port 0 picks a free port"""
+    handler = type("Handler", (FakeOpenAIHandler,), {"latency": latency, "error_rate": error_rate, "batches": {}})
+    server = http.server.ThreadingHTTPServer(("localhost", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of embedding requests failing with 429")
+    args = parser.parse_args()
+
+    server = serve(args.port, args.latency, args.error_rate)
+    logger.info(f"Fake OpenAI server listening on http://localhost:{server.server_port}/v1")
+    threading.Event().wait()
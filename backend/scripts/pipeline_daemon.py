@@ -0,0 +1,405 @@
+import argparse
+import contextlib
+import datetime as dt
+import os
+import signal
+import socket
+import threading
+import traceback
+from typing import Callable, Optional
+
+from domainwizard.integrations.data import Adapters
+from domainwizard.integrations.embeddings import (
+    EMBEDDING_RPM,
+    EMBEDDING_TPM,
+    LocalEmbeddingProvider,
+    RateLimiter,
+    embedding_provider,
+)
+from domainwizard.models import (
+    BatchRequestStatus,
+    DataUpdate,
+    DomainSearch,
+    Listing,
+    OpenAIEmbeddingBatchRequest,
+    PipelineJob,
+    PipelineStage,
+    Session,
+)
+from loguru import logger
+from sqlalchemy import select, text
+
+from .clean_openai_file_store import clean_file_store
+from .process_batch_requests import update_domain_searches
+from .upsert_data import ingest
+
+
+class Postpone(Exception):
+    """Raised by a stage to put its job back into the queue for `delay` seconds without counting it as a failure"""
+
+    def __init__(self, delay: float, reason: str):
+        super().__init__(reason)
+        self.delay = delay
+
+
+class LeaseLost(Exception):
+    """Raised by a stage at a safe point once another worker took over its job, the job row is left alone"""
+
+
+class PipelineDaemon:
+    """
+    Moves the listings through the stages ingested → submitted → completed → embedded → ranked
+
+    Each stage has its own worker threads claiming the due jobs of the stage from the `pipeline_jobs` table. The
+    periodic jobs (ingest per source, poll, clean) enqueue their next run when they finish, the others are enqueued by
+    the stage before them. Backpressure: the feeds are not ingested while too many listings wait for a batch request,
+    and no batch requests are created while too many are open at OpenAI.
+
+    With the local embedding provider or `embedding_mode="online"` the listings are embedded while they are ingested
+    and ranked right after, the batch request stages (submit, poll, download) do not run. A running job renews its
+    lease every `lease / 4` seconds, so only the jobs of dead workers are taken over.
+    """
+
+    def __init__(
+        self,
+        ingest_concurrency: int = 2,
+        download_parallelism: int = 4,
+        parse_workers: int = 0,
+        ingest_interval: float = 900,
+        poll_interval: float = 60,
+        clean_interval: float = 3600,
+        max_unsubmitted: int = 1000000,
+        max_open_batches: int = 10,
+        batch_size: int = 50000,
+        batch_request_concurrency: int = 4,
+        poll_concurrency: int = 8,
+        chunk_size: int = 200,
+        lease: float = 600,
+        max_attempts: int = 5,
+        idle_interval: float = 5,
+        embedding_mode: str = "batch",
+    ):
+        # the batch requests would write OpenAI embeddings, which do not fit the columns of a local provider
+        self.embed_on_ingest = embedding_mode == "online" or embedding_provider.name == LocalEmbeddingProvider.name
+        self.online = embedding_mode == "online" and embedding_provider.name != LocalEmbeddingProvider.name
+        batch_concurrency = 0 if self.embed_on_ingest else 1
+        self.concurrency = {
+            PipelineStage.INGEST: ingest_concurrency,
+            PipelineStage.SUBMIT: batch_concurrency,
+            PipelineStage.POLL: batch_concurrency,
+            PipelineStage.DOWNLOAD: 0 if self.embed_on_ingest else download_parallelism,
+            PipelineStage.RANK: 1,
+            PipelineStage.CLEAN: 1,
+        }
+        self.handlers: dict[PipelineStage, Callable[[PipelineJob], Optional[float]]] = {
+            PipelineStage.INGEST: self.ingest,
+            PipelineStage.SUBMIT: self.submit,
+            PipelineStage.POLL: self.poll,
+            PipelineStage.DOWNLOAD: self.download,
+            PipelineStage.RANK: self.rank,
+            PipelineStage.CLEAN: self.clean,
+        }
+        self.adapters = {Adapter.name: Adapter for Adapter in Adapters}
+        self.ingest_concurrency = ingest_concurrency
+        self.parse_workers = parse_workers
+        self.ingest_interval = ingest_interval
+        self.poll_interval = poll_interval
+        self.clean_interval = clean_interval
+        self.max_unsubmitted = max_unsubmitted
+        self.max_open_batches = max_open_batches
+        self.batch_size = batch_size
+        self.batch_request_concurrency = batch_request_concurrency
+        self.poll_concurrency = poll_concurrency
+        self.chunk_size = chunk_size
+        self.lease = dt.timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+        self.idle_interval = idle_interval
+        self.stopping = threading.Event()
+        # set by the heartbeat of a job once its lease is lost, per job id
+        self.lost_leases: dict[int, threading.Event] = {}
+
+    def seed(self):
+        """Enqueues the periodic jobs, a no-op for the ones still queued from an earlier run"""
+        with Session.begin() as session:
+            for source in self.adapters:
+                PipelineJob.enqueue(session, PipelineStage.INGEST, f"ingest:{source}", {"source": source})
+            if not self.embed_on_ingest:
+                PipelineJob.enqueue(session, PipelineStage.SUBMIT, "submit")
+                PipelineJob.enqueue(session, PipelineStage.POLL, "poll")
+            PipelineJob.enqueue(session, PipelineStage.CLEAN, "clean")
+
+    def ingest(self, job: PipelineJob) -> Optional[float]:
+        adapter = self.adapters[job.payload["source"]]()
+        if self.embed_on_ingest:
+            # the sources are embedded in their own event loops, the limits are split like in `upsert_data`
+            rate_limiter = (
+                RateLimiter(EMBEDDING_RPM / self.ingest_concurrency, EMBEDDING_TPM / self.ingest_concurrency)
+                if self.online
+                else None
+            )
+            _, embedded_listing_ids = ingest(
+                adapter,
+                Listing.copy_upsert_column_batches,
+                columnar=True,
+                parse_workers=self.parse_workers,
+                rate_limiter=rate_limiter,
+            )
+            self.ensure_leased(job)
+            if embedded_listing_ids:
+                with Session.begin() as session:
+                    PipelineJob.enqueue(
+                        session, PipelineStage.RANK, f"rank:ingest:{job.id}", {"listing_ids": embedded_listing_ids}
+                    )
+            return self.ingest_interval
+
+        with Session.begin() as session:
+            n_unsubmitted = Listing.get_unsubmitted_count(session)
+        if n_unsubmitted > self.max_unsubmitted:
+            raise Postpone(self.poll_interval, f"{n_unsubmitted} listings wait for a batch request")
+        ingest(
+            adapter, Listing.copy_upsert_column_batches, columnar=True, parse_workers=self.parse_workers, embed=False
+        )
+        self.ensure_leased(job)
+        with Session.begin() as session:
+            PipelineJob.enqueue(session, PipelineStage.SUBMIT, "submit")
+        return self.ingest_interval
+
+    def submit(self, job: PipelineJob) -> Optional[float]:
+        with Session.begin() as session:
+            n_open = OpenAIEmbeddingBatchRequest.get_open_count(session)
+            if n_open >= self.max_open_batches:
+                raise Postpone(self.poll_interval, f"{n_open} batch requests are open")
+            listing_id_to_url = Listing.get_unsubmitted(session, (self.max_open_batches - n_open) * self.batch_size)
+        if not listing_id_to_url:
+            return None
+        OpenAIEmbeddingBatchRequest.submit_batch_requests(
+            Session, listing_id_to_url, self.batch_size, self.batch_request_concurrency
+        )
+        with Session.begin() as session:
+            # listings ingested in the meantime, or more than the open batch requests could take
+            n_unsubmitted = Listing.get_unsubmitted_count(session)
+        return 0 if n_unsubmitted else None
+
+    def poll(self, job: PipelineJob) -> Optional[float]:
+        with Session.begin() as session:
+            OpenAIEmbeddingBatchRequest.update_processing(session, concurrency=self.poll_concurrency)
+            # also the batch requests completed before a restart
+            completed_batch_request_ids = session.scalars(
+                select(OpenAIEmbeddingBatchRequest.id).where(
+                    OpenAIEmbeddingBatchRequest.status == BatchRequestStatus.COMPLETED
+                )
+            ).all()
+            for batch_request_id in completed_batch_request_ids:
+                PipelineJob.enqueue(
+                    session,
+                    PipelineStage.DOWNLOAD,
+                    f"download:{batch_request_id}",
+                    {"batch_request_id": batch_request_id},
+                )
+        return self.poll_interval
+
+    def download(self, job: PipelineJob) -> Optional[float]:
+        batch_request_id = job.payload["batch_request_id"]
+        with Session.begin() as session:
+            batch_request = session.get(OpenAIEmbeddingBatchRequest, batch_request_id)
+            status = batch_request.status
+        # a retry after the embeddings were written only enqueues the ranking
+        if status == BatchRequestStatus.COMPLETED:
+            batch_request.download(Session)
+        self.ensure_leased(job)
+        with Session.begin() as session:
+            PipelineJob.enqueue(
+                session, PipelineStage.RANK, f"rank:{batch_request_id}", {"batch_request_ids": [batch_request_id]}
+            )
+            # the finalized batch request makes room for new ones
+            PipelineJob.enqueue(session, PipelineStage.SUBMIT, "submit")
+        return None
+
+    def rank(self, job: PipelineJob) -> Optional[float]:
+        payload = dict(job.payload)
+
+        def checkpoint(last_domain_search_id: int):
+            payload["after_id"] = last_domain_search_id
+            with Session.begin() as session:
+                if not PipelineJob.checkpoint(session, job.id, job.locked_by, payload):
+                    raise LeaseLost(f"{job.key} was taken over by another worker")
+
+        update_domain_searches(
+            payload.get("batch_request_ids", []),
+            self.chunk_size,
+            after_id=payload.get("after_id", 0),
+            on_chunk=checkpoint,
+            listing_ids=payload.get("listing_ids", []),
+        )
+        return None
+
+    def clean(self, job: PipelineJob) -> Optional[float]:
+        with Session.begin() as session:
+            Listing.delete_expired(session)
+        with Session.begin() as session:
+            listing_count = Listing.get_active_listings_count(session)
+            domain_search_count = DomainSearch.get_count(session)
+            session.add(DataUpdate(listing_count=listing_count, domain_search_count=domain_search_count))
+        with Session.begin() as session:
+            session.execute(text("VACUUM (ANALYZE) listings"))
+            session.execute(text("VACUUM (ANALYZE) listings_to_domain_searches_rel"))
+        clean_file_store()
+        with Session.begin() as session:
+            PipelineJob.prune(session)
+            queue_depths = PipelineJob.queue_depths(session)
+        logger.info("Open pipeline jobs: " + ", ".join(f"{stage.name} {n}" for stage, n in queue_depths.items()))
+        return self.clean_interval
+
+    def ensure_leased(self, job: PipelineJob):
+        """Raises `LeaseLost` if another worker took over `job`, called by the stages before their follow-up jobs"""
+        if self.lost_leases[job.id].is_set():
+            raise LeaseLost(f"{job.key} was taken over by another worker")
+
+    @contextlib.contextmanager
+    def leased(self, job: PipelineJob, worker: str):
+        """Renews the lease of `job` in a background thread while the block runs"""
+        done = threading.Event()
+        lost = self.lost_leases[job.id] = threading.Event()
+
+        def heartbeat():
+            while not done.wait(self.lease.total_seconds() / 4):
+                try:
+                    with Session.begin() as session:
+                        if not PipelineJob.heartbeat(session, job.id, worker):
+                            logger.warning(f"{worker} lost the lease of {job.key}")
+                            lost.set()
+                            return
+                except Exception:  # pylint: disable=broad-exception-caught
+                    logger.exception(f"{worker} could not renew the lease of {job.key}")
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+            del self.lost_leases[job.id]
+
+    def work(self, stage: PipelineStage, worker: str):
+        handler = self.handlers[stage]
+        while not self.stopping.is_set():
+            try:
+                with Session.begin() as session:
+                    job = PipelineJob.claim(session, stage, worker, self.lease)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception(f"{worker} could not claim a job")
+                job = None
+            if job is None:
+                self.stopping.wait(self.idle_interval)
+                continue
+
+            logger.info(f"{worker} running {job.key} (attempt {job.attempts})")
+            try:
+                with self.leased(job, worker):
+                    next_run_in = handler(job)
+            except LeaseLost as e:
+                logger.warning(f"Aborted {job.key}: {e}")
+                continue
+            except Postpone as e:
+                logger.info(f"Postponing {job.key} by {e.delay:.0f}s: {e}")
+                with Session.begin() as session:
+                    released = job.postpone(session, e.delay)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception(f"{job.key} failed")
+                with Session.begin() as session:
+                    released = job.fail(session, traceback.format_exc(), self.max_attempts)
+            else:
+                with Session.begin() as session:
+                    released = job.complete(session, next_run_in)
+            if not released:
+                logger.warning(f"{job.key} was taken over by another worker, its result is dropped")
+
+    def run(self):
+        self.seed()
+        hostname = f"{socket.gethostname()}:{os.getpid()}"
+        threads = [
+            threading.Thread(target=self.work, args=(stage, f"{hostname}:{stage.name.lower()}-{i}"))
+            for stage, concurrency in self.concurrency.items()
+            for i in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        logger.info(f"Pipeline daemon started with {len(threads)} workers")
+        for thread in threads:
+            thread.join()
+        logger.info("Pipeline daemon stopped")
+
+    def stop(self, *_):
+        logger.info("Stopping the pipeline daemon after the running jobs")
+        self.stopping.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ingest-concurrency", type=int, default=2, help="Number of sources ingested at once")
+    parser.add_argument(
+        "--download-parallelism", type=int, default=4, help="Number of batch outputs downloaded and applied at once"
+    )
+    parser.add_argument(
+        "--parse-workers", type=int, default=0, help="Number of processes transforming the feed items per source"
+    )
+    parser.add_argument("--ingest-interval", type=float, default=900, help="Seconds between the ingests of a source")
+    parser.add_argument("--poll-interval", type=float, default=60, help="Seconds between the batch status polls")
+    parser.add_argument(
+        "--clean-interval", type=float, default=3600, help="Seconds between the deletes of the expired listings"
+    )
+    parser.add_argument(
+        "--max-unsubmitted",
+        type=int,
+        default=1000000,
+        help="Ingests are postponed while more listings wait for a batch request",
+    )
+    parser.add_argument(
+        "--max-open-batches",
+        type=int,
+        default=10,
+        help="No batch requests are created while this many are not downloaded yet",
+    )
+    parser.add_argument("--batch-size", type=int, default=50000, help="Number of listings per batch request")
+    parser.add_argument(
+        "--batch-request-concurrency", type=int, default=4, help="Number of batch requests built & uploaded at once"
+    )
+    parser.add_argument("--poll-concurrency", type=int, default=8, help="Number of batch statuses retrieved at once")
+    parser.add_argument("--chunk-size", type=int, default=200, help="Number of domain searches ranked per query")
+    parser.add_argument(
+        "--lease",
+        type=float,
+        default=600,
+        help="Seconds without a heartbeat after which a running job is taken over by another worker",
+    )
+    parser.add_argument("--max-attempts", type=int, default=5, help="Number of attempts before a job is failed")
+    parser.add_argument(
+        "--embedding-mode",
+        choices=["batch", "online"],
+        default="batch",
+        help="Embed the new listings with the 24h batch API or right away with the embeddings endpoint "
+        "(ignored with EMBEDDING_PROVIDER=local, the listings are embedded locally)",
+    )
+    args = parser.parse_args()
+
+    daemon = PipelineDaemon(
+        ingest_concurrency=args.ingest_concurrency,
+        download_parallelism=args.download_parallelism,
+        parse_workers=args.parse_workers,
+        ingest_interval=args.ingest_interval,
+        poll_interval=args.poll_interval,
+        clean_interval=args.clean_interval,
+        max_unsubmitted=args.max_unsubmitted,
+        max_open_batches=args.max_open_batches,
+        batch_size=args.batch_size,
+        batch_request_concurrency=args.batch_request_concurrency,
+        poll_concurrency=args.poll_concurrency,
+        chunk_size=args.chunk_size,
+        lease=args.lease,
+        max_attempts=args.max_attempts,
+        embedding_mode=args.embedding_mode,
+    )
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
@@ -1,39 +1,139 @@
+import argparse
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Optional, Sequence
+
 from domainwizard.integrations.email import send_update_email
 from domainwizard.models import (
     BatchRequestStatus,
     DomainSearch,
+    Listing,
     OpenAIEmbeddingBatchRequest,
     Session,
+    engine,
 )
+from domainwizard.models.models import batched
 from loguru import logger
 from sqlalchemy import select
+from sqlalchemy.orm import raiseload
+
+
+def update_domain_searches(
+    batch_request_ids: Sequence[int],
+    chunk_size: int = 200,
+    mode: str = "incremental",
+    after_id: int = 0,
+    on_chunk: Optional[Callable[[int], None]] = None,
+    listing_ids: Sequence[int] = (),
+):
+    """
+    Ranks the listings of the finalized batch requests into the domain searches and emails the subscribers
+
+    The listings embedded without a batch request (online or locally) are given by `listing_ids`.
+
+    The searches are refreshed in chunks of `chunk_size` in id order, starting after `after_id`. `on_chunk` is called
+    with the last id of each finished chunk, so an interrupted run can continue from there.
+    """
+    with Session.begin() as session:
+        domain_search_ids = session.scalars(
+            select(DomainSearch.id).where(DomainSearch.id > after_id).order_by(DomainSearch.id)
+        ).all()
+
+    # the staged listings are a temporary table, all chunks run on one connection
+    with engine.connect() as connection:
+        if mode == "incremental":
+            with Session(bind=connection) as session, session.begin():
+                n_staged = Listing.stage_new_listings(session, batch_request_ids, listing_ids)
+            logger.info(f"Merging {n_staged} new listings into the domain searches")
+        for i, domain_search_id_chunk in enumerate(batched(domain_search_ids, chunk_size)):
+            logger.info(f"Updating domain searches chunk #{i + 1} ({len(domain_search_id_chunk)} searches)")
+            with Session(bind=connection) as session, session.begin():
+                if mode == "incremental":
+                    new_listing_ids = DomainSearch.merge_new_listings(session, domain_search_id_chunk)
+                else:
+                    new_listing_ids = DomainSearch.bulk_update_listings(session, domain_search_id_chunk)
+                if new_listing_ids:
+                    subscribed_domain_searches = session.scalars(
+                        select(DomainSearch)
+                        .where(
+                            DomainSearch.id.in_(new_listing_ids.keys()),
+                            DomainSearch.is_unlocked,
+                            DomainSearch.email.is_not(None),
+                            DomainSearch.name.is_not(None),
+                        )
+                        .options(raiseload("*"))
+                    ).all()
+                    # the listings of all emails of the chunk in one query
+                    email_listing_ids = {
+                        listing_id
+                        for domain_search in subscribed_domain_searches
+                        for listing_id in new_listing_ids[domain_search.id]
+                    }
+                    id_to_listing = {
+                        listing.id: listing for listing in Listing.get_by_ids(session, list(email_listing_ids))
+                    }
+                    for domain_search in subscribed_domain_searches:
+                        updated_listings = [
+                            id_to_listing[listing_id]
+                            for listing_id in new_listing_ids[domain_search.id]
+                            if listing_id in id_to_listing
+                        ]
+                        send_update_email(domain_search, updated_listings)
+            if on_chunk is not None:
+                on_chunk(domain_search_id_chunk[-1])
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunk-size", type=int, default=200, help="Number of domain searches refreshed per query")
+    parser.add_argument(
+        "--mode",
+        choices=["incremental", "full"],
+        default="incremental",
+        help="Score searches only against the newly embedded listings or against all active listings",
+    )
+    parser.add_argument(
+        "--parallelism", type=int, default=4, help="Number of batch outputs downloaded and applied at the same time"
+    )
+    parser.add_argument(
+        "--poll-concurrency", type=int, default=8, help="Number of batch statuses retrieved at the same time"
+    )
+    args = parser.parse_args()
+
     with Session.begin() as session:
-        completed_batch_requests = OpenAIEmbeddingBatchRequest.update_processing(session)
-        if not completed_batch_requests:
-            completed_batch_requests = session.scalars(
-                select(OpenAIEmbeddingBatchRequest).where(
-                    OpenAIEmbeddingBatchRequest.status == BatchRequestStatus.COMPLETED
-                )
-            ).all()
-
-    updated = False
-    logger.info("Downloading completed batch requests")
-    for batch_request in completed_batch_requests:
-        batch_request.download(Session, batch_size=1000)
-        updated = True
-
-    if updated:
-        with Session.begin() as session:
-            domain_searches = DomainSearch.get_all(session)
-            for domain_search in domain_searches:
-                logger.info(f"Updating domain search '{domain_search.summary}' ({domain_search.uuid})")
-                updated_listings = domain_search.update_listings(session)
-                if (
-                    updated_listings is not None
-                    and domain_search.is_unlocked
-                    and domain_search.email
-                    and domain_search.name
-                ):
-                    send_update_email(domain_search, updated_listings)
+        OpenAIEmbeddingBatchRequest.update_processing(session, concurrency=args.poll_concurrency)
+        # also picks up batches whose download failed in an earlier run, they resume from the stored offset
+        completed_batch_requests = session.scalars(
+            select(OpenAIEmbeddingBatchRequest).where(
+                OpenAIEmbeddingBatchRequest.status == BatchRequestStatus.COMPLETED
+            )
+        ).all()
+        batch_request_ids = {batch_request: batch_request.id for batch_request in completed_batch_requests}
+
+    # every running download draws its own progress bar line
+    progress_positions = queue.SimpleQueue()
+    for position in range(args.parallelism):
+        progress_positions.put(position)
+
+    def download(batch_request: OpenAIEmbeddingBatchRequest):
+        position = progress_positions.get()
+        try:
+            batch_request.download(Session, progress_position=position)
+        finally:
+            progress_positions.put(position)
+
+    logger.info(f"Downloading {len(completed_batch_requests)} completed batch requests ({args.parallelism} at a time)")
+    finalized_batch_request_ids = []
+    with ThreadPoolExecutor(max_workers=args.parallelism) as executor:
+        futures = {
+            executor.submit(download, batch_request): batch_request_ids[batch_request]
+            for batch_request in completed_batch_requests
+        }
+        for future in as_completed(futures):
+            if exception := future.exception():
+                logger.opt(exception=exception).error(f"Download of batch request {futures[future]} failed")
+            else:
+                finalized_batch_request_ids.append(futures[future])
+
+    if finalized_batch_request_ids:
+        update_domain_searches(finalized_batch_request_ids, args.chunk_size, args.mode)
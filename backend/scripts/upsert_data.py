@@ -1,32 +1,185 @@
-import datetime as dt
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 from domainwizard.integrations.data import Adapters
+from domainwizard.integrations.data.domains import DomainAdapter, iter_column_rows
+from domainwizard.integrations.embeddings import (
+    EMBEDDING_RPM,
+    EMBEDDING_TPM,
+    LocalEmbeddingProvider,
+    RateLimiter,
+    embedding_provider,
+)
 from domainwizard.models import (
     DataUpdate,
     DomainSearch,
+    FeedState,
     Listing,
     OpenAIEmbeddingBatchRequest,
     Session,
 )
 from loguru import logger
-from sqlalchemy import delete, text
+from sqlalchemy import text
+
+from .process_batch_requests import update_domain_searches
+
+
+def ingest(
+    adapter: DomainAdapter,
+    upsert_batch,
+    force: bool = False,
+    columnar: bool = False,
+    parse_workers: int = 0,
+    ordered: bool = True,
+    batch_request_concurrency: int = 4,
+    rate_limiter: Optional[RateLimiter] = None,
+    embed: bool = True,
+) -> tuple[dict[str, float], list[int]]:
+    """
+    Downloads, parses and upserts the listings of one source with its own connection
+
+    The new listings are embedded with the local embedding provider if configured, otherwise online with
+    `rate_limiter` if given or with OpenAI batch requests. Without `embed` they are left for the SUBMIT stage of the
+    pipeline daemon.
+    Returns the timings and the ids of the listings embedded right away (locally or online), which are not ranked into
+    the domain searches yet. The listings of batch requests are ranked once their output is downloaded.
+    """
+    tick = time.perf_counter()
+    if columnar or parse_workers:
+        dataset = adapter.timed_listing_batches(workers=parse_workers, ordered=ordered)
+        if not columnar:
+            dataset = iter_column_rows(dataset)
+    else:
+        dataset = adapter.timed_listings_data()
+    logger.info(f"Starting download & database upsert from {adapter.name}...")
+    with Session.begin() as session:
+        feed_state = FeedState.get_or_create(session, adapter.name)
+        if not force:
+            adapter.etag, adapter.last_modified = feed_state.etag, feed_state.last_modified
+        new_listing_ids: list[int] = []
+
+        def iter_new_listings():
+            for listing_id, listing_url in upsert_batch(session, dataset, adapter.name):
+                new_listing_ids.append(listing_id)
+                yield listing_id, listing_url
+
+        new_listing_id_to_url = iter_new_listings()
+        embedded_listing_ids: list[int] = []
+        if not embed:
+            n_new = sum(1 for _ in new_listing_id_to_url)
+            logger.info(f"Upserted {n_new} new listings from {adapter.name} without embeddings")
+        elif embedding_provider.name == LocalEmbeddingProvider.name:
+            Listing.embed_local(Session, new_listing_id_to_url)
+            embedded_listing_ids = new_listing_ids
+        elif rate_limiter is not None:
+            # searchable within minutes instead of up to 24h
+            Listing.embed_online(Session, new_listing_id_to_url, rate_limiter=rate_limiter)
+            embedded_listing_ids = new_listing_ids
+        else:
+            # the batch requests are uploaded while the upsert continues and are committed on their own
+            OpenAIEmbeddingBatchRequest.submit_batch_requests(
+                Session, new_listing_id_to_url, concurrency=batch_request_concurrency
+            )
+        # only stored once the feed is ingested, an interrupted run downloads it again
+        feed_state.etag, feed_state.last_modified = adapter.etag, adapter.last_modified
+    total = time.perf_counter() - tick
+    timings = {
+        "download": adapter.timings["download"],
+        "parse": adapter.timings["adapter"] - adapter.timings["download"],
+        # everything outside of the adapter: upsert and embedding batch requests
+        "upsert": total - adapter.timings["adapter"],
+        "total": total,
+    }
+    logger.info(f"Finished {adapter.name}: " + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in timings.items()))
+    return timings, embedded_listing_ids
+
 
 if __name__ == "__main__":
-    for Adapter in Adapters:
-        adapter = Adapter()
-        dataset = adapter.yield_listings_data()
-        logger.info(
-            f"Downloaded dataset from {adapter.name}. Starting database upsert...",
-        )
-        with Session.begin() as session:
-            new_listing_id_to_url = (
-                (listing_id, listing_url)
-                for listing_id, listing_url in Listing.upsert_batch(session, dataset, adapter.name)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--ingest",
+        choices=["copy", "orm"],
+        default="copy",
+        help="Upsert through a COPY staging table or through ORM executemany",
+    )
+    parser.add_argument("--concurrency", type=int, default=len(Adapters), help="Number of sources ingested at once")
+    parser.add_argument(
+        "--force", action="store_true", help="Download the feeds even if they did not change since the last run"
+    )
+    parser.add_argument(
+        "--transform",
+        choices=["row", "columnar"],
+        help="Transform the feed items one by one or in column batches (default: columnar for --ingest copy)",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=0,
+        help="Number of processes transforming & filtering the feed items (default: in the ingest thread)",
+    )
+    parser.add_argument(
+        "--unordered", action="store_true", help="Upsert the parsed batches as they finish instead of in feed order"
+    )
+    parser.add_argument(
+        "--batch-request-concurrency",
+        type=int,
+        default=4,
+        help="Number of embedding batch requests built & uploaded at once per source",
+    )
+    parser.add_argument(
+        "--embedding-mode",
+        choices=["batch", "online"],
+        default="batch",
+        help="Embed the new listings with the 24h batch API or right away with the embeddings endpoint "
+        "(ignored with EMBEDDING_PROVIDER=local, the listings are embedded locally)",
+    )
+    args = parser.parse_args()
+    columnar = (args.transform or ("columnar" if args.ingest == "copy" else "row")) == "columnar"
+    if columnar and args.ingest != "copy":
+        parser.error("--transform columnar requires --ingest copy")
+    if columnar:
+        upsert_batch = Listing.copy_upsert_column_batches
+    else:
+        upsert_batch = Listing.copy_upsert_batch if args.ingest == "copy" else Listing.upsert_batch
+
+    # the sources are embedded in their own event loops with their own rate limiter, the limits are split
+    n_parallel = min(args.concurrency, len(Adapters))
+    online = args.embedding_mode == "online"
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        adapters = [Adapter() for Adapter in Adapters]
+        source_results = dict(
+            zip(
+                (adapter.name for adapter in adapters),
+                executor.map(
+                    lambda adapter: ingest(
+                        adapter,
+                        upsert_batch,
+                        args.force,
+                        columnar,
+                        args.parse_workers,
+                        not args.unordered,
+                        args.batch_request_concurrency,
+                        RateLimiter(EMBEDDING_RPM / n_parallel, EMBEDDING_TPM / n_parallel) if online else None,
+                    ),
+                    adapters,
+                ),
             )
-            OpenAIEmbeddingBatchRequest.create_batch_requests(session, new_listing_id_to_url)
+        )
+    source_timings = {name: timings for name, (timings, _) in source_results.items()}
+    critical_source = max(source_timings, key=lambda name: source_timings[name]["total"])
+    logger.info(f"Critical path: {critical_source} ({source_timings[critical_source]['total']:.1f}s)")
+
+    # the listings embedded right away, after all sources so the rankings are not written concurrently
+    embedded_listing_ids = [listing_id for _, listing_ids in source_results.values() for listing_id in listing_ids]
+    if embedded_listing_ids:
+        logger.info(f"Ranking {len(embedded_listing_ids)} embedded listings into the domain searches...")
+        update_domain_searches([], listing_ids=embedded_listing_ids)
 
     with Session.begin() as session:
-        session.execute(delete(Listing).where(Listing.auction_end_time < dt.datetime.now(dt.UTC)))
+        Listing.delete_expired(session)
 
     with Session.begin() as session:
         logger.info("Creating DataUpdate entry...")
@@ -36,6 +189,8 @@ if __name__ == "__main__":
         session.add(data_update)
 
     with Session.begin() as session:
-        session.execute(text("VACUUM"))
+        # the deletes and updates only touch the listings and their rankings
+        session.execute(text("VACUUM (ANALYZE) listings"))
+        session.execute(text("VACUUM (ANALYZE) listings_to_domain_searches_rel"))
 
     logger.info("Upserting data finished.")
@@ -0,0 +1,116 @@
+import asyncio
+import datetime as dt
+import hashlib
+import os
+
+import pytest
+from domainwizard.integrations.embeddings import EMBEDDING_DIMENSIONS
+from domainwizard.models import (
+    AsyncSession,
+    DomainSearch,
+    Listing,
+    Session,
+    async_engine,
+    engine,
+)
+from domainwizard.models.models import ListingDomainSearch
+from sqlalchemy import delete, event, insert
+
+pytestmark = pytest.mark.skipif("TEST_DB_URL" not in os.environ, reason="needs the database of TEST_DB_URL")
+
+N_LISTINGS = 20
+PROMPT = "statement count test"
+
+
+def run(coroutine):
+    """Runs `coroutine` in a new event loop, the pooled connections belong to that loop and are closed with it"""
+
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await async_engine.dispose()
+
+    return asyncio.run(main())
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+@pytest.fixture
+def counter():
+    counter = StatementCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", counter)
+    yield counter
+    event.remove(engine, "before_cursor_execute", counter)
+    event.remove(async_engine.sync_engine, "before_cursor_execute", counter)
+
+
+@pytest.fixture
+def domain_search_id():
+    urls = [f"statement-count-test-{i}.com" for i in range(N_LISTINGS)]
+    auction_end_time = dt.datetime.now(dt.UTC).replace(tzinfo=None) + dt.timedelta(days=1)
+    with Session.begin() as session:
+        listing_ids = session.scalars(
+            insert(Listing).returning(Listing.id),
+            [dict(url=url, link=url, auction_end_time=auction_end_time, price=i) for i, url in enumerate(urls)],
+        ).all()
+        domain_search = DomainSearch(
+            prompt=PROMPT,
+            prompt_hash=hashlib.sha256(PROMPT.encode()).hexdigest(),
+            embeddings=[0.0] * EMBEDDING_DIMENSIONS,
+            is_example=True,
+        )
+        session.add(domain_search)
+        session.flush()
+        session.execute(
+            insert(ListingDomainSearch),
+            [
+                dict(listing_id=listing_id, domain_search_id=domain_search.id, score=i / N_LISTINGS)
+                for i, listing_id in enumerate(listing_ids)
+            ],
+        )
+        domain_search_id = domain_search.id
+    yield domain_search_id
+    with Session.begin() as session:
+        session.execute(delete(ListingDomainSearch).where(ListingDomainSearch.domain_search_id == domain_search_id))
+        session.execute(delete(DomainSearch).where(DomainSearch.id == domain_search_id))
+        session.execute(delete(Listing).where(Listing.url.in_(urls)))
+
+
+def test_aget_result_is_one_statement(counter, domain_search_id):
+    async def main():
+        async with AsyncSession() as session:
+            domain_search = await session.get(DomainSearch, domain_search_id)
+            counter.count = 0
+            result = await domain_search.aget_result(session)
+            assert counter.count == 1
+            return result
+
+    result = run(main())
+    assert result["totalDomains"] == N_LISTINGS
+    # the best score first
+    assert result["domains"][-1]["url"] == "statement-count-test-0.com"
+
+
+def test_examples_are_one_statement(counter, domain_search_id):
+    with Session() as session:
+        counter.count = 0
+        examples = DomainSearch.get_examples(session)
+        assert counter.count == 1
+    assert examples
+
+    async def main():
+        async with AsyncSession() as session:
+            counter.count = 0
+            examples = await DomainSearch.aget_examples(session)
+            assert counter.count == 1
+            return examples
+
+    assert run(main())
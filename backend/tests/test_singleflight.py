@@ -0,0 +1,128 @@
+import asyncio
+
+import domainwizard.models.models as models
+from domainwizard.models import DomainSearch, EmbeddingCache
+from domainwizard.models.singleflight import SingleFlight
+
+N_CALLERS = 20
+
+
+class FakeSession:
+    """Stands in for an `AsyncSession` in which no search exists yet"""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def scalar(self, _query):
+        return None
+
+    async def connection(self, **_kwargs):
+        return None
+
+    def add(self, instance):
+        instance.id = 1
+
+    async def flush(self):
+        pass
+
+
+class FakeSessionFactory:
+    def __call__(self):
+        return FakeSession()
+
+    def begin(self):
+        return FakeSession()
+
+
+class NoListingsIndex:
+    async def asearch(self, _session, _embeddings, limit=100):
+        return []
+
+
+def test_concurrent_calls_share_one_computation():
+    calls = []
+
+    async def compute():
+        calls.append(None)
+        await asyncio.sleep(0.01)
+        return object()
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("key", compute) for _ in range(N_CALLERS)))
+        assert len(flight) == 0
+        return results
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    async def compute():
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        flight = SingleFlight()
+        cancelled = asyncio.ensure_future(flight.do("key", compute))
+        waiting = asyncio.ensure_future(flight.do("key", compute))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        return await waiting
+
+    assert asyncio.run(main()) == "result"
+
+
+def test_failure_is_shared_and_not_cached():
+    calls = []
+
+    async def fail():
+        calls.append(None)
+        await asyncio.sleep(0.01)
+        raise ValueError("remote call failed")
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("key", fail) for _ in range(N_CALLERS)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        # the next call starts a new computation
+        await asyncio.gather(flight.do("key", fail), return_exceptions=True)
+
+    asyncio.run(main())
+    assert len(calls) == 2
+
+
+def test_concurrent_identical_creates_call_the_remote_apis_once(monkeypatch):
+    embedding_calls, summary_calls = [], []
+
+    async def aget_or_compute(_session_factory, text, *_args):
+        embedding_calls.append(text)
+        await asyncio.sleep(0.01)
+        return [0.0] * models.EMBEDDING_DIMENSIONS
+
+    async def aget_summary(prompt):
+        summary_calls.append(prompt)
+        await asyncio.sleep(0.01)
+        return "summary"
+
+    monkeypatch.setattr(EmbeddingCache, "aget_or_compute", staticmethod(aget_or_compute))
+    monkeypatch.setattr(models, "aget_summary", aget_summary)
+    monkeypatch.setattr(models, "USE_ADVISORY_LOCK", False)
+
+    async def main():
+        return await asyncio.gather(
+            *(
+                DomainSearch.acreate_or_get(FakeSessionFactory(), "  coffee shop  ", vector_index=NoListingsIndex())
+                for _ in range(N_CALLERS)
+            )
+        )
+
+    domain_searches = asyncio.run(main())
+    assert embedding_calls == ["coffee shop"]
+    assert summary_calls == ["coffee shop"]
+    assert all(domain_search is domain_searches[0] for domain_search in domain_searches)
+    assert domain_searches[0].summary == "summary"